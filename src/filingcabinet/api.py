@@ -1,21 +1,79 @@
+from typing import NamedTuple
+
 from django.conf import settings
 from django.core.files.base import File
+from django.db import transaction
 from django.template.defaultfilters import slugify
 
 from . import get_document_model, get_documentcollection_model
-from .models import CollectionDocument
+from .models import CollectionDocument, Page, TaggedDocument
+from .search import queue_document_index
+from .settings import FILINGCABINET_SECONDARY_CONTENT_HASH
 
 Document = get_document_model()
 DocumentCollection = get_documentcollection_model()
 
 
 def create_document(pdf_file_obj, metadata, process=True, update=False):
-    from .pdf_utils import calculcate_content_hash_from_file
+    from .pdf_utils import hash_file
+    from .utils import copy_to_temporary_file
 
+    original_name = getattr(pdf_file_obj, "name", None)
+    temp_file = None
+    properties = dict(metadata.get("properties", {}))
     content_hash = metadata.get("content_hash")
     if content_hash is None:
-        content_hash = calculcate_content_hash_from_file(pdf_file_obj)
+        if pdf_file_obj.seekable():
+            # Only hash it, storage copies or moves the file if it is needed
+            pdf_file_obj.seek(0)
+            hasher = hash_file(
+                pdf_file_obj, secondary=FILINGCABINET_SECONDARY_CONTENT_HASH
+            )
+            pdf_file_obj.seek(0)
+        else:
+            # Streams can only be read once, hash while copying
+            temp_file, hasher = copy_to_temporary_file(
+                pdf_file_obj, metadata.get("filename") or original_name or "file.pdf"
+            )
+            pdf_file_obj = temp_file
+        content_hash = hasher.hexdigest()
+        properties.update(hasher.get_properties())
+
+    try:
+        return create_or_update_document(
+            pdf_file_obj,
+            metadata,
+            content_hash,
+            properties,
+            original_name=original_name,
+            process=process,
+            update=update,
+        )
+    finally:
+        if temp_file is not None:
+            temp_file.close()
+
 
+# Fields set from metadata when updating documents
+DOCUMENT_UPDATE_FIELDS = [
+    "title",
+    "slug",
+    "description",
+    "published_at",
+    "language",
+    "public",
+    "pending",
+    "listed",
+    "allow_annotation",
+    "properties",
+    "data",
+    "outline",
+    "portal",
+    "content_hash",
+]
+
+
+def get_document_defaults(metadata, properties):
     if not metadata.get("slug"):
         metadata["slug"] = slugify(metadata["title"][:250])[:250]
 
@@ -29,11 +87,24 @@ def create_document(pdf_file_obj, metadata, process=True, update=False):
         "pending": metadata.get("pending", True),
         "listed": metadata.get("listed", True),
         "allow_annotation": metadata.get("allow_annotation", False),
-        "properties": metadata.get("properties", {}),
+        "properties": properties,
         "data": metadata.get("data", {}),
         "outline": metadata.get("outline", ""),
         "portal": metadata.get("portal"),
     }
+    return defaults
+
+
+def create_or_update_document(
+    pdf_file_obj,
+    metadata,
+    content_hash,
+    properties,
+    original_name=None,
+    process=True,
+    update=False,
+):
+    defaults = get_document_defaults(metadata, properties)
 
     lookup = {}
     if metadata.get("portal"):
@@ -55,6 +126,10 @@ def create_document(pdf_file_obj, metadata, process=True, update=False):
     else:
         doc, needs_saving = Document.objects.get_or_create(**lookup, defaults=defaults)
 
+    if not needs_saving and is_missing_file(doc):
+        # Left without file by an aborted import
+        needs_saving = True
+
     if metadata.get("tags"):
         doc.tags.add(*metadata["tags"])
 
@@ -62,17 +137,215 @@ def create_document(pdf_file_obj, metadata, process=True, update=False):
         CollectionDocument.objects.get_or_create(
             collection=metadata["collection"],
             document=doc,
+            defaults={"directory": metadata.get("directory")},
         )
 
     if not metadata.get("filename"):
-        if pdf_file_obj.name:
-            metadata["filename"] = pdf_file_obj.name
+        if original_name:
+            metadata["filename"] = original_name
         else:
             metadata["filename"] = doc.slug + ".pdf"
 
     if needs_saving and (update or not doc.pdf_file):
-        doc.pdf_file.save(metadata["filename"], File(pdf_file_obj), save=True)
+        if not isinstance(pdf_file_obj, File):
+            pdf_file_obj = File(pdf_file_obj)
+        doc.pdf_file.save(metadata["filename"], pdf_file_obj, save=True)
         if process:
             doc.process_document(reprocess=update)
 
     return doc
+
+
+class PreparedFile(NamedTuple):
+    file: File
+    metadata: dict
+    content_hash: str
+    properties: dict
+
+
+def create_documents_in_bulk(
+    prepared_files: list[PreparedFile], process=True, update=False
+):
+    """
+    Creates documents for files that are not yet present with one lookup
+    query per lookup kind and bulk inserts. Like create_or_update_document,
+    portal documents are looked up by portal and foreign id and all others
+    by content hash, update replaces the metadata and files of existing
+    documents, and tags and collection links are added to new and existing
+    documents. Portal documents without foreign id go through
+    create_or_update_document. Returns the created documents.
+    """
+    keyed_files = []
+    for prepared in prepared_files:
+        key = get_document_lookup_key(prepared.metadata, prepared.content_hash)
+        if key is None:
+            create_or_update_document(
+                prepared.file,
+                prepared.metadata,
+                prepared.content_hash,
+                prepared.properties,
+                process=process,
+                update=update,
+            )
+        else:
+            keyed_files.append((key, prepared))
+    key_docs = get_documents_by_lookup_key([key for key, _ in keyed_files])
+    seen_keys = set()
+    docs = []
+    update_docs = []
+    language_docs = []
+    file_docs = []
+    for key, prepared in keyed_files:
+        if key in seen_keys:
+            # Present earlier in this batch
+            continue
+        seen_keys.add(key)
+        defaults = get_document_defaults(prepared.metadata, prepared.properties)
+        if process:
+            defaults["pending"] = True
+        defaults["content_hash"] = prepared.content_hash
+        doc = key_docs.get(key)
+        if doc is not None:
+            if update:
+                if doc.language != defaults["language"]:
+                    language_docs.append(doc.id)
+                for attr, value in defaults.items():
+                    setattr(doc, attr, value)
+                update_docs.append(doc)
+                file_docs.append((doc, prepared))
+            elif is_missing_file(doc):
+                # Left without file by an aborted import, repair it
+                file_docs.append((doc, prepared))
+            continue
+        doc = Document(**defaults)
+        key_docs[key] = doc
+        docs.append(doc)
+        file_docs.append((doc, prepared))
+
+    if file_docs:
+        save_files_in_bulk(docs, file_docs, update_docs)
+    if language_docs:
+        # bulk_update skips Document.save
+        queue_document_index(language_docs)
+
+    doc_tags = []
+    collection_docs = []
+    for key, prepared in keyed_files:
+        doc = key_docs[key]
+        if prepared.metadata.get("tags"):
+            doc_tags.append((doc, prepared.metadata["tags"]))
+        if prepared.metadata.get("collection") is not None:
+            collection_docs.append(
+                CollectionDocument(
+                    collection=prepared.metadata["collection"],
+                    document=doc,
+                    directory=prepared.metadata.get("directory"),
+                )
+            )
+    add_tags_in_bulk(doc_tags)
+    # Existing links keep their directory like get_or_create does
+    CollectionDocument.objects.bulk_create(collection_docs, ignore_conflicts=True)
+
+    if process and file_docs:
+        if update_docs:
+            # Reprocess pages of replaced files
+            Page.objects.filter(document__in=update_docs).update(pending=True)
+        enqueue_document_processing([doc for doc, _ in file_docs])
+    return docs
+
+
+def get_document_lookup_key(metadata, content_hash):
+    """
+    Returns the key create_or_update_document looks up a document by:
+    portal and foreign id for portal documents, otherwise the content hash.
+    Portal documents without foreign id have no key.
+    """
+    portal = metadata.get("portal")
+    if portal is None:
+        return ("content_hash", content_hash)
+    foreign_id = metadata.get("properties", {}).get("foreign_id")
+    if not foreign_id:
+        return None
+    return ("portal", portal.id, foreign_id)
+
+
+def get_documents_by_lookup_key(keys) -> dict:
+    content_hashes = {key[1] for key in keys if key[0] == "content_hash"}
+    portal_ids = {key[1] for key in keys if key[0] == "portal"}
+    foreign_ids = [key[2] for key in keys if key[0] == "portal"]
+    key_docs = {}
+    if content_hashes:
+        for doc in Document.objects.filter(content_hash__in=content_hashes):
+            key_docs.setdefault(("content_hash", doc.content_hash), doc)
+    if portal_ids:
+        for doc in Document.objects.filter(
+            portal_id__in=portal_ids, properties__foreign_id__in=foreign_ids
+        ):
+            key = ("portal", doc.portal_id, doc.properties.get("foreign_id"))
+            key_docs.setdefault(key, doc)
+    return key_docs
+
+
+def is_missing_file(doc):
+    return not doc.pdf_file and not doc.has_original
+
+
+def save_files_in_bulk(docs, file_docs, update_docs=()):
+    """
+    Inserts new documents, updates the metadata of updated documents and
+    saves files of (document, prepared file) pairs in one transaction, so
+    an aborted batch leaves no documents without file behind. Files saved
+    before an error are removed.
+    """
+    saved = []
+    try:
+        with transaction.atomic():
+            Document.objects.bulk_create(docs)
+            if update_docs:
+                Document.objects.bulk_update(update_docs, DOCUMENT_UPDATE_FIELDS)
+            for doc, prepared in file_docs:
+                filename = prepared.metadata.get("filename") or doc.slug + ".pdf"
+                doc.pdf_file.save(filename, prepared.file, save=False)
+                saved.append(doc.pdf_file)
+            Document.objects.bulk_update([doc for doc, _ in file_docs], ["pdf_file"])
+    except Exception:
+        for field_file in saved:
+            field_file.storage.delete(field_file.name)
+        raise
+
+
+def add_tags_in_bulk(doc_tags):
+    """
+    Adds tag names to documents given as (document, tag names) pairs
+    with one insert of the missing tagged items.
+    """
+    if not doc_tags:
+        return
+    tag_model = TaggedDocument.tag_model()
+    names = {str(name) for _, tag_names in doc_tags for name in tag_names}
+    tags = {tag.name: tag for tag in tag_model.objects.filter(name__in=names)}
+    for name in names - tags.keys():
+        tags[name], _created = tag_model.objects.get_or_create(name=name)
+    existing = set(
+        TaggedDocument.objects.filter(
+            content_object__in={doc for doc, _ in doc_tags},
+            tag__in=tags.values(),
+        ).values_list("content_object_id", "tag_id")
+    )
+    tagged_items = []
+    for doc, tag_names in doc_tags:
+        for name in tag_names:
+            key = (doc.id, tags[str(name)].id)
+            if key in existing:
+                continue
+            existing.add(key)
+            tagged_items.append(TaggedDocument(content_object=doc, tag=tags[str(name)]))
+    TaggedDocument.objects.bulk_create(tagged_items)
+
+
+def enqueue_document_processing(docs):
+    from celery import group
+
+    from .tasks import process_document_task
+
+    group(process_document_task.si(doc.id) for doc in docs).apply_async()
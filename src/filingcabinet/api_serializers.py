@@ -17,15 +17,45 @@ Document = get_document_model()
 DocumentCollection = get_documentcollection_model()
 
 
+def get_requested_fields(request):
+    """
+    Returns the set of fields requested with the fields query parameter,
+    None if all fields are requested.
+    """
+    if request is None:
+        return None
+    fields = request.GET.get("fields", "")
+    fields = {field.strip() for field in fields.split(",") if field.strip()}
+    return fields or None
+
+
 class PageSerializer(serializers.HyperlinkedModelSerializer):
     document = serializers.HyperlinkedRelatedField(
         read_only=True, view_name="api:document-detail"
     )
     image = serializers.CharField(source="get_image_url")
+    # Only present on search results
+    query_highlight = serializers.CharField(read_only=True)
 
     class Meta:
         model = Page
-        fields = ("document", "number", "content", "width", "height", "image")
+        fields = (
+            "document",
+            "number",
+            "content",
+            "width",
+            "height",
+            "image",
+            "query_highlight",
+        )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        fields = get_requested_fields(request)
+        if fields:
+            for field_name in set(self.fields) - fields:
+                self.fields.pop(field_name)
 
 
 class DocumentSerializer(serializers.HyperlinkedModelSerializer):
@@ -1,10 +1,25 @@
+import base64
+import binascii
+import datetime
+import json
+import operator
 from collections import OrderedDict
+from functools import reduce
 
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import F, Q
 
 from rest_framework import status
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .settings import FILINGCABINET_API_COUNT_ESTIMATE_THRESHOLD
+
+COUNT_MODES = ("exact", "estimate", "none")
 
 
 def make_oembed_response(request, model):
@@ -76,3 +91,182 @@ class CustomLimitOffsetPagination(LimitOffsetPagination):
                 ]
             )
         )
+
+
+def get_keyset_ordering(queryset):
+    """
+    Returns (field name, descending) pairs of the queryset ordering with
+    primary key as tie-breaker, or None if ordering is not keyset compatible.
+    """
+    query = queryset.query
+    if query.order_by:
+        ordering = query.order_by
+    elif query.default_ordering:
+        ordering = queryset.model._meta.ordering
+    else:
+        ordering = ()
+    keyset = []
+    for order in ordering:
+        if not isinstance(order, str) or order == "?":
+            return None
+        name = order.lstrip("-")
+        keyset.append((name, order.startswith("-")))
+    if not any(name in ("pk", queryset.model._meta.pk.name) for name, _ in keyset):
+        keyset.append(("pk", False))
+    return keyset
+
+
+def apply_keyset(queryset, keyset, values):
+    """
+    Annotates keyset values and filters rows after values.
+    Annotations reuse joins of filters on multi-valued relations,
+    nulls are ordered last.
+    """
+    aliases = ["keyset_{}".format(i) for i in range(len(keyset))]
+    queryset = queryset.annotate(
+        **{alias: F(name) for alias, (name, _) in zip(aliases, keyset, strict=True)}
+    ).order_by(
+        *[
+            F(alias).desc(nulls_last=True)
+            if descending
+            else F(alias).asc(nulls_last=True)
+            for alias, (_, descending) in zip(aliases, keyset, strict=True)
+        ]
+    )
+    if values is None:
+        return queryset
+    conditions = []
+    equal = Q()
+    for alias, (_, descending), value in zip(aliases, keyset, values, strict=True):
+        null = Q(**{"{}__isnull".format(alias): True})
+        if value is None:
+            # Only nulls follow nulls
+            equal &= null
+            continue
+        lookup = "{}__{}".format(alias, "lt" if descending else "gt")
+        conditions.append(equal & (Q(**{lookup: value}) | null))
+        equal &= Q(**{alias: value})
+    if not conditions:
+        return queryset.none()
+    return queryset.filter(reduce(operator.or_, conditions))
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        # DjangoJSONEncoder cuts microseconds that keyset comparisons need
+        if isinstance(o, datetime.datetime):
+            return {"datetime": o.isoformat()}
+        return super().default(o)
+
+
+def decode_cursor_value(obj):
+    if obj.keys() == {"datetime"}:
+        return datetime.datetime.fromisoformat(obj["datetime"])
+    return obj
+
+
+def encode_cursor(values):
+    data = json.dumps(values, cls=CursorEncoder).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor, length):
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("ascii")),
+            object_hook=decode_cursor_value,
+        )
+    except (ValueError, binascii.Error):
+        raise NotFound("Invalid cursor") from None
+    if not isinstance(values, list) or len(values) != length:
+        raise NotFound("Invalid cursor")
+    return values
+
+
+def estimate_count(queryset):
+    """
+    Uses the query planner row estimate on PostgreSQL if it is above
+    FILINGCABINET_API_COUNT_ESTIMATE_THRESHOLD, exact count otherwise.
+    """
+    queryset = queryset.order_by()
+    if connections[queryset.db].vendor == "postgresql":
+        plan = json.loads(queryset.explain(format="json"))
+        estimate = plan[0]["Plan"]["Plan Rows"]
+        if estimate > FILINGCABINET_API_COUNT_ESTIMATE_THRESHOLD:
+            return estimate
+    return queryset.count()
+
+
+class KeysetLimitOffsetPagination(CustomLimitOffsetPagination):
+    """
+    Limit offset pagination with opt-in keyset pagination: the cursor
+    parameter (empty for the first page) continues after the ordering
+    values of the previous page instead of counting an offset.
+    The count parameter selects an exact, estimated or no total count.
+    """
+
+    cursor_query_param = "cursor"
+    count_query_param = "count"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count_mode = request.query_params.get(self.count_query_param)
+        if self.count_mode not in COUNT_MODES:
+            self.count_mode = "exact"
+        self.keyset = None
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor is not None:
+            self.keyset = get_keyset_ordering(queryset)
+        self.has_next = None
+        if self.keyset is None and self.count_mode == "exact":
+            return super().paginate_queryset(queryset, request, view=view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        if self.count_mode == "exact":
+            self.count = self.get_count(queryset)
+        elif self.count_mode == "estimate":
+            self.count = estimate_count(queryset)
+        else:
+            self.count = None
+
+        if self.keyset is not None:
+            values = None
+            if cursor:
+                values = decode_cursor(cursor, len(self.keyset))
+            queryset = apply_keyset(queryset, self.keyset, values)
+            self.offset = None
+            results = list(queryset[: self.limit + 1])
+        else:
+            self.offset = self.get_offset(request)
+            results = list(queryset[self.offset : self.offset + self.limit + 1])
+        self.has_next = len(results) > self.limit
+        results = results[: self.limit]
+        if self.keyset is not None and results:
+            last = results[-1]
+            self.next_cursor = encode_cursor(
+                [getattr(last, "keyset_{}".format(i)) for i in range(len(self.keyset))]
+            )
+        self.display_page_controls = False
+        return results
+
+    def get_next_link(self):
+        if self.has_next is None:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        if self.keyset is not None:
+            url = remove_query_param(url, self.offset_query_param)
+            return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+        return replace_query_param(
+            url, self.offset_query_param, self.offset + self.limit
+        )
+
+    def get_previous_link(self):
+        if self.keyset is not None:
+            # Keyset pages only link forward
+            return None
+        return super().get_previous_link()
@@ -28,10 +28,17 @@ from .api_serializers import (
     PageAnnotationSerializer,
     PageSerializer,
     UpdateDocumentSerializer,
+    get_requested_fields,
 )
-from .api_utils import CustomLimitOffsetPagination, make_oembed_response
+from .api_utils import (
+    CustomLimitOffsetPagination,
+    KeysetLimitOffsetPagination,
+    make_oembed_response,
+)
+from .facets import get_facet_filters, get_facets
 from .filters import DocumentFilter, PageDocumentFilterset
 from .models import CollectionDirectory, DocumentPortal, Page, PageAnnotation
+from .search import get_search_backend
 
 Document = get_document_model()
 DocumentCollection = get_documentcollection_model()
@@ -81,7 +88,31 @@ class DocumentPortalViewSet(viewsets.ReadOnlyModelViewSet):
         return make_oembed_response(request, DocumentPortal)
 
 
+class FacetListMixin:
+    """
+    Adds counts of the facet filters of the requested portal or
+    collection to the paginated list response.
+    """
+
+    facet_prefix = ""
+
+    def list(self, request, *args, **kwargs):
+        filters = []
+        if request.GET.get("format") != "rss":
+            filters = get_facet_filters(request)
+        if not filters:
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        facets = get_facets(queryset, filters, prefix=self.facet_prefix)
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(
+            {"objects": serializer.data, "facets": facets}
+        )
+
+
 class DocumentViewSet(
+    FacetListMixin,
     mixins.ListModelMixin,
     mixins.RetrieveModelMixin,
     mixins.UpdateModelMixin,
@@ -92,7 +123,7 @@ class DocumentViewSet(
         "retrieve": DocumentDetailSerializer,
         "update": UpdateDocumentSerializer,
     }
-    pagination_class = CustomLimitOffsetPagination
+    pagination_class = KeysetLimitOffsetPagination
     permission_classes = (CanReadWritePermission,)
     filterset_class = DocumentFilter
 
@@ -132,12 +163,12 @@ class DocumentViewSet(
         return make_oembed_response(request, Document)
 
 
-class PageViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
+class PageViewSet(FacetListMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
     serializer_class = PageSerializer
+    facet_prefix = "document__"
     filterset_class = PageDocumentFilterset
     renderer_classes = viewsets.GenericViewSet.renderer_classes + [RSSRenderer]
-    pagination_class = CustomLimitOffsetPagination
-    search_fields = ["content"]
+    pagination_class = KeysetLimitOffsetPagination
 
     def get_queryset(self):
         document_id = self.request.query_params.get("document", "")
@@ -166,13 +197,27 @@ class PageViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
             except (ValueError, DocumentCollection.DoesNotExist):
                 return Page.objects.none()
 
-        # Always order by publication date on RSS format
-        has_query = self.request.GET.get("q")
+        # Always order by publication date on RSS format. Pages have no
+        # publication date of their own, ordering by -published_at failed
+        # with a FieldError, use the one of their document.
+        has_query = self.request.GET.get("q") or self.request.GET.get("search")
         if has_query and self.request.GET.get("format") == "rss":
-            pages = pages.order_by("-published_at")
+            pages = pages.order_by("-document__published_at")
+
+        fields = get_requested_fields(self.request)
+        if fields and "content" not in fields and get_search_backend().indexed:
+            # Indexed backends build highlights in the database
+            pages = pages.defer("content")
 
         return pages.prefetch_related("document")
 
+    def paginate_queryset(self, queryset):
+        pages = super().paginate_queryset(queryset)
+        query = self.request.GET.get("q")
+        if pages is not None and query:
+            get_search_backend().highlight_pages(pages, query)
+        return pages
+
 
 class DocumentCollectionViewSet(
     mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet
@@ -0,0 +1,145 @@
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import models
+from django.db.models import Count
+from django.db.models.fields.json import KT
+from django.db.models.functions import Coalesce, Trunc
+
+from . import get_documentcollection_model
+from .models import DocumentPortal
+from .settings import FILINGCABINET_FACET_CACHE_TIMEOUT
+
+FACET_CACHE_KEY = "filingcabinet:facets:{}"
+DATE_INTERVALS = {"year", "quarter", "month", "week", "day"}
+TAG_KEYS = {"tag", "tags"}
+
+
+def get_facet_filters(request):
+    """
+    Returns filters with enabled facet of the portal or collection
+    requested by the portal or collection query parameter.
+    """
+    filters = []
+    portal_id = request.GET.get("portal", "")
+    if portal_id.isdigit():
+        portal = DocumentPortal.objects.filter(public=True, pk=portal_id).first()
+        if portal is not None:
+            filters.extend(portal.settings.get("filters", []))
+    collection_id = request.GET.get("collection", "")
+    if collection_id.isdigit():
+        collection = (
+            get_documentcollection_model().objects.filter(pk=collection_id).first()
+        )
+        if collection is not None and collection.can_read(request):
+            filters.extend(collection.settings.get("filters", []))
+    return [filt for filt in filters if filt.get("facet")]
+
+
+def get_choice_facet(queryset, filt, prefix):
+    data_key = filt["key"].split(".", 1)[1].replace(".", "__")
+    counts = (
+        queryset.order_by()
+        .values(value=KT("{}data__{}".format(prefix, data_key)))
+        .annotate(count=Count("pk"))
+        .order_by("-count", "value")
+    )
+    buckets = []
+    for row in counts:
+        value = row["value"]
+        if value is None:
+            continue
+        if filt.get("datatype") == "int":
+            try:
+                value = int(value)
+            except ValueError:
+                continue
+        buckets.append({"value": value, "count": row["count"]})
+    return {"type": "choice", "key": filt["key"], "buckets": buckets}
+
+
+def get_date_facet(queryset, filt, prefix):
+    facet_config = filt.get("facet_config") or {}
+    interval = facet_config.get("interval", "year")
+    if interval not in DATE_INTERVALS:
+        interval = "year"
+    if filt["key"] == "created_at":
+        # Like the created_at filter, prefer the publication date
+        date = Coalesce("{}published_at".format(prefix), "{}created_at".format(prefix))
+    else:
+        date = models.F("{}{}".format(prefix, filt["key"]))
+    counts = (
+        queryset.order_by()
+        .annotate(bucket=Trunc(date, interval, output_field=models.DateTimeField()))
+        .values("bucket")
+        .annotate(count=Count("pk"))
+        .order_by("bucket")
+    )
+    return {
+        "type": "date_histogram",
+        "key": filt["key"],
+        "interval": interval,
+        "buckets": [
+            {"value": row["bucket"].isoformat(), "count": row["count"]}
+            for row in counts
+            if row["bucket"] is not None
+        ],
+    }
+
+
+def get_tag_facet(queryset, filt, prefix):
+    counts = (
+        queryset.order_by()
+        .filter(**{"{}tags__isnull".format(prefix): False})
+        .values(
+            value=models.F("{}tags__slug".format(prefix)),
+            label=models.F("{}tags__name".format(prefix)),
+        )
+        .annotate(count=Count("pk"))
+        .order_by("-count", "value")
+    )
+    return {"type": "tag", "key": filt["key"], "buckets": list(counts)}
+
+
+def get_facet(queryset, filt, prefix=""):
+    if filt["key"] in TAG_KEYS:
+        return get_tag_facet(queryset, filt, prefix)
+    if filt["type"] == "daterange" and not filt["key"].startswith("data."):
+        return get_date_facet(queryset, filt, prefix)
+    if filt["type"] == "choice" and filt["key"].startswith("data."):
+        return get_choice_facet(queryset, filt, prefix)
+    return None
+
+
+def get_facets(queryset, filters, prefix=""):
+    """
+    Counts results of the filtered queryset by the facet filters with one
+    grouped query per facet. prefix leads from the queryset model to the
+    document, e.g. "document__" for pages.
+    """
+    if not filters:
+        return {}
+    try:
+        cache_key = get_facet_cache_key(queryset, filters)
+    except EmptyResultSet:
+        cache_key = None
+    if cache_key is not None:
+        facets = cache.get(cache_key)
+        if facets is not None:
+            return facets
+    facets = {}
+    for filt in filters:
+        facet = get_facet(queryset, filt, prefix=prefix)
+        if facet is not None:
+            facets[filt["id"]] = facet
+    if cache_key is not None:
+        cache.set(cache_key, facets, FILINGCABINET_FACET_CACHE_TIMEOUT)
+    return facets
+
+
+def get_facet_cache_key(queryset, filters):
+    sql, params = queryset.query.sql_with_params()
+    key = json.dumps([sql, [str(param) for param in params], filters], sort_keys=True)
+    return FACET_CACHE_KEY.format(hashlib.sha1(key.encode("utf-8")).hexdigest())
@@ -5,6 +5,7 @@ from taggit.models import Tag
 
 from . import get_document_model, get_documentcollection_model
 from .models import CollectionDirectory, DocumentPortal, Page
+from .search import get_search_backend
 
 Document = get_document_model()
 DocumentCollection = get_documentcollection_model()
@@ -123,7 +124,9 @@ class DocumentFilter(filters.FilterSet):
 
 
 class PageDocumentFilterset(filters.FilterSet):
-    q = filters.CharFilter(field_name="content", lookup_expr="contains")
+    q = filters.CharFilter(method="filter_query")
+    # Former parameter of the SearchFilter on page content, same as q
+    search = filters.CharFilter(method="filter_query")
 
     tag = filters.ModelChoiceFilter(
         queryset=Tag.objects.all(), to_field_name="slug", method="filter_tag"
@@ -177,6 +180,11 @@ class PageDocumentFilterset(filters.FilterSet):
             queryset = queryset.filter(document__listed=True)
         return super().filter_queryset(queryset)
 
+    def filter_query(self, qs, name, value):
+        # Feeds stay ordered by publication date
+        rank = self.request.GET.get("format") != "rss"
+        return get_search_backend().search(qs, value, rank=rank)
+
     def filter_tag(self, qs, name, value):
         return qs.filter(document__tags=value)
 
@@ -0,0 +1,90 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...pdf_utils import RASTERIZERS, TEXT_EXTRACTORS, PDFProcessor
+
+
+class Command(BaseCommand):
+    help = "Compare page processing backends on PDF files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("filenames", nargs="+", type=str)
+        parser.add_argument(
+            "--max-pages",
+            type=int,
+            default=20,
+            help="Only process the first pages of each file",
+        )
+        parser.add_argument(
+            "--rasterizer",
+            action="append",
+            choices=list(RASTERIZERS),
+            help="Rasterizer to benchmark, can be given multiple times",
+        )
+        parser.add_argument(
+            "--text-extractor",
+            action="append",
+            choices=list(TEXT_EXTRACTORS),
+            help="Text extractor to benchmark, can be given multiple times",
+        )
+
+    def handle(self, *args, **options):
+        rasterizers = options["rasterizer"] or list(RASTERIZERS)
+        text_extractors = options["text_extractor"] or list(TEXT_EXTRACTORS)
+        for filename in options["filenames"]:
+            pdf = PDFProcessor(filename)
+            pages = list(range(1, min(pdf.num_pages, options["max_pages"]) + 1))
+            self.stdout.write("{} ({} pages)".format(filename, len(pages)))
+            for name in rasterizers:
+                self.benchmark_rasterizer(pdf, name, pages)
+            for name in text_extractors:
+                self.benchmark_text_extractor(pdf, name, pages)
+
+    def report(self, name, pages, count, duration):
+        per_page = duration / count if count else 0
+        self.stdout.write(
+            "  {name}: {count}/{total} pages in {duration:.2f}s "
+            "({per_page:.3f}s per page)".format(
+                name=name,
+                count=count,
+                total=len(pages),
+                duration=duration,
+                per_page=per_page,
+            )
+        )
+
+    def benchmark_rasterizer(self, pdf, name, pages):
+        pdf.config["RASTERIZER"] = name
+        count = 0
+        start = time.perf_counter()
+        try:
+            for _page_number, image in pdf.get_images(pages):
+                # Force decoding like thumbnailing does
+                image.image  # noqa: B018
+                count += 1
+        except RuntimeError as err:
+            self.stderr.write("  {}: {}".format(name, err))
+            return
+        self.report(
+            "rasterizer {}".format(name), pages, count, time.perf_counter() - start
+        )
+
+    def benchmark_text_extractor(self, pdf, name, pages):
+        pdf.config["TEXT_EXTRACTOR"] = name
+        count = 0
+        chars = 0
+        start = time.perf_counter()
+        try:
+            for page_number in pages:
+                chars += len(pdf._get_text_for_page(page_number))
+                count += 1
+        except RuntimeError as err:
+            self.stderr.write("  {}: {}".format(name, err))
+            return
+        self.report(
+            "text extractor {} ({} chars)".format(name, chars),
+            pages,
+            count,
+            time.perf_counter() - start,
+        )
@@ -1,19 +1,36 @@
 import glob
-import hashlib
 import json
+import logging
 import os
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import PurePath
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 
 from ... import get_document_model, get_documentcollection_model
-from ...api import create_document
+from ...api import (
+    PreparedFile,
+    create_document,
+    create_documents_in_bulk,
+    create_or_update_document,
+    get_document_lookup_key,
+    get_documents_by_lookup_key,
+)
 from ...models import DocumentPortal
+from ...utils import (
+    build_directory_tree,
+    copy_to_temporary_file,
+    get_existing_directories,
+)
 
 Document = get_document_model()
 DocumentCollection = get_documentcollection_model()
 
+logger = logging.getLogger(__name__)
+
 
 def parse_date(date_str):
     try:
@@ -25,34 +42,168 @@ def parse_date(date_str):
     return date
 
 
+class ImportManifest:
+    """
+    JSON lines file recording path, content hash and resulting
+    document id of every imported file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def get_imported_paths(self):
+        if not os.path.exists(self.path):
+            return set()
+        paths = set()
+        with open(self.path) as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    paths.add(json.loads(line)["path"])
+                except (ValueError, KeyError, TypeError):
+                    # e.g. last line truncated by an interrupted import
+                    logger.warning(
+                        "Skipping invalid line %s of manifest %s", line_no, self.path
+                    )
+        return paths
+
+    def open(self):
+        truncated = False
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                truncated = f.read(1) != b"\n"
+        self.file = open(self.path, "a")
+        if truncated:
+            # Start the next record on its own line
+            self.file.write("\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def record(self, path, content_hash, document_id):
+        self.file.write(
+            json.dumps(
+                {"path": path, "content_hash": content_hash, "document": document_id}
+            )
+            + "\n"
+        )
+        self.file.flush()
+
+
 class Command(BaseCommand):
     help = "Load directory of PDFs with meta data JSON files"
 
     def add_arguments(self, parser):
         parser.add_argument("directory", type=str)
         parser.add_argument("--update", action="store_true")
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Hash and copy files in this many threads, implies batches",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="Import files in batches with bulk queries (default 100)",
+        )
+        parser.add_argument(
+            "--recursive",
+            action="store_true",
+            help="Import PDFs in subdirectories as collection directories",
+        )
+        parser.add_argument(
+            "--collection",
+            type=int,
+            default=None,
+            help="Collection for files without collection in their metadata",
+        )
+        parser.add_argument(
+            "--manifest",
+            type=str,
+            default=None,
+            help="JSON lines file recording every imported file",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Skip files recorded in the manifest without opening them",
+        )
 
     def handle(self, *args, **options):
-        directory = options["directory"]
+        self.directory = options["directory"]
         update = options["update"]
         self.portals = {}
         self.collections = {}
-        pdf_files = glob.glob(os.path.join(directory, "*.pdf"))
+        self.directories = {}
+        self.recursive = options["recursive"]
+        self.default_collection = None
+        if options["collection"] is not None:
+            self.default_collection = self.get_collection(options["collection"])
+
+        if self.recursive:
+            pattern = os.path.join(self.directory, "**", "*.pdf")
+        else:
+            pattern = os.path.join(self.directory, "*.pdf")
+        pdf_files = sorted(glob.glob(pattern, recursive=self.recursive))
+
+        self.manifest = None
+        if options["manifest"]:
+            self.manifest = ImportManifest(options["manifest"])
+        if options["resume"]:
+            if self.manifest is None:
+                raise CommandError("--resume needs a --manifest")
+            imported_paths = self.manifest.get_imported_paths()
+            remaining = [
+                pdf_file
+                for pdf_file in pdf_files
+                if self.get_relative_path(pdf_file) not in imported_paths
+            ]
+            self.stdout.write(
+                "Skipping %s already imported files" % (len(pdf_files) - len(remaining))
+            )
+            pdf_files = remaining
+
+        if self.recursive and self.default_collection is not None:
+            # Create the directory tree for all files at once
+            self.build_directories(self.default_collection, pdf_files)
+
+        if self.manifest is not None:
+            self.manifest.open()
+        try:
+            self.import_pdfs(pdf_files, options, update=update)
+        finally:
+            if self.manifest is not None:
+                self.manifest.close()
+
+    def import_pdfs(self, pdf_files, options, update=False):
+        workers = options["workers"]
+        batch_size = options["batch_size"]
+        if workers > 1 or batch_size:
+            self.import_in_batches(
+                pdf_files, workers=workers, batch_size=batch_size or 100, update=update
+            )
+            return
         for pdf_file in pdf_files:
             self.stdout.write("Importing %s" % pdf_file)
-            self.import_pdf(pdf_file, update=update)
-
-    def get_content_hash(self, pdf_filename):
-        h = hashlib.sha1()
-        with open(pdf_filename, "rb") as f:
-            while True:
-                chunk = f.read(h.block_size)
-                if not chunk:
-                    break
-                h.update(chunk)
-        return h.hexdigest()
+            doc = self.import_pdf(pdf_file, update=update)
+            self.record_import(pdf_file, doc.content_hash, doc.id)
 
-    def import_pdf(self, pdf_filename, update=False):
+    def get_relative_path(self, pdf_filename):
+        return os.path.relpath(pdf_filename, self.directory)
+
+    def record_import(self, pdf_filename, content_hash, document_id):
+        if self.manifest is not None:
+            self.manifest.record(
+                self.get_relative_path(pdf_filename), content_hash, document_id
+            )
+
+    def read_metadata(self, pdf_filename):
         metadata_filename = pdf_filename.replace(".pdf", ".json")
         if os.path.exists(metadata_filename):
             with open(metadata_filename) as f:
@@ -66,7 +217,9 @@ class Command(BaseCommand):
             metadata["published_at"] = parse_date(metadata["published_at"])
         else:
             metadata["published_at"] = None
+        return metadata
 
+    def resolve_metadata(self, metadata, pdf_filename):
         if metadata.get("portal"):
             metadata["portal"] = self.get_portal(metadata["portal"])
         else:
@@ -75,10 +228,115 @@ class Command(BaseCommand):
         if metadata.get("collection"):
             metadata["collection"] = self.get_collection(metadata["collection"])
         else:
-            metadata["collection"] = None
+            metadata["collection"] = self.default_collection
+
+        if self.recursive and metadata["collection"] is not None:
+            metadata["directory"] = self.get_directory(
+                metadata["collection"], PurePath(self.get_relative_path(pdf_filename))
+            )
+        return metadata
 
+    def build_directories(self, collection, pdf_files):
+        self.directories[collection.id] = build_directory_tree(
+            collection,
+            get_existing_directories(collection),
+            [
+                PurePath(self.get_relative_path(pdf_file)).parent
+                for pdf_file in pdf_files
+            ],
+            collection.user,
+        )
+
+    def get_directory(self, collection, path):
+        if collection.id not in self.directories:
+            self.directories[collection.id] = get_existing_directories(collection)
+        directories = self.directories[collection.id]
+        if str(path.parent) != "." and path.parent not in directories:
+            directories = build_directory_tree(
+                collection, directories, [path.parent], collection.user
+            )
+            self.directories[collection.id] = directories
+        return directories.get(path.parent)
+
+    def import_pdf(self, pdf_filename, update=False):
+        metadata = self.resolve_metadata(self.read_metadata(pdf_filename), pdf_filename)
         with open(pdf_filename, "rb") as pdf_fileobj:
-            create_document(pdf_fileobj, metadata, update=update)
+            return create_document(pdf_fileobj, metadata, update=update)
+
+    def prepare_pdf(self, pdf_filename):
+        """
+        Reads metadata and hashes the file while copying it to a temporary
+        file that storage moves into place, runs in worker threads.
+        """
+        metadata = self.read_metadata(pdf_filename)
+        with open(pdf_filename, "rb") as pdf_fileobj:
+            temp_file, hasher = copy_to_temporary_file(
+                pdf_fileobj, metadata["filename"]
+            )
+        properties = dict(metadata.get("properties", {}))
+        properties.update(hasher.get_properties())
+        return PreparedFile(temp_file, metadata, hasher.hexdigest(), properties)
+
+    def import_in_batches(self, pdf_files, workers=1, batch_size=100, update=False):
+        total = len(pdf_files)
+        done = 0
+        created = 0
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for offset in range(0, total, batch_size):
+                batch = pdf_files[offset : offset + batch_size]
+                prepared_files = list(executor.map(self.prepare_pdf, batch))
+                try:
+                    created += self.import_batch(batch, prepared_files, update=update)
+                finally:
+                    for prepared in prepared_files:
+                        prepared.file.close()
+                done += len(batch)
+                self.write_progress(done, total, created, time.monotonic() - start)
+
+    def import_batch(self, pdf_files, prepared_files, update=False):
+        bulk_files = []
+        bulk_filenames = []
+        for pdf_file, prepared in zip(pdf_files, prepared_files, strict=True):
+            self.resolve_metadata(prepared.metadata, pdf_file)
+            if get_document_lookup_key(prepared.metadata, prepared.content_hash):
+                bulk_files.append(prepared)
+                bulk_filenames.append(pdf_file)
+                continue
+            # Portal documents without foreign id are looked up one by one
+            doc = create_or_update_document(
+                prepared.file,
+                prepared.metadata,
+                prepared.content_hash,
+                prepared.properties,
+                update=update,
+            )
+            self.record_import(pdf_file, prepared.content_hash, doc.id)
+        created = create_documents_in_bulk(bulk_files, update=update)
+        if self.manifest is not None and bulk_files:
+            keys = [
+                get_document_lookup_key(prepared.metadata, prepared.content_hash)
+                for prepared in bulk_files
+            ]
+            key_docs = get_documents_by_lookup_key(keys)
+            for pdf_file, prepared, key in zip(
+                bulk_filenames, bulk_files, keys, strict=True
+            ):
+                doc = key_docs.get(key)
+                self.record_import(
+                    pdf_file, prepared.content_hash, doc.id if doc else None
+                )
+        return len(created)
+
+    def write_progress(self, done, total, created, duration):
+        rate = done / duration if duration else 0
+        eta = timedelta(seconds=int((total - done) / rate)) if rate else "?"
+        self.stdout.write(
+            "Imported {done}/{total} files ({created} new), "
+            "{rate:.1f} files/s, ETA {eta}".format(
+                done=done, total=total, created=created, rate=rate, eta=eta
+            )
+        )
 
     def get_portal(self, portal_slug):
         if portal_slug not in self.portals:
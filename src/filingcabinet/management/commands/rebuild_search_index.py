@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from ...models import Page
+from ...search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuild the page search index of the configured search backend"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--document",
+            type=int,
+            action="append",
+            help="Only reindex pages of this document, can be given multiple times",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        pages = Page.objects.all()
+        if options["document"]:
+            pages = pages.filter(document_id__in=options["document"])
+        else:
+            backend.clear()
+        page_ids = pages.order_by("id").values_list("id", flat=True)
+        total = page_ids.count()
+        done = 0
+        batch = []
+        for page_id in page_ids.iterator(chunk_size=options["batch_size"]):
+            batch.append(page_id)
+            if len(batch) >= options["batch_size"]:
+                backend.index_pages(batch)
+                done += len(batch)
+                batch = []
+                self.stdout.write("Indexed {}/{} pages".format(done, total))
+        if batch:
+            backend.index_pages(batch)
+            done += len(batch)
+        self.stdout.write("Indexed {} pages".format(done))
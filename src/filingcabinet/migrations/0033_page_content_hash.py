@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 11:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filingcabinet', '0032_alter_document_language'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=40),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.6 on 2026-10-17 11:12
+
+import filingcabinet.models
+import filingcabinet.storage
+import functools
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filingcabinet', '0033_page_content_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='document',
+            name='pdf_file',
+            field=models.FileField(blank=True, max_length=255, storage=filingcabinet.storage.get_storage, upload_to=filingcabinet.models.get_document_path),
+        ),
+        migrations.AlterField(
+            model_name='page',
+            name='image',
+            field=models.ImageField(max_length=255, storage=filingcabinet.storage.get_storage, upload_to=functools.partial(filingcabinet.models.get_page_filename, *(), **{'size': 'original'})),
+        ),
+        migrations.AlterField(
+            model_name='page',
+            name='image_large',
+            field=models.ImageField(max_length=255, storage=filingcabinet.storage.get_storage, upload_to=functools.partial(filingcabinet.models.get_page_filename, *(), **{'size': 'large'})),
+        ),
+        migrations.AlterField(
+            model_name='page',
+            name='image_normal',
+            field=models.ImageField(max_length=255, storage=filingcabinet.storage.get_storage, upload_to=functools.partial(filingcabinet.models.get_page_filename, *(), **{'size': 'normal'})),
+        ),
+        migrations.AlterField(
+            model_name='page',
+            name='image_small',
+            field=models.ImageField(max_length=255, storage=filingcabinet.storage.get_storage, upload_to=functools.partial(filingcabinet.models.get_page_filename, *(), **{'size': 'small'})),
+        ),
+        migrations.AlterField(
+            model_name='pageannotation',
+            name='image',
+            field=models.ImageField(blank=True, max_length=255, storage=filingcabinet.storage.get_storage, upload_to=filingcabinet.models.get_page_annotation_filename),
+        ),
+    ]
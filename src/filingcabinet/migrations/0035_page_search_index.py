@@ -0,0 +1,50 @@
+from django.db import migrations
+
+POSTGRES_CREATE = [
+    """
+    CREATE TABLE IF NOT EXISTS filingcabinet_pagesearch (
+        page_id bigint PRIMARY KEY
+            REFERENCES filingcabinet_page (id) ON DELETE CASCADE,
+        config regconfig NOT NULL,
+        vector tsvector NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS filingcabinet_pagesearch_vector
+    ON filingcabinet_pagesearch USING gin (vector)
+    """,
+]
+POSTGRES_DROP = ["DROP TABLE IF EXISTS filingcabinet_pagesearch"]
+
+SQLITE_CREATE = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS filingcabinet_page_fts
+    USING fts5(content, tokenize='unicode61 remove_diacritics 2')
+    """,
+]
+SQLITE_DROP = ["DROP TABLE IF EXISTS filingcabinet_page_fts"]
+
+
+def run_statements(schema_editor, statements):
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def create_search_index(apps, schema_editor):
+    run_statements(
+        schema_editor, {"postgresql": POSTGRES_CREATE, "sqlite": SQLITE_CREATE}
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    run_statements(schema_editor, {"postgresql": POSTGRES_DROP, "sqlite": SQLITE_DROP})
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("filingcabinet", "0034_storage"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
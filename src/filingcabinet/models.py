@@ -1,13 +1,11 @@
 import functools
 import os
-import shutil
 import urllib.parse
 import uuid
 
 from django.conf import settings
 from django.conf.locale import LANG_INFO
 from django.core.files.base import File
-from django.core.files.storage import FileSystemStorage
 from django.db import models
 from django.urls import Resolver404, resolve, reverse
 from django.utils import timezone
@@ -24,6 +22,12 @@ from .settings import (
     FILINGCABINET_DOCUMENT_MODEL,
     FILINGCABINET_DOCUMENTCOLLECTION_MODEL,
 )
+from .storage import (
+    delete_storage_directory,
+    get_storage,
+    is_local_storage,
+    move_storage_directory,
+)
 from .validators import validate_settings_schema
 
 
@@ -202,7 +206,7 @@ class AbstractDocument(models.Model):
 
     pdf_file = models.FileField(
         max_length=255,
-        storage=FileSystemStorage(allow_overwrite=True),
+        storage=get_storage,
         upload_to=get_document_path,
         blank=True,
     )
@@ -335,10 +339,13 @@ class AbstractDocument(models.Model):
     def get_local_file(self):
         from .utils import get_local_file
 
+        file = self.get_file()
+        if file is not None and hasattr(file, "storage"):
+            return get_local_file(file.name, storage=file.storage)
         return get_local_file(self.get_file_path())
 
     def get_document_filename(self):
-        return self.get_file_path().rsplit("/", 1)[1]
+        return self.get_file().name.rsplit("/", 1)[1]
 
     def get_file_name(self, filename=None):
         if filename is None:
@@ -375,26 +382,22 @@ class AbstractDocument(models.Model):
         return self.get_file_url(filename=filename)
 
     def delete(self, **kwargs):
-        # FIXME: this should be storage system agnostic
         res = super().delete(**kwargs)
         dir_path = os.path.dirname(get_document_file_path(self, "foo", self.public))
-        shutil.rmtree(dir_path, ignore_errors=True)
+        delete_storage_directory(self.pdf_file.storage, dir_path)
         return res
 
     def _move_file(self, target_public):
         """
         Move the file from src to dst.
-        This uses direct filesystem operations for efficiency
-        and not replicating/copying all thumbnails
+        This moves the whole document directory with all thumbnails,
+        a rename on local storages and server side copies on S3
         """
-        # FIXME: this should be storage system agnostic
         if not self.pending:
             return
         from_public = not target_public
         dummy_src_file_name = get_document_file_path(self, "dummy.pdf", from_public)
-        src_file_dir = os.path.dirname(
-            os.path.join(settings.MEDIA_ROOT, dummy_src_file_name)
-        )
+        src_file_dir = os.path.dirname(dummy_src_file_name)
 
         if self.pdf_file:
             dst_file_name = get_document_path(
@@ -402,12 +405,9 @@ class AbstractDocument(models.Model):
             )
         else:
             dst_file_name = get_document_file_path(self, "dummy.pdf", target_public)
-        dst_file_dir = os.path.dirname(os.path.join(settings.MEDIA_ROOT, dst_file_name))
+        dst_file_dir = os.path.dirname(dst_file_name)
         try:
-            src_exists = os.path.exists(src_file_dir)
-            if src_file_dir != dst_file_dir and src_exists:
-                shutil.rmtree(dst_file_dir, ignore_errors=True)
-            shutil.move(src_file_dir, dst_file_dir)
+            move_storage_directory(self.pdf_file.storage, src_file_dir, dst_file_dir)
             if self.pdf_file:
                 self.pdf_file = dst_file_name
         except IOError:
@@ -470,8 +470,10 @@ class AbstractDocument(models.Model):
 
     def get_writeable_file(self):
         if not self.pdf_file:
-            with open(self.get_file_path(), "rb") as f:
+            with self.get_file().open("rb") as f:
                 self.pdf_file.save("document.pdf", File(f))
+        if not is_local_storage(self.pdf_file.storage):
+            return None
         return self.pdf_file.path
 
     def process_document(self, reprocess=True):
@@ -507,11 +509,36 @@ class AbstractDocument(models.Model):
     def has_format_webp(self):
         return self.has_format("webp")
 
+    @classmethod
+    def from_db(cls, db, field_names, values, **kwargs):
+        instance = super().from_db(db, field_names, values, **kwargs)
+        if "language" in instance.__dict__:
+            instance._loaded_language = instance.language
+        return instance
+
+    def has_changed_language(self):
+        if "language" not in self.__dict__:
+            # Deferred and not set
+            return False
+        # New documents have no pages yet
+        loaded_language = getattr(self, "_loaded_language", self.language)
+        return loaded_language != self.language
+
     def save(self, *args, **kwargs):
+        from .search import queue_document_index
+
         if "update_fields" in kwargs:
             kwargs["update_fields"] = {"updated_at"}.union(kwargs["update_fields"])
 
+        update_fields = kwargs.get("update_fields")
+        # Pages are indexed with the text search config of the language
+        reindex = (
+            update_fields is None or "language" in update_fields
+        ) and self.has_changed_language()
         super().save(*args, **kwargs)
+        if reindex:
+            queue_document_index([self.pk])
+            self._loaded_language = self.language
 
 
 class Document(AbstractDocument):
@@ -548,25 +575,26 @@ class Page(models.Model):
 
     content = models.TextField(blank=True)
     corrected = models.BooleanField(default=False)
+    content_hash = models.CharField(max_length=40, blank=True, db_index=True)
 
     image = models.ImageField(
         max_length=255,
-        storage=FileSystemStorage(allow_overwrite=True),
+        storage=get_storage,
         upload_to=functools.partial(get_page_filename, size="original"),
     )
     image_large = models.ImageField(
         max_length=255,
-        storage=FileSystemStorage(allow_overwrite=True),
+        storage=get_storage,
         upload_to=UPLOAD_FUNCS["large"],
     )
     image_normal = models.ImageField(
         max_length=255,
-        storage=FileSystemStorage(allow_overwrite=True),
+        storage=get_storage,
         upload_to=UPLOAD_FUNCS["normal"],
     )
     image_small = models.ImageField(
         max_length=255,
-        storage=FileSystemStorage(allow_overwrite=True),
+        storage=get_storage,
         upload_to=UPLOAD_FUNCS["small"],
     )
 
@@ -627,6 +655,33 @@ class Page(models.Model):
     def get_image_srcset_webp(self):
         return self.get_image_srcset(ext=".webp")
 
+    @classmethod
+    def from_db(cls, db, field_names, values, **kwargs):
+        instance = super().from_db(db, field_names, values, **kwargs)
+        if "content" in instance.__dict__:
+            instance._loaded_content = instance.content
+        return instance
+
+    def has_changed_content(self):
+        if "content" not in self.__dict__:
+            # Deferred and not set
+            return False
+        loaded_content = getattr(self, "_loaded_content", None)
+        return loaded_content is None or loaded_content != self.content
+
+    def save(self, *args, **kwargs):
+        from .search import queue_page_index
+
+        update_fields = kwargs.get("update_fields")
+        reindex = (
+            update_fields is None or "content" in update_fields
+        ) and self.has_changed_content()
+        res = super().save(*args, **kwargs)
+        if reindex:
+            queue_page_index([self.pk])
+            self._loaded_content = self.content
+        return res
+
 
 def get_page_annotation_filename(instance, filename):
     # UUID field is already filled
@@ -657,7 +712,7 @@ class PageAnnotation(models.Model):
     highlight = models.TextField(blank=True)
     image = models.ImageField(
         upload_to=get_page_annotation_filename,
-        storage=FileSystemStorage(allow_overwrite=True),
+        storage=get_storage,
         max_length=255,
         blank=True,
     )
@@ -687,6 +742,16 @@ class PageAnnotation(models.Model):
         )
 
 
+class SearchIndexUpdate(models.Model):
+    """
+    Page queued for a search index update. The page id is no foreign key,
+    so updates of deleted pages remove them from the index.
+    """
+
+    page_id = models.BigIntegerField(unique=True)
+    queued_at = models.DateTimeField(default=timezone.now)
+
+
 class CollectionDirectory(MP_Node):
     name = models.CharField(max_length=255)
     collection = models.ForeignKey(
@@ -2,25 +2,54 @@ import contextlib
 import glob
 import hashlib
 import io
+import json
 import logging
 import os
+import shutil
 import subprocess
 import tempfile
+import threading
+import time
+import warnings
+from collections import OrderedDict
 from pathlib import Path
 from typing import BinaryIO, Callable, Generator, NamedTuple, Optional
 
 import pikepdf
-import wand
 from PIL import Image as PILImage
 from pypdf import PdfReader
 from pypdf.errors import PdfReadError
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.utils import ImageReader
 from reportlab.pdfgen import canvas
 from wand.color import Color
 from wand.image import Image
 
-from .settings import FILINGCABINET_PAGE_PROCESSING_TIMEOUT
+from .settings import (
+    FILINGCABINET_PAGE_PROCESSING_TIMEOUT,
+    FILINGCABINET_RASTERIZE_BATCH_SIZE,
+)
+
+try:
+    import pypdfium2
+except ImportError:
+    pypdfium2 = None
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 logger = logging.getLogger(__name__)
 
@@ -118,12 +147,17 @@ def try_reading_pdf(pdf_file: Path, password=None) -> PdfReader:
 
 
 def get_readable_pdf(pdf_file: Path, copy_func, password=None):
+    """
+    Returns the path of a readable PDF, its reader and the list of repair
+    strategies that were applied in place to make it readable.
+    """
     tries = 0
     timeout = FILINGCABINET_PAGE_PROCESSING_TIMEOUT
+    repairs = []
     while True:
         try:
             pdf_reader = try_reading_pdf(pdf_file, password=password)
-            return pdf_file, pdf_reader
+            return pdf_file, pdf_reader, repairs
         except PDFException as e:
             if tries == 0 and copy_func:
                 pdf_file = copy_func(pdf_file)
@@ -131,14 +165,17 @@ def get_readable_pdf(pdf_file: Path, copy_func, password=None):
             if tries > 2:
                 raise Exception("PDF Redaction Error") from None
             if e.reason == "rewrite":
+                repairs.append("rewrite")
                 next_pdf_file = rewrite_pdf_in_place(
                     pdf_file, password=password, timeout=timeout
                 )
                 if next_pdf_file is None:
+                    repairs[-1] = "rewrite_hard"
                     next_pdf_file = rewrite_hard_pdf_in_place(
                         pdf_file, password=password, timeout=timeout
                     )
             elif e.reason == "decrypt":
+                repairs.append("decrypt")
                 next_pdf_file = decrypt_pdf_in_place(
                     pdf_file, password=password, timeout=timeout
                 )
@@ -220,12 +257,17 @@ class PDFProcessor(object):
     def __init__(
         self, filename: str | Path, copy_func=None, language=None, config=None
     ):
-        filename, pdf_reader = get_readable_pdf(filename, copy_func)
+        filename, pdf_reader, repairs = get_readable_pdf(filename, copy_func)
         self.filename = Path(filename)
         self.pdf_reader = pdf_reader
+        self.repairs = repairs
         self.num_pages = len(self.pdf_reader.pages)
         self.language = language
         self.config = config or {}
+        self._text_extractor = None
+        self._text_extractor_name = None
+        # Hashes of shared PDF objects like fonts by object reference
+        self._object_hashes = {}
 
     def get_meta(self):
         try:
@@ -249,35 +291,70 @@ class PDFProcessor(object):
         with PikePDFProcessor(self.filename) as pike_pdf:
             return pike_pdf.get_markdown_outline()
 
+    def get_rasterizer(self, resolution=300, timeout=5 * 60):
+        rasterizer_class = get_rasterizer_class(self.config.get("RASTERIZER"))
+        return rasterizer_class(
+            self.pdf_reader, self.filename, max_dpi=resolution, timeout=timeout
+        )
+
     def get_images(self, pages=None, resolution=300, timeout=5 * 60):
-        white = wand.color.Color("#fff")
         if pages is None:
             pages = list(range(1, self.num_pages + 1))
-        images = get_images_from_pdf(
-            self.pdf_reader,
-            self.filename,
-            pages,
-            max_dpi=resolution,
-            timeout=timeout,
-        )
-        for page_number, image_filename in images:
-            logger.info("Generated page %s: %s", page_number, image_filename)
-            with Image(filename=image_filename, background=white) as img:
-                yield page_number, img
+        rasterizer = self.get_rasterizer(resolution=resolution, timeout=timeout)
+        yield from rasterizer.get_images(pages)
+
+    def get_page_costs(self, pages: list[int]) -> dict[int, float]:
+        return {
+            page_no: estimate_page_cost(self.pdf_reader.pages[page_no - 1])
+            for page_no in pages
+        }
+
+    def get_page_hashes(self, pages: list[int]) -> dict[int, str]:
+        hashes = {}
+        for page_no in pages:
+            try:
+                hashes[page_no] = get_page_content_hash(
+                    self.pdf_reader.pages[page_no - 1], self._object_hashes
+                )
+            except Exception:
+                logger.warning("Could not hash page %s", page_no, exc_info=True)
+        return hashes
+
+    def has_text_layer(self) -> bool:
+        for page in self.pdf_reader.pages:
+            try:
+                has_fonts, _has_images = get_page_content_kinds(page)
+            except Exception:
+                logger.warning("Could not read page resources", exc_info=True)
+                return True
+            if has_fonts:
+                return True
+        return False
 
     def get_text_for_page(self, page_no, image=None, use_ocr=False):
         text = self._get_text_for_page(page_no)
         if not text.strip():
             if use_ocr and image is None:
                 for _page_number, image in self.get_images([page_no]):
-                    text = self.run_ocr_on_image(image)
+                    text = self.run_ocr_on_image(image.image)
             elif image is not None:
-                text = self.run_ocr_on_image(image)
+                text = self.run_ocr_on_image(get_pil_image(image))
         return text.strip()
 
+    def get_text_extractor(self):
+        name = self.config.get("TEXT_EXTRACTOR")
+        if self._text_extractor is None or self._text_extractor_name != name:
+            extractor_class = get_text_extractor_class(name)
+            self._text_extractor = extractor_class(
+                self.pdf_reader,
+                self.filename,
+                batch_size=self.config.get("TEXT_BATCH_SIZE"),
+            )
+            self._text_extractor_name = name
+        return self._text_extractor
+
     def _get_text_for_page(self, page_no):
-        page = self.pdf_reader.pages[page_no - 1]
-        return page.extract_text()
+        return self.get_text_extractor().get_text_for_page(page_no)
 
     def get_text(self, pages=None, use_ocr=False):
         if pages is None:
@@ -285,30 +362,168 @@ class PDFProcessor(object):
         for page_no in pages:
             yield self.get_text_for_page(page_no, use_ocr=use_ocr)
 
+    def get_ocr_engine(self):
+        ocr_engine_class = get_ocr_engine_class(self.config.get("OCR_ENGINE"))
+        return ocr_engine_class(
+            language=self.language,
+            data_path=self.config.get("TESSERACT_DATA_PATH", ""),
+        )
+
     def run_ocr_on_image(self, image, timeout=30):
-        try:
-            import pytesseract
-        except ImportError:
-            pytesseract = None
+        return self.get_ocr_engine().image_to_string(image, timeout=timeout)
 
-        if pytesseract is None:
-            return ""
-        img_blob = image.make_blob("RGB")
-        pil_image = PILImage.frombytes("RGB", image.size, img_blob)
 
-        lang = TESSERACT_LANGUAGE.get(self.language)
-        config = ""
-        path = self.config.get("TESSERACT_DATA_PATH", "")
-        if path:
-            config = '--tessdata-dir "{}"'.format(path)
+A4_AREA = 595 * 842
 
-        try:
-            return pytesseract.image_to_string(
-                pil_image, lang=lang, config=config, timeout=timeout
+
+def get_page_content_kinds(page) -> tuple[bool, bool]:
+    """
+    Returns whether the page uses fonts and whether it contains images.
+    """
+    resources = page.get("/Resources")
+    resources = resources.get_object() if resources is not None else {}
+    has_fonts = bool(resources.get("/Font"))
+    xobjects = resources.get("/XObject")
+    xobjects = xobjects.get_object() if xobjects is not None else {}
+    has_images = any(
+        xobject.get_object().get("/Subtype") == "/Image"
+        for xobject in xobjects.values()
+    )
+    return has_fonts, has_images
+
+
+def estimate_page_cost(page) -> float:
+    """
+    Estimates the relative processing cost of a page,
+    a text-only A4 page costs 1.
+    """
+    box = page.cropbox
+    # Render resolution is capped, so large pages only cost a bit more
+    cost = min(max(box.width * box.height / A4_AREA, 0.5), 2)
+    try:
+        has_fonts, has_images = get_page_content_kinds(page)
+    except Exception:
+        logger.warning("Could not read page resources", exc_info=True)
+        return cost
+    if has_images:
+        cost *= 2
+        if not has_fonts:
+            # Scanned page without text layer, OCR will run
+            cost *= 3
+    return cost
+
+
+def get_page_content_hash(page, object_hashes: Optional[dict] = None) -> str:
+    """
+    Hashes everything that determines how a page renders: its boxes, rotation,
+    content stream, the resources (fonts, images, forms) it references and its
+    annotations with their appearance streams, e.g. filled form fields.
+    Identical pages of different files get the same hash.
+    """
+    if object_hashes is None:
+        object_hashes = {}
+    hasher = hashlib.sha1()
+    hasher.update(
+        repr(
+            (
+                page.rotation,
+                [float(x) for x in page.mediabox],
+                [float(x) for x in page.cropbox],
             )
-        except RuntimeError as e:
-            logger.warning(e)
-            return ""
+        ).encode("utf-8")
+    )
+    contents = page.get_contents()
+    if contents is not None:
+        hasher.update(contents.get_data())
+    resources = page.get("/Resources")
+    hasher.update(get_pdf_object_hash(resources, object_hashes, set()).encode("utf-8"))
+    annotations = page.get("/Annots")
+    hasher.update(
+        get_pdf_object_hash(annotations, object_hashes, set()).encode("utf-8")
+    )
+    return hasher.hexdigest()
+
+
+def get_pdf_object_hash(obj, object_hashes: dict, seen: set) -> str:
+    if isinstance(obj, IndirectObject):
+        key = (obj.idnum, obj.generation)
+        if key in object_hashes:
+            return object_hashes[key]
+        if key in seen:
+            # Reference cycle, e.g. a parent link
+            return "cycle"
+        seen.add(key)
+        object_hash = get_pdf_object_hash(obj.get_object(), object_hashes, seen)
+        seen.discard(key)
+        object_hashes[key] = object_hash
+        return object_hash
+
+    hasher = hashlib.sha1()
+    if isinstance(obj, DictionaryObject):
+        for key in sorted(obj):
+            # /P links annotations back to their page
+            if key in ("/Parent", "/Length", "/P"):
+                continue
+            hasher.update(key.encode("utf-8"))
+            hasher.update(get_pdf_object_hash(obj[key], object_hashes, seen).encode())
+        if isinstance(obj, StreamObject):
+            try:
+                hasher.update(obj.get_data())
+            except Exception:
+                hasher.update(repr(obj).encode("utf-8"))
+    elif isinstance(obj, ArrayObject):
+        for item in obj:
+            hasher.update(get_pdf_object_hash(item, object_hashes, seen).encode())
+    else:
+        hasher.update(repr(obj).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class PDFProcessorCache:
+    """
+    LRU cache of opened PDFProcessor instances.
+
+    pypdf keeps the whole file in memory, so the cache is bounded
+    by the number of entries and by the summed size of their files.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key) -> Optional["PDFProcessor"]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, pdf: "PDFProcessor", size: int):
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (pdf, size)
+            self._size += size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
 
 
 def draw_highlights(highlights):
@@ -406,13 +621,22 @@ def convert_images_to_ocred_pdf(
 
 
 def run_ocr(
-    filename: Path, language: Optional[str] = None, binary_name="ocrmypdf", timeout=50
+    filename: Path,
+    language: Optional[str] = None,
+    binary_name="ocrmypdf",
+    timeout=50,
+    jobs: Optional[int] = None,
+    output_path: Optional[Path] = None,
 ):
+    """
+    Returns the OCRed PDF as bytes, or writes it to output_path
+    and returns that path.
+    """
     if binary_name is None:
         return
     with tempfile.TemporaryDirectory() as outpath:
         outpath = Path(outpath)
-        output_file = outpath / "out.pdf"
+        output_file = Path(output_path) if output_path else outpath / "out.pdf"
         lang = TESSERACT_LANGUAGE.get(language)
         arguments = [binary_name]
         if lang is not None:
@@ -422,6 +646,8 @@ def run_ocr(
                     lang,
                 ]
             )
+        if jobs is not None:
+            arguments.extend(["--jobs", str(jobs)])
         arguments += [
             "--deskew",
             "--skip-text",
@@ -439,7 +665,10 @@ def run_ocr(
                     0,
                     10,  # https://ocrmypdf.readthedocs.io/en/v10.2.0/api.html#ocrmypdf.exceptions.ExitCode.pdfa_conversion_failed
                 ],
+                read_output=output_path is None,
             )
+            if output_path:
+                return output_file
             return output_bytes
         except Exception as err:
             logger.error("Error during PDF OCR: %s", err)
@@ -453,7 +682,8 @@ def shell_call(
     timeout=50,
     raise_timeout=False,
     successful_returncodes=None,
-) -> bytes:
+    read_output=True,
+) -> Optional[bytes]:
     if successful_returncodes is None:
         successful_returncodes = [0]
     env = dict(os.environ)
@@ -483,6 +713,9 @@ def shell_call(
             out, err = p.communicate()
     if p is not None and p.returncode in successful_returncodes:
         if output_file is not None and output_file.exists():
+            if not read_output:
+                # Caller uses the output file itself
+                return None
             with open(output_file, "rb") as f:
                 return f.read()
     if output_file is not None:
@@ -639,6 +872,63 @@ def get_images_from_pdf(
     max_dpi=300,
     max_resolution=MAX_HEIGHT_A4,
     timeout=5 * 60,
+    batch_size=FILINGCABINET_RASTERIZE_BATCH_SIZE,
+):
+    """
+    Yields (page, image filename) for pages. timeout applies per page,
+    a batch of pages gets the timeout of all its pages.
+    """
+    if batch_size is None or batch_size <= 1:
+        yield from get_single_images_from_pdf(
+            pdf_reader,
+            filename,
+            pages,
+            max_dpi=max_dpi,
+            max_resolution=max_resolution,
+            timeout=timeout,
+        )
+        return
+
+    page_batches = get_page_batches(
+        pdf_reader,
+        pages,
+        max_dpi=max_dpi,
+        max_resolution=max_resolution,
+        batch_size=batch_size,
+    )
+    for dpi, batch in page_batches:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            rendered = pages_to_png(
+                filename=filename,
+                temp_dir=Path(temp_dir),
+                first=batch[0],
+                last=batch[-1],
+                dpi=dpi,
+                timeout=timeout * len(batch),
+            )
+            for page in batch:
+                if page in rendered:
+                    yield (page, rendered[page])
+                    continue
+                # Render pages that did not come out of the batch on their own
+                logger.warning("Page %s missing from batch, rendering single", page)
+                yield from get_single_images_from_pdf(
+                    pdf_reader,
+                    filename,
+                    [page],
+                    max_dpi=max_dpi,
+                    max_resolution=max_resolution,
+                    timeout=timeout,
+                )
+
+
+def get_single_images_from_pdf(
+    pdf_reader: PdfReader,
+    filename: Path,
+    pages: list[int],
+    max_dpi=300,
+    max_resolution=MAX_HEIGHT_A4,
+    timeout=5 * 60,
 ):
     for page in pages:
         with get_image_from_pdf_page(
@@ -680,6 +970,13 @@ def get_image_from_pdf_page(
             yield None
 
 
+def get_page_dpi(pdf_reader: PdfReader, page: int, max_dpi: int, max_resolution: int):
+    page_size = pdf_reader.pages[page - 1].cropbox
+    max_x_dpi = max_resolution / (page_size.width / 72)
+    max_y_dpi = max_resolution / (page_size.height / 72)
+    return min(max_dpi, max_x_dpi, max_y_dpi)
+
+
 def page_to_png(
     pdf_reader: PdfReader,
     filename: Path,
@@ -691,10 +988,7 @@ def page_to_png(
 ):
     temp_out = temp_dir / "image"
 
-    page_size = pdf_reader.pages[page - 1].cropbox
-    max_x_dpi = max_resolution / (page_size.width / 72)
-    max_y_dpi = max_resolution / (page_size.height / 72)
-    dpi = min(max_dpi, max_x_dpi, max_y_dpi)
+    dpi = get_page_dpi(pdf_reader, page, max_dpi, max_resolution)
 
     command = [
         "pdftoppm",
@@ -714,6 +1008,549 @@ def page_to_png(
     return (page, out_filename)
 
 
+def get_page_batches(
+    pdf_reader: PdfReader,
+    pages: list[int],
+    max_dpi: int,
+    max_resolution: int,
+    batch_size: int,
+) -> Generator[tuple[float, list[int]], None, None]:
+    """
+    Split pages into runs of continuous pages that render at the same DPI
+    so that each run can be rendered with a single pdftoppm call.
+    """
+    if not pages:
+        return
+    for first, last in get_continuous_pages(pages):
+        batch: list[int] = []
+        batch_dpi = None
+        for page in range(first, last + 1):
+            dpi = get_page_dpi(pdf_reader, page, max_dpi, max_resolution)
+            if batch and (dpi != batch_dpi or len(batch) >= batch_size):
+                yield batch_dpi, batch
+                batch = []
+            batch_dpi = dpi
+            batch.append(page)
+        if batch:
+            yield batch_dpi, batch
+
+
+def pages_to_png(
+    filename: Path,
+    temp_dir: Path,
+    first: int,
+    last: int,
+    dpi: float,
+    timeout: int,
+) -> dict[int, str]:
+    temp_out = temp_dir / "image"
+    command = [
+        "pdftoppm",
+        "-png",
+        "-cropbox",
+        "-r",
+        str(dpi),
+        "-f",
+        str(first),
+        "-l",
+        str(last),
+        str(filename),
+        str(temp_out),
+    ]
+    timed_out = False
+    try:
+        shell_call(
+            command, temp_dir, output_file=None, timeout=timeout, raise_timeout=True
+        )
+    except subprocess.TimeoutExpired:
+        logger.warning("Timeout rendering pages %s-%s of %s", first, last, filename)
+        timed_out = True
+    except Exception as err:
+        logger.error("Error during pages to png %s", err)
+        logger.exception(err)
+        return {}
+
+    # pdftoppm names files <prefix>-<zero padded page number>.png
+    rendered = {}
+    for out_filename in glob.glob(str(temp_out) + "-*.png"):
+        try:
+            page = int(Path(out_filename).stem.rsplit("-", 1)[1])
+        except ValueError:
+            continue
+        rendered[page] = out_filename
+    if timed_out and rendered:
+        # The last file may have been written partially when the process was killed
+        del rendered[max(rendered)]
+    return rendered
+
+
+def get_pil_image(image) -> PILImage.Image:
+    """
+    Accepts page images and, from callers written for earlier versions,
+    Pillow and wand images.
+    """
+    if isinstance(image, PageImage):
+        return image.image
+    if isinstance(image, PILImage.Image):
+        return image
+    return PILImage.open(io.BytesIO(image.make_blob("png")))
+
+
+class PageImage:
+    """
+    A rendered page image that is decoded at most once.
+
+    Rasterizers that write image files set `filename`, which is only valid
+    until the rasterizer generator continues. In-process rasterizers pass
+    the decoded image directly.
+
+    get_images used to yield wand images, other attributes are looked up
+    on a wand copy of the image for code written against that.
+    """
+
+    def __init__(
+        self,
+        number: int,
+        filename: Optional[str | Path] = None,
+        image: Optional[PILImage.Image] = None,
+    ):
+        self.number = number
+        self.filename = filename
+        self._image = image
+        self._wand_image = None
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        warnings.warn(
+            "Page images are no longer wand images, use PageImage.image "
+            "or PageImage.as_wand() instead of PageImage.{}".format(name),
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        if self._wand_image is None:
+            self._wand_image = self.as_wand()
+        return getattr(self._wand_image, name)
+
+    def as_wand(self) -> Image:
+        """
+        Returns a wand image of the page like get_images yielded before,
+        the caller closes it.
+        """
+        if self.filename is not None and self._image is None:
+            return Image(filename=str(self.filename), background=Color("#fff"))
+        buffer = io.BytesIO()
+        self.image.save(buffer, format="PNG")
+        return Image(blob=buffer.getvalue())
+
+    @property
+    def image(self) -> PILImage.Image:
+        if self._image is None:
+            with PILImage.open(self.filename) as img:
+                if img.mode not in ("RGB", "L"):
+                    img = img.convert("RGB")
+                img.load()
+                self._image = img
+        return self._image
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.image.size
+
+    def get_resized(self, widths: list[int]) -> list[PILImage.Image]:
+        """
+        Returns resized copies for the given widths (largest first),
+        each one is downscaled from the previous one.
+        """
+        resized = []
+        source = self.image
+        for width in widths:
+            height = max(1, round(width * source.height / source.width))
+            source = source.resize(
+                (width, height), PILImage.Resampling.LANCZOS, reducing_gap=2.0
+            )
+            resized.append(source)
+        return resized
+
+
+class PdftoppmRasterizer:
+    """
+    Renders pages to PNG files with poppler's pdftoppm.
+    """
+
+    def __init__(
+        self,
+        pdf_reader: PdfReader,
+        filename: Path,
+        max_dpi=300,
+        max_resolution=MAX_HEIGHT_A4,
+        timeout=5 * 60,
+    ):
+        self.pdf_reader = pdf_reader
+        self.filename = filename
+        self.max_dpi = max_dpi
+        self.max_resolution = max_resolution
+        self.timeout = timeout
+
+    def get_images(
+        self, pages: list[int]
+    ) -> Generator[tuple[int, PageImage], None, None]:
+        images = get_images_from_pdf(
+            self.pdf_reader,
+            self.filename,
+            pages,
+            max_dpi=self.max_dpi,
+            max_resolution=self.max_resolution,
+            timeout=self.timeout,
+        )
+        for page_number, image_filename in images:
+            logger.info("Generated page %s: %s", page_number, image_filename)
+            yield page_number, PageImage(page_number, filename=image_filename)
+
+
+class PdfiumRasterizer(PdftoppmRasterizer):
+    """
+    Renders pages in process with pypdfium2 without going through
+    an encoded image file.
+    """
+
+    def get_images(
+        self, pages: list[int]
+    ) -> Generator[tuple[int, PageImage], None, None]:
+        if pypdfium2 is None:
+            raise RuntimeError("The 'pypdfium2' python package is not installed")
+        pdf = pypdfium2.PdfDocument(self.filename)
+        try:
+            for page_number in pages:
+                try:
+                    pil_image = self.render_page(pdf, page_number)
+                except Exception as err:
+                    logger.error("Error during pdfium page render %s", err)
+                    logger.exception(err)
+                    continue
+                logger.info("Generated page %s with pdfium", page_number)
+                yield page_number, PageImage(page_number, image=pil_image)
+        finally:
+            pdf.close()
+
+    def render_page(self, pdf, page_number: int) -> PILImage.Image:
+        dpi = get_page_dpi(
+            self.pdf_reader, page_number, self.max_dpi, self.max_resolution
+        )
+        page = pdf[page_number - 1]
+        try:
+            bitmap = page.render(scale=dpi / 72)
+            return bitmap.to_pil().convert("RGB")
+        finally:
+            page.close()
+
+
+class RenderedPage(NamedTuple):
+    number: int
+    width: int
+    height: int
+    text: Optional[str]
+    image_files: dict[str, str]
+
+
+def write_page_images(image: PageImage, sizes, output_dir: Path) -> dict[str, str]:
+    """
+    Writes the original page image and its resized derivatives
+    as PNG files to output_dir and returns their paths by size name.
+    """
+    resized = image.get_resized([width for _size_name, width in sizes])
+    original_path = output_dir / "page-{}-original.png".format(image.number)
+    if image.filename is not None:
+        shutil.move(image.filename, original_path)
+    else:
+        image.image.save(original_path, format="PNG")
+    image_files = {"original": str(original_path)}
+    for (size_name, _width), resized_image in zip(sizes, resized, strict=True):
+        path = output_dir / "page-{}-{}.png".format(image.number, size_name)
+        resized_image.save(path, format="PNG")
+        image_files[size_name] = str(path)
+    return image_files
+
+
+def init_page_worker(parent_pid: int, interval: float = 1.0):
+    """
+    Starts a thread in a page worker process that exits the worker once
+    its parent process is gone. Parents killed without a chance to shut
+    down their pool would otherwise leave their workers behind.
+    """
+
+    def watch_parent():
+        while True:
+            if os.getppid() != parent_pid:
+                os._exit(1)
+            time.sleep(interval)
+
+    threading.Thread(target=watch_parent, daemon=True).start()
+
+
+# PDF opened in a long-lived page worker process, replaced when
+# pages of another document or of a changed file come in
+_worker_pdf = None
+_worker_pdf_key = None
+
+
+def get_worker_pdf(filename: Path, language, config) -> PDFProcessor:
+    global _worker_pdf, _worker_pdf_key
+    stat = os.stat(filename)
+    key = (
+        str(filename),
+        stat.st_mtime_ns,
+        stat.st_size,
+        language,
+        json.dumps(config, sort_keys=True, default=str),
+    )
+    if key != _worker_pdf_key:
+        # Workers get single pages, extract text of only that page
+        config = {**config, "TEXT_BATCH_SIZE": 1}
+        _worker_pdf = PDFProcessor(filename, language=language, config=config)
+        _worker_pdf_key = key
+    return _worker_pdf
+
+
+def render_page_in_worker(
+    filename: Path,
+    language,
+    config,
+    page_number: int,
+    sizes,
+    output_dir: str,
+    extract_text: bool,
+    timeout: int,
+) -> Optional[RenderedPage]:
+    """
+    Rasterizes, thumbnails and extracts text of a single page
+    in a page worker process.
+    """
+    pdf = get_worker_pdf(filename, language, config)
+    for _page_number, image in pdf.get_images([page_number], timeout=timeout):
+        text = None
+        if extract_text:
+            text = pdf.get_text_for_page(page_number, image)
+        width, height = image.size
+        image_files = write_page_images(image, sizes, Path(output_dir))
+        return RenderedPage(page_number, width, height, text, image_files)
+    return None
+
+
+RASTERIZERS = {
+    "pdftoppm": PdftoppmRasterizer,
+    "pdfium": PdfiumRasterizer,
+}
+
+
+def get_rasterizer_class(name: Optional[str] = None):
+    if name is None:
+        return PdftoppmRasterizer
+    try:
+        return RASTERIZERS[name]
+    except KeyError:
+        raise ValueError("Unknown rasterizer: {}".format(name)) from None
+
+
+class PypdfTextExtractor:
+    """
+    Extracts the text layer page by page with pypdf. batch_size is the
+    number of continuous pages extracted at once by extractors that run
+    an external tool, None uses their default.
+    """
+
+    def __init__(
+        self, pdf_reader: PdfReader, filename: Path, timeout=5 * 60, batch_size=None
+    ):
+        self.pdf_reader = pdf_reader
+        self.filename = filename
+        self.timeout = timeout
+
+    def get_text_for_page(self, page_no: int) -> str:
+        page = self.pdf_reader.pages[page_no - 1]
+        return page.extract_text()
+
+
+class PdftotextTextExtractor(PypdfTextExtractor):
+    """
+    Extracts the text layer with poppler's pdftotext for a range of pages
+    in one call and keeps the text of the range around for subsequent pages.
+    """
+
+    def __init__(self, *args, batch_size=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_size = batch_size or FILINGCABINET_RASTERIZE_BATCH_SIZE
+        self.texts: dict[int, Optional[str]] = {}
+
+    def get_text_for_page(self, page_no: int) -> str:
+        if page_no not in self.texts:
+            last = min(page_no + self.batch_size - 1, len(self.pdf_reader.pages))
+            self.texts = dict.fromkeys(range(page_no, last + 1))
+            self.texts.update(pages_to_text(self.filename, page_no, last, self.timeout))
+        if self.texts[page_no] is None:
+            logger.warning(
+                "pdftotext failed on page %s of %s, using pypdf",
+                page_no,
+                self.filename,
+            )
+            return super().get_text_for_page(page_no)
+        return self.texts[page_no]
+
+
+class PdfiumTextExtractor(PypdfTextExtractor):
+    """
+    Extracts the text layer in process with pypdfium2.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if pypdfium2 is None:
+            raise RuntimeError("The 'pypdfium2' python package is not installed")
+        self.pdf = None
+
+    def get_text_for_page(self, page_no: int) -> str:
+        if self.pdf is None:
+            self.pdf = pypdfium2.PdfDocument(self.filename)
+        page = self.pdf[page_no - 1]
+        try:
+            textpage = page.get_textpage()
+            try:
+                return textpage.get_text_range()
+            finally:
+                textpage.close()
+        finally:
+            page.close()
+
+
+def pages_to_text(filename: Path, first: int, last: int, timeout: int):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_out = Path(temp_dir) / "text.txt"
+        command = [
+            "pdftotext",
+            "-layout",
+            "-enc",
+            "UTF-8",
+            "-f",
+            str(first),
+            "-l",
+            str(last),
+            str(filename),
+            str(temp_out),
+        ]
+        try:
+            output = shell_call(
+                command, Path(temp_dir), output_file=temp_out, timeout=timeout
+            )
+        except Exception as err:
+            logger.error("Error during pages to text %s", err)
+            logger.exception(err)
+            return {}
+    # pdftotext ends every page with a form feed
+    texts = output.decode("utf-8", errors="replace").split("\f")
+    return dict(zip(range(first, last + 1), texts[: last - first + 1], strict=False))
+
+
+TEXT_EXTRACTORS = {
+    "pypdf": PypdfTextExtractor,
+    "pdftotext": PdftotextTextExtractor,
+    "pdfium": PdfiumTextExtractor,
+}
+
+
+def get_text_extractor_class(name: Optional[str] = None):
+    if name is None:
+        return PypdfTextExtractor
+    try:
+        return TEXT_EXTRACTORS[name]
+    except KeyError:
+        raise ValueError("Unknown text extractor: {}".format(name)) from None
+
+
+class PytesseractOCREngine:
+    """
+    Runs OCR by calling the tesseract binary through pytesseract,
+    which loads the language model again for every image.
+    """
+
+    def __init__(self, language=None, data_path=""):
+        self.lang = TESSERACT_LANGUAGE.get(language)
+        self.data_path = data_path or ""
+
+    def image_to_string(self, image: PILImage.Image, timeout=30) -> str:
+        try:
+            import pytesseract
+        except ImportError:
+            pytesseract = None
+
+        if pytesseract is None:
+            return ""
+        config = ""
+        if self.data_path:
+            config = '--tessdata-dir "{}"'.format(self.data_path)
+
+        try:
+            return pytesseract.image_to_string(
+                image, lang=self.lang, config=config, timeout=timeout
+            )
+        except RuntimeError as e:
+            logger.warning(e)
+            return ""
+
+
+# Tesseract API handles by data path and language, initialized once
+# per thread of a process and reused for all following pages. With page
+# workers they live as long as the worker processes of the page pool.
+_tesseract_apis = threading.local()
+
+
+class TesserocrOCREngine(PytesseractOCREngine):
+    """
+    Runs OCR in process with tesserocr and keeps the loaded language model
+    warm between pages. There is no timeout support for a single image.
+    """
+
+    def get_api(self):
+        apis = getattr(_tesseract_apis, "apis", None)
+        if apis is None:
+            apis = _tesseract_apis.apis = {}
+        key = (self.data_path, self.lang)
+        if key not in apis:
+            kwargs = {"lang": self.lang or "eng"}
+            if self.data_path:
+                kwargs["path"] = self.data_path
+            apis[key] = tesserocr.PyTessBaseAPI(**kwargs)
+        return apis[key]
+
+    def image_to_string(self, image: PILImage.Image, timeout=30) -> str:
+        if tesserocr is None:
+            return ""
+        try:
+            api = self.get_api()
+        except RuntimeError as e:
+            logger.warning(e)
+            return ""
+        api.SetImage(image)
+        try:
+            return api.GetUTF8Text()
+        finally:
+            api.Clear()
+
+
+OCR_ENGINES = {
+    "pytesseract": PytesseractOCREngine,
+    "tesserocr": TesserocrOCREngine,
+}
+
+
+def get_ocr_engine_class(name: Optional[str] = None):
+    if name is None:
+        return PytesseractOCREngine
+    try:
+        return OCR_ENGINES[name]
+    except KeyError:
+        raise ValueError("Unknown OCR engine: {}".format(name)) from None
+
+
 def get_continuous_pages(pages: list[int]) -> Generator[tuple[int, int], None, None]:
     first, last = None, None
 
@@ -744,16 +1581,88 @@ def detect_tables(filename: Path):
         return []
 
 
+HASH_BUFFER_SIZE = 1024 * 1024  # 1 MB
+
+
+def get_secondary_hasher(name: Optional[str]):
+    if name is None:
+        return None
+    if name == "blake3":
+        if blake3 is None:
+            raise RuntimeError("The 'blake3' python package is not installed")
+        return blake3.blake3()
+    if name == "xxhash":
+        if xxhash is None:
+            raise RuntimeError("The 'xxhash' python package is not installed")
+        return xxhash.xxh3_128()
+    return hashlib.new(name)
+
+
+class ContentHasher:
+    """
+    Computes the SHA1 content hash stored on documents and
+    an optional faster secondary hash in the same pass over the data.
+    """
+
+    PROPERTIES_KEY = "_content_hash_{}"
+
+    def __init__(self, secondary: Optional[str] = None):
+        self.sha1 = hashlib.sha1()
+        self.secondary_name = secondary
+        self.secondary = get_secondary_hasher(secondary)
+        self.size = 0
+
+    def update(self, data):
+        self.sha1.update(data)
+        if self.secondary is not None:
+            self.secondary.update(data)
+        self.size += len(data)
+
+    def hexdigest(self) -> str:
+        return self.sha1.hexdigest()
+
+    def get_properties(self) -> dict[str, str]:
+        if self.secondary is None:
+            return {}
+        key = self.PROPERTIES_KEY.format(self.secondary_name)
+        return {key: self.secondary.hexdigest()}
+
+
+def hash_file(
+    file_object: BinaryIO,
+    secondary: Optional[str] = None,
+    output: Optional[BinaryIO] = None,
+    buffer_size=HASH_BUFFER_SIZE,
+) -> ContentHasher:
+    """
+    Hashes file_object from its current position in large buffers,
+    optionally copying the data to output on the way.
+    """
+    hasher = ContentHasher(secondary)
+    readinto = getattr(file_object, "readinto", None)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    while True:
+        if readinto is not None:
+            size = readinto(buffer)
+            if not size:
+                break
+            chunk = view[:size]
+        else:
+            chunk = file_object.read(buffer_size)
+            if not chunk:
+                break
+        hasher.update(chunk)
+        if output is not None:
+            output.write(chunk)
+    return hasher
+
+
 def calculcate_content_hash_from_file(file_object: BinaryIO):
-    h = hashlib.sha1()
     file_object.seek(0)
-    while True:
-        chunk = file_object.read(h.block_size)
-        if not chunk:
-            break
-        h.update(chunk)
+    content_hash = hash_file(file_object).hexdigest()
     file_object.seek(0)
-    return h.hexdigest()
+    return content_hash
 
 
 def rotate_pages_on_pdf(input_fh, output_fh, page_numbers, angle):
@@ -0,0 +1,413 @@
+import bisect
+import html
+import re
+from typing import Optional
+
+from django.db import connection, transaction
+from django.db.models import FloatField, TextField
+from django.db.models.expressions import RawSQL
+
+from . import get_document_model
+from .models import Page, SearchIndexUpdate
+from .settings import (
+    FILINGCABINET_SEARCH_BACKEND,
+    FILINGCABINET_SEARCH_INDEX_BATCH_SIZE,
+    FILINGCABINET_SEARCH_LANGUAGE_CONFIGS,
+    FILINGCABINET_SEARCH_SNIPPET_FRAGMENTS,
+    FILINGCABINET_SEARCH_SNIPPET_WORDS,
+)
+
+# Tables are created by migration 0035 on the respective database
+POSTGRES_SEARCH_TABLE = "filingcabinet_pagesearch"
+SQLITE_SEARCH_TABLE = "filingcabinet_page_fts"
+
+HIGHLIGHT_START = "<em>"
+HIGHLIGHT_END = "</em>"
+# Private use characters delimit matches until snippets are HTML escaped
+HIGHLIGHT_START_MARKER = "\ue000"
+HIGHLIGHT_END_MARKER = "\ue001"
+SNIPPET_DELIMITER = " … "
+
+WORD_RE = re.compile(r"\w+")
+
+
+def get_index_batches(page_ids, batch_size=500):
+    page_ids = list(page_ids)
+    for i in range(0, len(page_ids), batch_size):
+        yield page_ids[i : i + batch_size]
+
+
+def format_highlight(text):
+    return (
+        html.escape(text)
+        .replace(HIGHLIGHT_START_MARKER, HIGHLIGHT_START)
+        .replace(HIGHLIGHT_END_MARKER, HIGHLIGHT_END)
+    )
+
+
+def get_snippet_ranges(content, pattern, word_spans):
+    word_starts = [start for start, _end in word_spans]
+    words = FILINGCABINET_SEARCH_SNIPPET_WORDS
+    ranges = []
+    for match in pattern.finditer(content):
+        if ranges and match.start() < ranges[-1][1]:
+            # Already part of the previous fragment
+            continue
+        start, end = match.span()
+        if word_spans:
+            index = max(0, bisect.bisect_right(word_starts, start) - 1)
+            first = max(0, index - words // 2)
+            last = min(len(word_spans) - 1, first + words - 1)
+            start = min(start, word_spans[first][0])
+            end = max(end, word_spans[last][1])
+        ranges.append((start, end))
+        if len(ranges) == FILINGCABINET_SEARCH_SNIPPET_FRAGMENTS:
+            break
+    return ranges
+
+
+def make_snippet(content, pattern):
+    """
+    Returns HTML escaped fragments of content around matches of pattern
+    with matches highlighted, None if nothing matches.
+    """
+    word_spans = [match.span() for match in WORD_RE.finditer(content)]
+    fragments = [
+        pattern.sub(
+            lambda match: (
+                HIGHLIGHT_START_MARKER + match.group(0) + HIGHLIGHT_END_MARKER
+            ),
+            content[start:end],
+        )
+        for start, end in get_snippet_ranges(content, pattern, word_spans)
+    ]
+    if not fragments:
+        return None
+    return format_highlight(SNIPPET_DELIMITER.join(fragments))
+
+
+class SearchBackend:
+    indexed = False
+
+    def search(self, queryset, query, rank=True):
+        raise NotImplementedError
+
+    def highlight_pages(self, pages, query):
+        """
+        Sets query_highlight snippets on a page of search results.
+        Indexed backends annotate marked snippets in the database.
+        """
+        for page in pages:
+            query_highlight = getattr(page, "query_highlight", None)
+            if query_highlight is not None:
+                page.query_highlight = format_highlight(query_highlight)
+
+    def index_pages(self, page_ids):
+        pass
+
+    def remove_pages(self, page_ids):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LikeSearchBackend(SearchBackend):
+    """
+    Unindexed substring search on page content.
+    """
+
+    def search(self, queryset, query, rank=True):
+        return queryset.filter(content__contains=query)
+
+    def highlight_pages(self, pages, query):
+        # One pattern for all pages of results
+        pattern = re.compile(re.escape(query), re.IGNORECASE)
+        for page in pages:
+            page.query_highlight = make_snippet(page.content, pattern)
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    Full-text search on a tsvector table with GIN index. Pages are indexed
+    with the text search configuration of their document language and
+    queries are parsed with all configured configurations.
+    """
+
+    indexed = True
+
+    def get_configs(self):
+        return sorted(set(FILINGCABINET_SEARCH_LANGUAGE_CONFIGS.values()) | {"simple"})
+
+    def get_tsquery(self, query):
+        configs = self.get_configs()
+        sql = " || ".join(["websearch_to_tsquery(%s::regconfig, %s)"] * len(configs))
+        params = []
+        for config in configs:
+            params.extend([config, query])
+        return "({})".format(sql), params
+
+    def get_config_sql(self, language_column):
+        cases = []
+        params = []
+        for language, config in FILINGCABINET_SEARCH_LANGUAGE_CONFIGS.items():
+            cases.append("WHEN %s THEN %s::regconfig")
+            params.extend([language, config])
+        if not cases:
+            return "'simple'::regconfig", params
+        return (
+            "CASE {} {} ELSE 'simple'::regconfig END".format(
+                language_column, " ".join(cases)
+            ),
+            params,
+        )
+
+    def search(self, queryset, query, rank=True):
+        tsquery, tsquery_params = self.get_tsquery(query)
+        page_id = '"{}"."id"'.format(Page._meta.db_table)
+        queryset = queryset.filter(
+            id__in=RawSQL(
+                "SELECT page_id FROM {} WHERE vector @@ {}".format(
+                    POSTGRES_SEARCH_TABLE, tsquery
+                ),
+                tsquery_params,
+            )
+        )
+        queryset = queryset.annotate(
+            query_highlight=RawSQL(
+                "SELECT ts_headline(config, {}, {}, %s) FROM {} "
+                "WHERE page_id = {}".format(
+                    '"{}"."content"'.format(Page._meta.db_table),
+                    tsquery,
+                    POSTGRES_SEARCH_TABLE,
+                    page_id,
+                ),
+                tsquery_params + [self.get_headline_options()],
+                output_field=TextField(),
+            ),
+        )
+        if not rank:
+            return queryset
+        return queryset.annotate(
+            search_rank=RawSQL(
+                "SELECT ts_rank(vector, {}) FROM {} WHERE page_id = {}".format(
+                    tsquery, POSTGRES_SEARCH_TABLE, page_id
+                ),
+                tsquery_params,
+                output_field=FloatField(),
+            ),
+        ).order_by("-search_rank", "document", "number")
+
+    def get_headline_options(self):
+        words = FILINGCABINET_SEARCH_SNIPPET_WORDS
+        return (
+            "StartSel={start}, StopSel={stop}, MaxWords={max_words}, "
+            "MinWords={min_words}, MaxFragments={fragments}, "
+            'FragmentDelimiter="{delimiter}"'
+        ).format(
+            start=HIGHLIGHT_START_MARKER,
+            stop=HIGHLIGHT_END_MARKER,
+            max_words=words,
+            min_words=max(1, words // 2),
+            fragments=FILINGCABINET_SEARCH_SNIPPET_FRAGMENTS,
+            delimiter=SNIPPET_DELIMITER,
+        )
+
+    def index_pages(self, page_ids):
+        document_table = get_document_model()._meta.db_table
+        for batch in get_index_batches(page_ids):
+            config_sql, config_params = self.get_config_sql("d.language")
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO {search_table} (page_id, config, vector)
+                    SELECT p.id, config, to_tsvector(config, p.content)
+                    FROM {page_table} p
+                    JOIN {document_table} d ON d.id = p.document_id,
+                    LATERAL (SELECT {config_sql} AS config) c
+                    WHERE p.id = ANY(%s)
+                    ON CONFLICT (page_id) DO UPDATE
+                    SET config = EXCLUDED.config, vector = EXCLUDED.vector
+                    """.format(
+                        search_table=POSTGRES_SEARCH_TABLE,
+                        page_table=Page._meta.db_table,
+                        document_table=document_table,
+                        config_sql=config_sql,
+                    ),
+                    config_params + [batch],
+                )
+
+    def remove_pages(self, page_ids):
+        for batch in get_index_batches(page_ids):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM {} WHERE page_id = ANY(%s)".format(
+                        POSTGRES_SEARCH_TABLE
+                    ),
+                    [batch],
+                )
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute("TRUNCATE {}".format(POSTGRES_SEARCH_TABLE))
+
+
+class SqliteSearchBackend(SearchBackend):
+    """
+    Full-text search on an FTS5 table with the page id as rowid,
+    ranked by bm25.
+    """
+
+    indexed = True
+
+    def get_match_query(self, query):
+        # Quote terms so FTS5 query syntax in user input can't fail
+        return " ".join('"{}"'.format(word) for word in WORD_RE.findall(query))
+
+    def search(self, queryset, query, rank=True):
+        match_query = self.get_match_query(query)
+        if not match_query:
+            return queryset.none()
+        page_id = '"{}"."id"'.format(Page._meta.db_table)
+        queryset = queryset.filter(
+            id__in=RawSQL(
+                "SELECT rowid FROM {table} WHERE {table} MATCH %s".format(
+                    table=SQLITE_SEARCH_TABLE
+                ),
+                [match_query],
+            )
+        )
+        queryset = queryset.annotate(
+            query_highlight=RawSQL(
+                "SELECT snippet({table}, 0, %s, %s, '…', %s) FROM {table} "
+                "WHERE {table} MATCH %s AND rowid = {page_id}".format(
+                    table=SQLITE_SEARCH_TABLE, page_id=page_id
+                ),
+                [
+                    HIGHLIGHT_START_MARKER,
+                    HIGHLIGHT_END_MARKER,
+                    # FTS5 snippets have a single fragment of up to 64 tokens
+                    min(64, FILINGCABINET_SEARCH_SNIPPET_WORDS),
+                    match_query,
+                ],
+                output_field=TextField(),
+            ),
+        )
+        if not rank:
+            return queryset
+        return queryset.annotate(
+            search_rank=RawSQL(
+                "SELECT -rank FROM {table} WHERE {table} MATCH %s "
+                "AND rowid = {page_id}".format(
+                    table=SQLITE_SEARCH_TABLE, page_id=page_id
+                ),
+                [match_query],
+                output_field=FloatField(),
+            ),
+        ).order_by("-search_rank", "document", "number")
+
+    def index_pages(self, page_ids):
+        for batch in get_index_batches(page_ids):
+            placeholders = ", ".join(["%s"] * len(batch))
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM {} WHERE rowid IN ({})".format(
+                        SQLITE_SEARCH_TABLE, placeholders
+                    ),
+                    batch,
+                )
+                cursor.execute(
+                    "INSERT INTO {} (rowid, content) SELECT id, content "
+                    "FROM {} WHERE id IN ({})".format(
+                        SQLITE_SEARCH_TABLE, Page._meta.db_table, placeholders
+                    ),
+                    batch,
+                )
+
+    def remove_pages(self, page_ids):
+        for batch in get_index_batches(page_ids):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM {} WHERE rowid IN ({})".format(
+                        SQLITE_SEARCH_TABLE, ", ".join(["%s"] * len(batch))
+                    ),
+                    batch,
+                )
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM {}".format(SQLITE_SEARCH_TABLE))
+
+
+SEARCH_BACKENDS = {
+    "like": LikeSearchBackend,
+    "postgres": PostgresSearchBackend,
+    "sqlite": SqliteSearchBackend,
+}
+
+
+def get_search_backend_class(name: Optional[str] = None):
+    if name is None:
+        return LikeSearchBackend
+    try:
+        return SEARCH_BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown search backend: {}".format(name)) from None
+
+
+def get_search_backend():
+    return get_search_backend_class(FILINGCABINET_SEARCH_BACKEND)()
+
+
+def queue_page_index(page_ids):
+    """
+    Queues pages for the next search index update, pages already
+    in the queue are only updated once.
+    """
+    if not get_search_backend_class(FILINGCABINET_SEARCH_BACKEND).indexed:
+        return
+    SearchIndexUpdate.objects.bulk_create(
+        [SearchIndexUpdate(page_id=page_id) for page_id in page_ids],
+        ignore_conflicts=True,
+    )
+
+
+def queue_document_index(document_ids):
+    """
+    Queues all pages of documents, e.g. after their language changed.
+    """
+    if not get_search_backend_class(FILINGCABINET_SEARCH_BACKEND).indexed:
+        return
+    queue_page_index(
+        Page.objects.filter(document_id__in=document_ids).values_list("id", flat=True)
+    )
+
+
+def update_search_index(batch_size=FILINGCABINET_SEARCH_INDEX_BATCH_SIZE):
+    """
+    Drains the queue of search index updates in batches.
+    Returns the number of updated pages.
+    """
+    backend = get_search_backend()
+    count = 0
+    while True:
+        with transaction.atomic():
+            # Concurrent runs skip batches that are being updated
+            page_ids = list(
+                SearchIndexUpdate.objects.select_for_update(skip_locked=True)
+                .order_by("id")
+                .values_list("page_id", flat=True)[:batch_size]
+            )
+            if not page_ids:
+                break
+            # Pages queued again while indexing get a new queue entry
+            SearchIndexUpdate.objects.filter(page_id__in=page_ids).delete()
+            existing_ids = set(
+                Page.objects.filter(id__in=page_ids).values_list("id", flat=True)
+            )
+            backend.index_pages(sorted(existing_ids))
+            backend.remove_pages(sorted(set(page_ids) - existing_ids))
+        count += len(page_ids)
+        if len(page_ids) < batch_size:
+            break
+    return count
@@ -1,11 +1,22 @@
+import contextlib
+import itertools
 import json
 import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
 import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
-from pathlib import PurePath
+from pathlib import Path, PurePath
 
-from django.core.files.base import ContentFile
+from django.conf import settings
+from django.core.files.base import ContentFile, File
 from django.db import transaction
 from django.utils.text import slugify
 
@@ -24,15 +35,48 @@ from .models import (
     get_page_filename,
 )
 from .pdf_utils import (
+    HASH_BUFFER_SIZE,
     PDFProcessor,
+    PDFProcessorCache,
+    calculcate_content_hash_from_file,
     crop_image,
     detect_tables,
     draw_highlights,
+    hash_file,
+    init_page_worker,
+    render_page_in_worker,
     rotate_pages_on_pdf,
+    run_ocr,
 )
-from .settings import FILINGCABINET_PAGE_PROCESSING_TIMEOUT, TESSERACT_DATA_PATH
+from .search import queue_page_index
+from .settings import (
+    FILINGCABINET_OCR_DOCUMENT,
+    FILINGCABINET_OCR_DOCUMENT_TIMEOUT,
+    FILINGCABINET_OCR_ENGINE,
+    FILINGCABINET_OCR_JOBS,
+    FILINGCABINET_PAGE_DEDUPLICATION,
+    FILINGCABINET_PAGE_PROCESSING_FANOUT,
+    FILINGCABINET_PAGE_PROCESSING_MAX_IN_FLIGHT,
+    FILINGCABINET_PAGE_PROCESSING_TIMEOUT,
+    FILINGCABINET_PAGE_PROCESSING_WORKERS,
+    FILINGCABINET_PAGE_SAVE_BATCH_SIZE,
+    FILINGCABINET_PAGE_TASK_TARGET_DURATION,
+    FILINGCABINET_PDF_CACHE_ENTRIES,
+    FILINGCABINET_PDF_CACHE_SIZE,
+    FILINGCABINET_RASTERIZER,
+    FILINGCABINET_SECONDARY_CONTENT_HASH,
+    FILINGCABINET_TEXT_EXTRACTOR,
+    TESSERACT_DATA_PATH,
+)
+from .storage import get_storage, is_local_storage, save_field_files
 from .tasks import convert_images_to_webp_task, process_document_task
-from .utils import ensure_directory_exists, get_existing_directories
+from .utils import (
+    HashingFile,
+    build_directory_tree,
+    copy_to_temporary_file,
+    get_existing_directories,
+    get_local_file,
+)
 
 try:
     from easy_thumbnails.files import get_thumbnailer
@@ -44,54 +88,230 @@ Document = get_document_model()
 
 logger = logging.getLogger(__name__)
 
+PAGE_TIMING_KEY = "_page_timing"
+PDF_REPAIR_KEY = "_pdf_repair"
+PAGE_DEDUPLICATION_KEY = "_page_deduplication"
+OCR_DOCUMENT_KEY = "_ocr_document"
+# Processing seconds per page cost unit until durations have been measured
+DEFAULT_SECONDS_PER_PAGE_COST = 12
+MAX_TASK_PAGE_LIMIT = 100
+
 
 def get_copy_func(doc):
     def copy_func(filename):
-        return doc.get_writeable_file()
+        writeable_path = doc.get_writeable_file()
+        if writeable_path is None:
+            # Remote storage, repair a local copy and upload it afterwards
+            fd, writeable_path = tempfile.mkstemp(suffix=".pdf")
+            os.close(fd)
+            shutil.copyfile(filename, writeable_path)
+        return writeable_path
 
     return copy_func
 
 
-def get_pdf_processor(doc):
-    config = {"TESSERACT_DATA_PATH": TESSERACT_DATA_PATH}
-    pdf_path = doc.get_file_path()
-    return PDFProcessor(
+# Opened PDFs of this worker process, so chunks of the same document
+# processed one after another do not parse and repair the file again
+pdf_processor_cache = PDFProcessorCache(
+    max_entries=FILINGCABINET_PDF_CACHE_ENTRIES,
+    max_bytes=FILINGCABINET_PDF_CACHE_SIZE,
+)
+
+
+def get_pdf_cache_key(doc, pdf_path):
+    try:
+        stat = os.stat(pdf_path)
+    except OSError:
+        return None, 0
+    return (doc.uid.hex, str(pdf_path), stat.st_mtime_ns, stat.st_size), stat.st_size
+
+
+def get_pdf_processor(doc, pdf_path):
+    config = {
+        "TESSERACT_DATA_PATH": TESSERACT_DATA_PATH,
+        "RASTERIZER": FILINGCABINET_RASTERIZER,
+        "TEXT_EXTRACTOR": FILINGCABINET_TEXT_EXTRACTOR,
+        "OCR_ENGINE": FILINGCABINET_OCR_ENGINE,
+    }
+    cache_key, _size = get_pdf_cache_key(doc, pdf_path)
+    pdf = pdf_processor_cache.get(cache_key) if cache_key is not None else None
+    if pdf is not None:
+        logger.info("Using cached PDF of doc %s", doc.id)
+        pdf.language = doc.language
+        pdf.config = config
+        return pdf
+
+    pdf = PDFProcessor(
         pdf_path, copy_func=get_copy_func(doc), language=doc.language, config=config
     )
+    if pdf.repairs and not is_local_storage(doc.pdf_file.storage):
+        # Repaired temporary copy, removed by open_document_pdf and not cached
+        replace_document_file(doc, pdf.filename)
+        return pdf
+    # The file may have been copied or repaired while opening
+    cache_key, size = get_pdf_cache_key(doc, pdf.filename)
+    if cache_key is not None:
+        pdf_processor_cache.set(cache_key, pdf, size)
+    return pdf
+
+
+@contextlib.contextmanager
+def open_document_pdf(doc):
+    """
+    Yields the PDF processor of a local copy of the document file.
+    Repaired temporary copies of remote files are removed afterwards.
+    """
+    with doc.get_local_file() as pdf_path:
+        pdf = get_pdf_processor(doc, pdf_path)
+        try:
+            yield pdf
+        finally:
+            if pdf.filename != Path(pdf_path) and not is_local_storage(
+                doc.pdf_file.storage
+            ):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(pdf.filename)
 
 
 def process_document(doc):
-    if not doc.get_file_path():
+    if not doc.get_file():
         return
     logger.info("Processing document %s", doc.id)
-    pdf = get_pdf_processor(doc)
-    doc.num_pages = pdf.num_pages
-    # TODO: make storage agnostic
-    doc.file_size = os.path.getsize(doc.get_file_path())
+    with open_document_pdf(doc) as pdf:
+        if pdf.repairs:
+            record_pdf_repair(doc, pdf)
+        if should_ocr_document(doc, pdf):
+            queue_document_ocr(doc)
+            return
+        doc.num_pages = pdf.num_pages
+        doc.file_size = doc.get_file().size
 
-    meta = pdf.get_meta()
-    doc.properties.update(meta)
-    if doc.title.endswith(".pdf"):
-        doc.title = doc.title.rsplit(".pdf")[0]
-    doc.title = doc.title[:500]
+        meta = pdf.get_meta()
+        doc.properties.update(meta)
+        if doc.title.endswith(".pdf"):
+            doc.title = doc.title.rsplit(".pdf")[0]
+        doc.title = doc.title[:500]
 
-    if not doc.slug and doc.title:
-        doc.slug = slugify(doc.title)[:250]
+        if not doc.slug and doc.title:
+            doc.slug = slugify(doc.title)[:250]
 
-    if not doc.outline:
-        try:
-            doc.outline = pdf.get_markdown_outline()
-        except Exception:
-            logging.warning("Failed to generate markdown outline:", exc_info=True)
+        if not doc.outline:
+            try:
+                doc.outline = pdf.get_markdown_outline()
+            except Exception:
+                logging.warning("Failed to generate markdown outline:", exc_info=True)
+
+        detect_tables_on_doc(doc, save=False)
+
+        doc.save()
 
-    detect_tables_on_doc(doc, save=False)
+        queue_missing_pages(doc, pdf=pdf)
+
+
+def record_pdf_repair(doc, pdf):
+    """
+    The repaired file replaced the document file in place, so later chunks
+    and reprocessing read it directly. Record how it was repaired.
+    The content_hash field keeps the hash of the uploaded file for
+    duplicate detection.
+    """
+    with open(pdf.filename, "rb") as f:
+        content_hash = calculcate_content_hash_from_file(f)
+    logger.info("Doc %s was repaired with %s", doc.id, pdf.repairs)
+    doc.properties[PDF_REPAIR_KEY] = {
+        "strategies": pdf.repairs,
+        "content_hash": content_hash,
+    }
+
+
+def should_ocr_document(doc, pdf):
+    if not FILINGCABINET_OCR_DOCUMENT:
+        return False
+    if OCR_DOCUMENT_KEY in doc.properties:
+        # Only try once, pages get OCRed one by one if it failed
+        return False
+    return not pdf.has_text_layer()
+
+
+def queue_document_ocr(doc):
+    from .tasks import ocr_document_task
+
+    logger.info("Doc %s has no text layer, queuing OCR of document", doc.id)
+    doc.properties[OCR_DOCUMENT_KEY] = {"status": "queued"}
+    doc.save(update_fields=["properties"])
+    ocr_document_task.apply_async(
+        (doc.id,), time_limit=FILINGCABINET_OCR_DOCUMENT_TIMEOUT + 60
+    )
 
-    doc.save()
 
-    queue_missing_pages(doc)
+def ocr_document(doc):
+    """
+    Runs ocrmypdf over the whole document, replaces the document file
+    with the OCRed PDF and processes the document again, now with text layer.
+    """
+    start = time.monotonic()
+    with doc.get_local_file() as pdf_path:
+        # Next to the file, so local storage replaces it atomically
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(pdf_path), suffix=".pdf")
+        os.close(fd)
+        try:
+            output_path = run_ocr(
+                pdf_path,
+                language=doc.language,
+                timeout=FILINGCABINET_OCR_DOCUMENT_TIMEOUT,
+                jobs=FILINGCABINET_OCR_JOBS,
+                output_path=temp_path,
+            )
+            duration = time.monotonic() - start
+            if output_path:
+                replace_document_file(doc, temp_path)
+                status = "done"
+            else:
+                status = "failed"
+        finally:
+            # Left in place by uploads to remote storages and failures
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+    logger.info("OCR of doc %s %s after %.1fs", doc.id, status, duration)
+    doc.refresh_from_db(fields=["properties"])
+    doc.properties[OCR_DOCUMENT_KEY] = {
+        "status": status,
+        "duration": round(duration, 1),
+    }
+    doc.save(update_fields=["properties"])
+    process_document(doc)
+
+
+def replace_document_file(doc, local_path):
+    """
+    Replaces the document file with a local file. Local storage files
+    are replaced atomically, so cached PDFs are invalidated by the changed
+    file. Remote storage files are replaced by an upload, storages that do
+    not overwrite files get the document pointed to the uploaded file.
+    Documents backed by an original get their own document file instead.
+    """
+    if not doc.pdf_file:
+        # Keep the original attachment, the replacement becomes the document file
+        with open(local_path, "rb") as f:
+            doc.pdf_file.save("document.pdf", MovableFile(f))
+        return
+    file = doc.pdf_file
+    if is_local_storage(file.storage):
+        pdf_path = file.path
+        if local_path != pdf_path:
+            shutil.copymode(pdf_path, local_path)
+            os.replace(local_path, pdf_path)
+        return
+    old_name = file.name
+    with open(local_path, "rb") as f:
+        name = file.storage.save(old_name, File(f, name=old_name))
+    if name != old_name:
+        file.name = name
+        doc.save(update_fields=["pdf_file"])
+        file.storage.delete(old_name)
 
 
-def queue_missing_pages(doc):
+def queue_missing_pages(doc, pdf=None):
     from .tasks import process_pages_task
 
     all_pages = set(range(1, doc.num_pages + 1))
@@ -112,22 +332,132 @@ def queue_missing_pages(doc):
         doc.save()
         return
 
+    # Sequential processing requeues the rest, only its first chunk is needed
+    max_chunks = None if FILINGCABINET_PAGE_PROCESSING_FANOUT else 1
+    if pdf is None:
+        with open_document_pdf(doc) as pdf:
+            chunks = get_page_chunks(doc, pdf, missing_pages, max_chunks=max_chunks)
+    else:
+        chunks = get_page_chunks(doc, pdf, missing_pages, max_chunks=max_chunks)
+
+    if FILINGCABINET_PAGE_PROCESSING_FANOUT:
+        queue_page_chunks(doc, chunks)
+        return
+
+    first_chunk, estimated_duration = chunks[0]
     process_pages_task.apply_async(
         args=[doc.id],
-        kwargs={"page_numbers": missing_pages, "task_page_limit": 10},
-        time_limit=FILINGCABINET_PAGE_PROCESSING_TIMEOUT + 60,
+        kwargs={"page_numbers": missing_pages, "task_page_limit": len(first_chunk)},
+        time_limit=get_chunk_time_limit(estimated_duration),
     )
 
 
-def process_pages(doc, page_numbers=None, task_page_limit=None):
+def get_seconds_per_page_cost(doc):
+    timing = doc.properties.get(PAGE_TIMING_KEY) or {}
+    return timing.get("seconds_per_cost", DEFAULT_SECONDS_PER_PAGE_COST)
+
+
+def get_page_chunks(doc, pdf, page_numbers, max_chunks=None):
+    """
+    Splits pages into chunks that are estimated to take the target task
+    duration, based on estimated page costs and previously measured durations.
+    Page costs are only estimated up to max_chunks full chunks.
+    Returns a list of (page numbers, estimated duration) tuples.
+    """
+    seconds_per_cost = get_seconds_per_page_cost(doc)
+    target_duration = FILINGCABINET_PAGE_TASK_TARGET_DURATION
+
+    chunks = []
+    chunk, chunk_duration = [], 0
+    for page_number in page_numbers:
+        cost = pdf.get_page_costs([page_number])[page_number]
+        duration = cost * seconds_per_cost
+        if chunk and (
+            chunk_duration + duration > target_duration
+            or len(chunk) >= MAX_TASK_PAGE_LIMIT
+        ):
+            chunks.append((chunk, chunk_duration))
+            if max_chunks is not None and len(chunks) >= max_chunks:
+                return chunks
+            chunk, chunk_duration = [], 0
+        chunk.append(page_number)
+        chunk_duration += duration
+    if chunk:
+        chunks.append((chunk, chunk_duration))
+    return chunks
+
+
+def get_chunk_time_limit(estimated_duration):
+    return int(max(FILINGCABINET_PAGE_PROCESSING_TIMEOUT, estimated_duration * 2)) + 60
+
+
+def record_page_timing(doc, pdf, page_numbers, duration):
+    if not page_numbers:
+        return
+    total_cost = sum(pdf.get_page_costs(page_numbers).values())
+    measured = duration / total_cost
+    documents = type(doc).objects.filter(pk=doc.pk)
+    with transaction.atomic():
+        # Lock against concurrent chunk tasks of the same document
+        properties = (
+            documents.select_for_update().values_list("properties", flat=True).get()
+        )
+        timing = properties.get(PAGE_TIMING_KEY) or {}
+        previous = timing.get("seconds_per_cost")
+        if previous is not None:
+            # Smooth out outliers
+            measured = (previous + measured) / 2
+        properties[PAGE_TIMING_KEY] = {"seconds_per_cost": round(measured, 3)}
+        documents.update(properties=properties)
+    doc.properties = properties
+
+
+def queue_page_chunks(doc, chunks):
+    """
+    Process all missing pages in parallel chunk tasks and
+    finalize the document once when all of them are done.
+    """
+    from celery import chord
+
+    from .tasks import finalize_pages_task, process_pages_task
+
+    chunk_tasks = [
+        process_pages_task.si(
+            doc.id,
+            page_numbers=chunk,
+            requeue=False,
+        ).set(time_limit=get_chunk_time_limit(estimated_duration))
+        for chunk, estimated_duration in chunks
+    ]
+    logger.info("Fanning out %s page tasks for doc %s", len(chunk_tasks), doc.id)
+    callback = finalize_pages_task.si(doc.id)
+    # Also finalize when a chunk task failed so its pages get queued again
+    callback.link_error(finalize_pages_task.si(doc.id))
+    chord(chunk_tasks)(callback)
+
+
+PAGE_IMAGE_FIELDS = ["image", "image_large", "image_normal", "image_small"]
+PAGE_RESULT_FIELDS = [
+    "content",
+    "content_hash",
+    "width",
+    "height",
+    "pending",
+    *PAGE_IMAGE_FIELDS,
+]
+
+
+def process_pages(doc, page_numbers=None, task_page_limit=None, requeue=True):
     if page_numbers is None:
         page_numbers = list(range(1, doc.num_pages + 1))
 
     # Remove existing non-pending page numbers
-    existing_pages = Page.objects.filter(document=doc, pending=False).values_list(
-        "number", flat=True
+    done_page_numbers = set(
+        Page.objects.filter(document=doc, pending=False).values_list(
+            "number", flat=True
+        )
     )
-    page_numbers = list(set(page_numbers) - set(existing_pages))
+    page_numbers = list(set(page_numbers) - done_page_numbers)
     page_numbers.sort()
 
     if task_page_limit is None:
@@ -136,42 +466,229 @@ def process_pages(doc, page_numbers=None, task_page_limit=None):
         process_page_numbers = page_numbers[:task_page_limit]
 
     logger.info("Processing %s pages of doc %s", process_page_numbers, doc.id)
-    pdf = get_pdf_processor(doc)
+    with open_document_pdf(doc) as pdf:
+        pages = get_chunk_pages(doc, process_page_numbers)
+        # Saves in batches, so a chunk killed by its time limit keeps its work
+        saver = PageSaver()
+        render_page_numbers = process_page_numbers
+        if FILINGCABINET_PAGE_DEDUPLICATION:
+            reused_pages = reuse_duplicate_pages(doc, pdf, pages)
+            saver.add_all(reused_pages)
+            reused_page_numbers = {page.number for page in reused_pages}
+            render_page_numbers = [
+                page_number
+                for page_number in process_page_numbers
+                if page_number not in reused_page_numbers
+            ]
+
+        timeout = FILINGCABINET_PAGE_PROCESSING_TIMEOUT
+        workers = FILINGCABINET_PAGE_PROCESSING_WORKERS
+        start = time.monotonic()
+
+        render_pages = {
+            page_number: pages[page_number] for page_number in render_page_numbers
+        }
+        if workers > 1 and len(render_pages) > 1 and can_start_page_pool():
+            saver.add_all(
+                process_pages_parallel(
+                    doc, pdf, render_pages, workers=workers, timeout=timeout
+                )
+            )
+        else:
+            saver.add_all(process_pages_sequential(doc, pdf, render_pages, timeout))
+
+    saver.flush()
+    logger.info("Processing %s pages done of doc %s", process_page_numbers, doc.id)
+    record_page_timing(doc, pdf, render_page_numbers, time.monotonic() - start)
+    if requeue:
+        done_count = len(done_page_numbers) + saver.count
+        finalize_pages(doc, pdf=pdf, done_count=done_count)
+
+
+def reuse_duplicate_pages(doc, pdf, pages):
+    """
+    Copies text and images from already processed pages with the same
+    content hash, e.g. from re-uploads of the same file, instead of
+    rendering and running OCR again. Returns the reused pages.
+    """
+    hashes = pdf.get_page_hashes(sorted(pages))
+    for page_number, content_hash in hashes.items():
+        pages[page_number].content_hash = content_hash
+    if not hashes:
+        return []
+
+    source_pages = {}
+    candidates = (
+        Page.objects.filter(
+            content_hash__in=set(hashes.values()),
+            pending=False,
+            # Text may come from OCR in the document's language
+            document__language=doc.language,
+        )
+        .exclude(image="")
+        .order_by("-corrected", "id")
+    )
+    for candidate in candidates:
+        source_pages.setdefault(candidate.content_hash, candidate)
+
+    reused_pages = []
+    for page_number, content_hash in hashes.items():
+        source_page = source_pages.get(content_hash)
+        if source_page is None:
+            continue
+        page = pages[page_number]
+        try:
+            copy_page_results(page, source_page)
+        except OSError as err:
+            logger.warning(
+                "Could not reuse page %s for page %s of doc %s: %s",
+                source_page.id,
+                page_number,
+                doc.id,
+                err,
+            )
+            continue
+        reused_pages.append(page)
+    logger.info(
+        "Reused %s of %s pages of doc %s", len(reused_pages), len(hashes), doc.id
+    )
+    record_page_deduplication(doc, len(hashes), len(reused_pages))
+    return reused_pages
 
-    timeout = FILINGCABINET_PAGE_PROCESSING_TIMEOUT
 
-    for page_number, image in pdf.get_images(
-        pages=process_page_numbers, timeout=timeout
-    ):
-        process_page(doc, pdf, page_number, image)
+def copy_page_results(page, source_page):
+    if not page.corrected:
+        page.content = source_page.content
+    page.width = source_page.width
+    page.height = source_page.height
+    for field_name in PAGE_IMAGE_FIELDS:
+        source_file = getattr(source_page, field_name)
+        field_file = getattr(page, field_name)
+        if not source_file:
+            continue
+        if field_file:
+            field_file.delete(save=False)
+        with source_file.open("rb") as f:
+            field_file.save("page.png", File(f), save=False)
+    page.pending = False
 
-    logger.info("Processing %s pages done of doc %s", process_page_numbers, doc.id)
+
+def record_page_deduplication(doc, checked_count, reused_count):
+    documents = type(doc).objects.filter(pk=doc.pk)
+    with transaction.atomic():
+        # Lock against concurrent chunk tasks of the same document
+        properties = (
+            documents.select_for_update().values_list("properties", flat=True).get()
+        )
+        stats = properties.get(PAGE_DEDUPLICATION_KEY) or {}
+        checked_count += stats.get("pages", 0)
+        reused_count += stats.get("reused", 0)
+        properties[PAGE_DEDUPLICATION_KEY] = {
+            "pages": checked_count,
+            "reused": reused_count,
+            "hit_rate": round(reused_count / checked_count, 3) if checked_count else 0,
+        }
+        documents.update(properties=properties)
+    doc.properties = properties
+
+
+def get_chunk_pages(doc, page_numbers):
+    """
+    Returns pages of the chunk by number, fetched in one query
+    and with unsaved instances for pages that do not exist yet.
+    """
+    pages = {
+        page.number: page
+        for page in Page.objects.filter(document=doc, number__in=page_numbers)
+    }
+    for page_number in page_numbers:
+        if page_number not in pages:
+            pages[page_number] = Page(document=doc, number=page_number, pending=True)
+    return pages
+
+
+def save_pages(pages):
+    existing_pages = [page for page in pages if page.pk is not None]
+    new_pages = [page for page in pages if page.pk is None]
+    if existing_pages:
+        Page.objects.bulk_update(existing_pages, PAGE_RESULT_FIELDS)
+    if new_pages:
+        # Pages may have been created concurrently in the meantime
+        Page.objects.bulk_create(
+            new_pages,
+            update_conflicts=True,
+            unique_fields=["document", "number"],
+            update_fields=PAGE_RESULT_FIELDS,
+        )
+    page_ids = [page.pk for page in pages if page.pk is not None]
+    unsaved_pages = [page for page in pages if page.pk is None]
+    if unsaved_pages:
+        # Backend did not return primary keys of upserted pages
+        page_ids.extend(
+            Page.objects.filter(
+                document_id__in={page.document_id for page in unsaved_pages},
+                number__in=[page.number for page in unsaved_pages],
+            ).values_list("id", flat=True)
+        )
+    queue_page_index(page_ids)
+
+
+class PageSaver:
+    """
+    Collects processed pages and saves them with save_pages
+    whenever batch_size pages are collected.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or FILINGCABINET_PAGE_SAVE_BATCH_SIZE
+        self.pages = []
+        self.count = 0
+
+    def add(self, page):
+        self.pages.append(page)
+        self.count += 1
+        if len(self.pages) >= self.batch_size:
+            self.flush()
+
+    def add_all(self, pages):
+        for page in pages:
+            self.add(page)
+
+    def flush(self):
+        if self.pages:
+            save_pages(self.pages)
+            self.pages = []
+
+
+def finalize_pages(doc, pdf=None, done_count=None):
     # Check if doc is done
-    done_pages = Page.objects.filter(document=doc, pending=False).count()
-    if done_pages == doc.num_pages:
+    if done_count is None:
+        done_count = Page.objects.filter(document=doc, pending=False).count()
+    if done_count == doc.num_pages:
         logger.info("Processing pages of doc %s complete", doc.id)
         doc.pending = False
         doc.save()
         if webp is not None:
             convert_images_to_webp_task.delay(doc.pk)
     else:
-        queue_missing_pages(doc)
+        queue_missing_pages(doc, pdf=pdf)
 
 
-def process_page(doc, pdf, page_number, image):
+def process_page(doc, pdf, page_number, image, page=None, save=True):
     logger.info("Getting text for page %s of doc %s", page_number, doc.id)
     dims = image.size
 
-    try:
-        page = Page.objects.get(
-            document=doc,
-            number=page_number,
-        )
-    except Page.DoesNotExist:
-        page = Page(document=doc, number=page_number, pending=True)
+    if page is None:
+        try:
+            page = Page.objects.get(
+                document=doc,
+                number=page_number,
+            )
+        except Page.DoesNotExist:
+            page = Page(document=doc, number=page_number, pending=True)
 
     if not page.pending:
-        return
+        return None
 
     if not page.corrected:
         text = pdf.get_text_for_page(page_number, image)
@@ -181,20 +698,236 @@ def process_page(doc, pdf, page_number, image):
     logger.info("Making thumbnails page %s of doc %s", page_number, doc.id)
     make_thumbnails(page, image)
     page.pending = False
-    page.save()
+    if save:
+        page.save()
     logger.info("Processing page %s of doc %s complete", page_number, doc.id)
+    return page
+
+
+# Page worker processes of this process, kept across chunk tasks so
+# imports, opened PDFs and loaded OCR models stay warm
+_page_pool = None
+_page_pool_key = None
+_page_pool_lock = threading.Lock()
+
+
+def can_start_page_pool():
+    """
+    Daemonic processes like the children of Celery's prefork pool cannot
+    start page workers, pages are then processed in the task process.
+    """
+    return not multiprocessing.current_process().daemon
+
+
+def get_page_pool(workers):
+    global _page_pool, _page_pool_key
+    key = (os.getpid(), workers)
+    with _page_pool_lock:
+        if _page_pool is not None and _page_pool_key != key:
+            if _page_pool_key[0] == os.getpid():
+                _page_pool.shutdown(wait=False, cancel_futures=True)
+            # Pools inherited from a forking parent are left to the parent
+            _page_pool = None
+        if _page_pool is None:
+            _page_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                # Workers exit when this process is killed, e.g. on a hard
+                # task time limit, instead of being left behind
+                initializer=init_page_worker,
+                initargs=(os.getpid(),),
+            )
+            _page_pool_key = key
+        return _page_pool
+
+
+def shutdown_page_pool(terminate=False):
+    """
+    Shuts down the page worker processes, the next chunk starts new ones.
+    terminate kills workers stuck on a page, running pages cannot be
+    cancelled otherwise.
+    """
+    global _page_pool, _page_pool_key
+    with _page_pool_lock:
+        pool, _page_pool, _page_pool_key = _page_pool, None, None
+    if pool is None:
+        return
+    if terminate:
+        for process in list((pool._processes or {}).values()):
+            process.terminate()
+    pool.shutdown(wait=not terminate, cancel_futures=True)
+
+
+def process_pages_sequential(doc, pdf, pages, timeout):
+    """
+    Render, thumbnail and extract text of pages in this process.
+    Yielded pages still need to be saved.
+    """
+    for page_number, image in pdf.get_images(pages=sorted(pages), timeout=timeout):
+        page = process_page(
+            doc, pdf, page_number, image, page=pages[page_number], save=False
+        )
+        if page is not None:
+            yield page
+
+
+def process_pages_parallel(doc, pdf, pages, workers, timeout):
+    """
+    Render, thumbnail and extract text of pages in a pool of worker processes.
+    Page results are yielded as they come in and at most max in-flight pages
+    are handed to the pool at the same time to bound memory usage.
+    Workers stuck without finishing a page for twice the timeout (rendering
+    and text extraction) are terminated, their pages stay pending. Pages are
+    processed sequentially when the workers cannot be started.
+    Yielded pages still need to be saved.
+    """
+    max_in_flight = FILINGCABINET_PAGE_PROCESSING_MAX_IN_FLIGHT or workers * 2
+    page_iter = iter(sorted(pages))
+    executor = get_page_pool(workers)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        in_flight = {}
+
+        def submit(page_number):
+            future = executor.submit(
+                render_page_in_worker,
+                pdf.filename,
+                pdf.language,
+                pdf.config,
+                page_number,
+                Page.SIZES,
+                temp_dir,
+                not pages[page_number].corrected,
+                timeout,
+            )
+            in_flight[future] = page_number
+
+        try:
+            try:
+                for page_number in itertools.islice(page_iter, max_in_flight):
+                    submit(page_number)
+            except (AssertionError, OSError, BrokenProcessPool):
+                # Page workers could not be started in this process
+                logger.exception(
+                    "Could not start page workers for doc %s, "
+                    "processing pages sequentially",
+                    doc.id,
+                )
+                shutdown_page_pool(terminate=True)
+                in_flight.clear()
+                yield from process_pages_sequential(doc, pdf, pages, timeout)
+                return
+
+            while in_flight:
+                done, _not_done = wait(
+                    in_flight, timeout=timeout * 2, return_when=FIRST_COMPLETED
+                )
+                if not done:
+                    logger.error(
+                        "Page workers stuck on pages %s of doc %s, terminating",
+                        sorted(in_flight.values()),
+                        doc.id,
+                    )
+                    shutdown_page_pool(terminate=True)
+                    return
+                for future in done:
+                    page_number = in_flight.pop(future)
+                    try:
+                        rendered = future.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as err:
+                        # Page stays pending and is picked up again later
+                        logger.error(
+                            "Error processing page %s of doc %s: %s",
+                            page_number,
+                            doc.id,
+                            err,
+                        )
+                        logger.exception(err)
+                        rendered = None
+                    if rendered is not None:
+                        page = save_rendered_page(
+                            doc, pages[page_number], rendered, save=False
+                        )
+                        if page is not None:
+                            yield page
+                    next_page_number = next(page_iter, None)
+                    if next_page_number is not None:
+                        submit(next_page_number)
+        except BrokenProcessPool:
+            # A worker died, e.g. killed by the OOM killer
+            logger.exception("Page workers of doc %s broke", doc.id)
+            shutdown_page_pool(terminate=True)
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+def save_rendered_page(doc, page, rendered, save=True):
+    if page is None:
+        page = Page(document=doc, number=rendered.number, pending=True)
+    if not page.pending:
+        return None
+    if rendered.text is not None:
+        page.content = rendered.text.replace("\x00", "\ufffd")
+    page.width = rendered.width
+    page.height = rendered.height
+    store_page_images(page, rendered.image_files)
+    page.pending = False
+    if save:
+        page.save()
+    logger.info("Processing page %s of doc %s complete", page.number, doc.id)
+    return page
+
+
+class MovableFile(File):
+    """
+    File backed by a temporary file that FileSystemStorage
+    moves into place instead of copying it.
+    """
+
+    def temporary_file_path(self):
+        return self.name
 
 
 def make_thumbnails(page, image):
     if page.image:
         page.image.delete(save=False)
-    page.image.save("page.png", ContentFile(image.make_blob("png")), save=False)
-    for size_name, width in Page.SIZES:
-        image.transform(resize="{}x".format(width))
-        field_file = getattr(page, "image_%s" % size_name)
-        if field_file:
-            field_file.delete(save=False)
-        field_file.save("page.png", ContentFile(image.make_blob("png")), save=False)
+    # Decode once before the original file is moved into storage
+    resized = image.get_resized([width for _size_name, width in Page.SIZES])
+    with contextlib.ExitStack() as stack:
+        if image.filename is not None:
+            # Store the rasterizer's PNG as is
+            original = stack.enter_context(
+                MovableFile(open(image.filename, "rb"), name=str(image.filename))
+            )
+        else:
+            original = ContentFile(get_pil_bytes(image.image))
+        field_files = [(page.image, "page.png", original)]
+        for (size_name, _width), resized_image in zip(Page.SIZES, resized, strict=True):
+            field_file = getattr(page, "image_%s" % size_name)
+            if field_file:
+                field_file.delete(save=False)
+            field_files.append(
+                (field_file, "page.png", ContentFile(get_pil_bytes(resized_image)))
+            )
+        save_field_files(field_files)
+
+
+def store_page_images(page, image_files):
+    with contextlib.ExitStack() as stack:
+        field_files = []
+        for size_name, filename in image_files.items():
+            if size_name == "original":
+                field_file = page.image
+            else:
+                field_file = getattr(page, "image_%s" % size_name)
+            if field_file:
+                field_file.delete(save=False)
+            f = stack.enter_context(MovableFile(open(filename, "rb"), name=filename))
+            field_files.append((field_file, "page.png", f))
+        save_field_files(field_files)
 
 
 def make_page_annotation(annotation):
@@ -204,14 +937,16 @@ def make_page_annotation(annotation):
         if highlights:
             transform_func = draw_highlights(highlights)
 
-    image_bytes = crop_image(
-        annotation.page.image.path,
-        annotation.left,
-        annotation.top,
-        annotation.width,
-        annotation.height,
-        transform_func=transform_func,
-    )
+    page_image = annotation.page.image
+    with get_local_file(page_image.name, storage=page_image.storage) as image_path:
+        image_bytes = crop_image(
+            image_path,
+            annotation.left,
+            annotation.top,
+            annotation.width,
+            annotation.height,
+            transform_func=transform_func,
+        )
     if get_thumbnailer is not None:
         thumbnailer = get_thumbnailer(annotation.image)
         thumbnailer.delete_thumbnails()
@@ -259,6 +994,7 @@ def trigger_process_document_task(doc_pk):
 
 
 ZIP_BLOCK_LIST = {"__MACOSX"}
+ZIP_UPLOAD_DIRECTORY = "zip-uploads"
 
 
 class DocumentStorer:
@@ -273,7 +1009,7 @@ class DocumentStorer:
             self.user, self.collection, self.public, self.tags
         )
 
-    def create_from_file(self, file_obj, filename, directory=None):
+    def create_from_file(self, file_obj, filename, directory=None, hasher=None):
         title = filename
 
         doc = Document.objects.create(
@@ -281,7 +1017,22 @@ class DocumentStorer:
         )
 
         if file_obj:
-            doc.pdf_file.save(filename, file_obj, save=True)
+            if hasattr(file_obj, "temporary_file_path"):
+                # Storage moves the file into place, only hash it
+                if hasher is None:
+                    file_obj.seek(0)
+                    hasher = hash_file(
+                        file_obj, secondary=FILINGCABINET_SECONDARY_CONTENT_HASH
+                    )
+                    file_obj.seek(0)
+                doc.pdf_file.save(filename, file_obj, save=False)
+            else:
+                hashing_file = HashingFile(file_obj, name=filename)
+                doc.pdf_file.save(filename, hashing_file, save=False)
+                hasher = hashing_file.get_hasher()
+            doc.content_hash = hasher.hexdigest()
+            doc.properties.update(hasher.get_properties())
+            doc.save()
             transaction.on_commit(trigger_process_document_task(doc.pk))
 
         if self.tags:
@@ -293,38 +1044,117 @@ class DocumentStorer:
         return doc
 
     def unpack_upload_zip(self, upload):
-        return self.unpack_zip(upload.get_file())
+        return self.unpack_zip_delayed(upload.get_file())
+
+    def unpack_zip_delayed(self, file_obj):
+        """
+        Stores the zip file in the document storage, so any worker can
+        open it, and unpacks it in a Celery task that deletes it afterwards.
+        Returns the task result to poll progress on.
+        """
+        from .tasks import unpack_zip_task
+
+        storage = get_storage()
+        zip_name = storage.save(
+            os.path.join(
+                settings.FILINGCABINET_MEDIA_PRIVATE_PREFIX,
+                ZIP_UPLOAD_DIRECTORY,
+                "{}.zip".format(uuid.uuid4().hex),
+            ),
+            File(file_obj, name="upload.zip"),
+        )
+        return unpack_zip_task.delay(
+            zip_name,
+            user_id=self.user.id if self.user else None,
+            public=self.public,
+            collection_id=self.collection.id if self.collection else None,
+            tags=[str(tag) for tag in self.tags] if self.tags else None,
+        )
 
-    def unpack_zip(self, file_obj):
+    def unpack_zip(self, file_obj, progress_callback=None):
+        """
+        Creates documents from the PDFs in a zip file and in zip files nested
+        in it, streaming every entry through a temporary file instead of
+        reading it into memory. Entries with the same content as an entry
+        before or as a document already in the collection are skipped.
+        progress_callback is called with the number of done and total entries.
+        """
         if not zipfile.is_zipfile(file_obj):
             return
 
-        with zipfile.ZipFile(file_obj, "r") as zf:
-            zip_paths = []
-            # step one collect files
-            for zip_info in zf.infolist():
-                if zip_info.is_dir():
-                    continue
-                path = PurePath(zip_info.filename)
-                parts = path.parts
-                if parts[0] in ZIP_BLOCK_LIST:
-                    continue
-                if path.suffix == ".pdf":
-                    zip_paths.append(path)
-                # TODO: recursive zip unpacking?
-            if not zip_paths:
+        with contextlib.ExitStack() as stack:
+            entries = list(get_zip_pdf_entries(file_obj, stack))
+            if not entries:
                 return
 
+            zip_paths = [path for path, _zf, _zip_info in entries]
             doc_paths = remove_common_root_path(zip_paths)
-            directories = get_existing_directories(self.collection)
-            for doc_path, zip_path in zip(doc_paths, zip_paths, strict=False):
-                directories = ensure_directory_exists(
-                    self.collection, directories, doc_path, self.user
+            directories = build_directory_tree(
+                self.collection,
+                get_existing_directories(self.collection),
+                [doc_path.parent for doc_path in doc_paths],
+                self.user,
+            )
+            seen_hashes = set()
+            if self.collection:
+                seen_hashes = set(
+                    self.collection.documents.exclude(content_hash=None).values_list(
+                        "content_hash", flat=True
+                    )
+                )
+            total = len(entries)
+            for done, (doc_path, (_path, zf, zip_info)) in enumerate(
+                zip(doc_paths, entries, strict=True), start=1
+            ):
+                with zf.open(zip_info) as entry:
+                    temp_file, hasher = copy_to_temporary_file(entry, doc_path.name)
+                with temp_file:
+                    content_hash = hasher.hexdigest()
+                    if content_hash in seen_hashes:
+                        logger.info("Skipping duplicate zip entry %s", doc_path)
+                    else:
+                        seen_hashes.add(content_hash)
+                        self.create_from_file(
+                            temp_file,
+                            doc_path.name,
+                            directory=directories.get(doc_path.parent),
+                            hasher=hasher,
+                        )
+                if progress_callback is not None:
+                    progress_callback(done, total)
+
+
+MAX_ZIP_DEPTH = 3
+
+
+def get_zip_pdf_entries(file_obj, stack, prefix=None, depth=0):
+    """
+    Yields path, zip file and zip info of PDF entries of a zip file.
+    Nested zip files are spooled to temporary files and their entries
+    are placed in a directory named after the nested zip file.
+    """
+    zf = stack.enter_context(zipfile.ZipFile(file_obj, "r"))
+    for zip_info in zf.infolist():
+        if zip_info.is_dir():
+            continue
+        path = PurePath(zip_info.filename)
+        parts = path.parts
+        if parts[0] in ZIP_BLOCK_LIST:
+            continue
+        if prefix is not None:
+            path = prefix / path
+        suffix = path.suffix.lower()
+        if suffix == ".pdf":
+            yield path, zf, zip_info
+        elif suffix == ".zip" and depth < MAX_ZIP_DEPTH:
+            nested_file = stack.enter_context(tempfile.TemporaryFile())
+            with zf.open(zip_info) as entry:
+                shutil.copyfileobj(entry, nested_file, HASH_BUFFER_SIZE)
+            nested_file.seek(0)
+            if zipfile.is_zipfile(nested_file):
+                yield from get_zip_pdf_entries(
+                    nested_file, stack, prefix=path.with_suffix(""), depth=depth + 1
                 )
-
-                directory = directories.get(doc_path.parent)
-                file_obj = BytesIO(zf.read(str(zip_path)))
-                self.create_from_file(file_obj, doc_path.name, directory=directory)
 
 
 def remove_common_root_path(paths):
@@ -344,7 +1174,7 @@ def remove_common_root_path(paths):
 
 
 def detect_tables_on_doc(doc, save=True):
-    if not doc.get_file_path():
+    if not doc.get_file():
         return
     logger.info("Detecting tables for %s", doc.id)
     with doc.get_local_file() as local_file_path:
@@ -23,3 +23,148 @@ FILINGCABINET_PAGE_PROCESSING_TIMEOUT = getattr(
     "FILINGCABINET_PAGE_PROCESSING_TIMEOUT",
     4 * 60,  # 4 minutes
 )
+
+# Number of continuous pages rendered by a single pdftoppm call,
+# set to 1 to render every page in its own process. The call gets
+# FILINGCABINET_PAGE_PROCESSING_TIMEOUT for every page in the batch.
+FILINGCABINET_RASTERIZE_BATCH_SIZE = getattr(
+    settings, "FILINGCABINET_RASTERIZE_BATCH_SIZE", 10
+)
+
+# Rasterizer backend for page images: "pdftoppm" or "pdfium" (needs pypdfium2)
+FILINGCABINET_RASTERIZER = getattr(settings, "FILINGCABINET_RASTERIZER", "pdftoppm")
+
+# Text layer extraction backend: "pypdf", "pdftotext" (poppler)
+# or "pdfium" (needs pypdfium2)
+FILINGCABINET_TEXT_EXTRACTOR = getattr(
+    settings, "FILINGCABINET_TEXT_EXTRACTOR", "pypdf"
+)
+
+# OCR backend for pages without text layer: "pytesseract" or
+# "tesserocr" (needs tesserocr, keeps the language model loaded per process,
+# i.e. per task process or per page worker process kept across chunk tasks;
+# handles are loaded again after workers were terminated or replaced)
+FILINGCABINET_OCR_ENGINE = getattr(settings, "FILINGCABINET_OCR_ENGINE", "pytesseract")
+
+# Run ocrmypdf once over documents without any text layer and store the
+# OCRed PDF as document file instead of OCRing every page on its own
+FILINGCABINET_OCR_DOCUMENT = getattr(settings, "FILINGCABINET_OCR_DOCUMENT", False)
+# Parallel ocrmypdf jobs, defaults to the number of CPUs
+FILINGCABINET_OCR_JOBS = getattr(settings, "FILINGCABINET_OCR_JOBS", None)
+FILINGCABINET_OCR_DOCUMENT_TIMEOUT = getattr(
+    settings, "FILINGCABINET_OCR_DOCUMENT_TIMEOUT", 60 * 60
+)
+
+# Number of worker processes rendering pages of one processing task,
+# 1 processes pages sequentially in the task process. Workers can only be
+# started from non-daemonic processes, e.g. Celery workers running with
+# the solo or threads pool. Children of the default prefork pool are
+# daemonic and process pages sequentially.
+FILINGCABINET_PAGE_PROCESSING_WORKERS = getattr(
+    settings, "FILINGCABINET_PAGE_PROCESSING_WORKERS", 1
+)
+# Maximum number of pages handed to the workers at the same time,
+# defaults to twice the number of workers
+FILINGCABINET_PAGE_PROCESSING_MAX_IN_FLIGHT = getattr(
+    settings, "FILINGCABINET_PAGE_PROCESSING_MAX_IN_FLIGHT", None
+)
+# Processed pages are saved in batches of this size during a chunk task
+FILINGCABINET_PAGE_SAVE_BATCH_SIZE = getattr(
+    settings, "FILINGCABINET_PAGE_SAVE_BATCH_SIZE", 10
+)
+
+# Dispatch all page chunks of a document at once as a Celery chord
+# instead of one chunk after another, needs a Celery result backend
+FILINGCABINET_PAGE_PROCESSING_FANOUT = getattr(
+    settings, "FILINGCABINET_PAGE_PROCESSING_FANOUT", False
+)
+
+# Page processing tasks get as many pages as are estimated to finish
+# in this many seconds
+FILINGCABINET_PAGE_TASK_TARGET_DURATION = getattr(
+    settings,
+    "FILINGCABINET_PAGE_TASK_TARGET_DURATION",
+    FILINGCABINET_PAGE_PROCESSING_TIMEOUT / 2,
+)
+
+# Reuse text and images of already processed identical pages
+FILINGCABINET_PAGE_DEDUPLICATION = getattr(
+    settings, "FILINGCABINET_PAGE_DEDUPLICATION", True
+)
+
+# Opened PDFs kept per worker process, bounded by count and by file size
+FILINGCABINET_PDF_CACHE_ENTRIES = getattr(
+    settings, "FILINGCABINET_PDF_CACHE_ENTRIES", 4
+)
+FILINGCABINET_PDF_CACHE_SIZE = getattr(
+    settings,
+    "FILINGCABINET_PDF_CACHE_SIZE",
+    256 * 1024 * 1024,  # 256 MB
+)
+
+# Additional content hash computed on ingest next to SHA1 and stored in
+# Document.properties: "blake3" or "xxhash" (need the respective package)
+# or any hashlib algorithm like "blake2b"
+FILINGCABINET_SECONDARY_CONTENT_HASH = getattr(
+    settings, "FILINGCABINET_SECONDARY_CONTENT_HASH", None
+)
+
+# Local copies of files from remote storages kept per process, in bytes,
+# 0 disables the cache
+FILINGCABINET_LOCAL_FILE_CACHE_SIZE = getattr(
+    settings,
+    "FILINGCABINET_LOCAL_FILE_CACHE_SIZE",
+    256 * 1024 * 1024,  # 256 MB
+)
+
+# Alias in settings.STORAGES for document files and page images, e.g. an
+# S3Storage of django-storages, None keeps files in MEDIA_ROOT
+FILINGCABINET_STORAGE = getattr(settings, "FILINGCABINET_STORAGE", None)
+# Parallel uploads, copies and deletes on remote storages
+FILINGCABINET_STORAGE_WORKERS = getattr(settings, "FILINGCABINET_STORAGE_WORKERS", 8)
+
+# Page search backend: "like" (unindexed substring search), "postgres"
+# (tsvector with GIN index) or "sqlite" (FTS5)
+FILINGCABINET_SEARCH_BACKEND = getattr(settings, "FILINGCABINET_SEARCH_BACKEND", "like")
+# PostgreSQL text search configuration by document language,
+# pages of other languages are indexed with "simple"
+FILINGCABINET_SEARCH_LANGUAGE_CONFIGS = getattr(
+    settings,
+    "FILINGCABINET_SEARCH_LANGUAGE_CONFIGS",
+    {
+        "da": "danish",
+        "de": "german",
+        "en": "english",
+        "es": "spanish",
+        "fi": "finnish",
+        "fr": "french",
+        "hu": "hungarian",
+        "it": "italian",
+        "nl": "dutch",
+        "no": "norwegian",
+        "pt": "portuguese",
+        "ro": "romanian",
+        "ru": "russian",
+        "sv": "swedish",
+        "tr": "turkish",
+    },
+)
+# Queued pages updated per transaction by the search index update task
+FILINGCABINET_SEARCH_INDEX_BATCH_SIZE = getattr(
+    settings, "FILINGCABINET_SEARCH_INDEX_BATCH_SIZE", 500
+)
+# Search result snippets: words per fragment and fragments per page
+FILINGCABINET_SEARCH_SNIPPET_WORDS = getattr(
+    settings, "FILINGCABINET_SEARCH_SNIPPET_WORDS", 15
+)
+FILINGCABINET_SEARCH_SNIPPET_FRAGMENTS = getattr(
+    settings, "FILINGCABINET_SEARCH_SNIPPET_FRAGMENTS", 3
+)
+# Seconds facet counts of a filtered document or page list are cached
+FILINGCABINET_FACET_CACHE_TIMEOUT = getattr(
+    settings, "FILINGCABINET_FACET_CACHE_TIMEOUT", 5 * 60
+)
+# Estimated API total counts above this are returned without exact count
+FILINGCABINET_API_COUNT_ESTIMATE_THRESHOLD = getattr(
+    settings, "FILINGCABINET_API_COUNT_ESTIMATE_THRESHOLD", 10000
+)
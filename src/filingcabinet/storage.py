@@ -0,0 +1,128 @@
+import posixpath
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+from django.core.files.storage import FileSystemStorage, storages
+
+from .settings import FILINGCABINET_STORAGE, FILINGCABINET_STORAGE_WORKERS
+
+default_storage = FileSystemStorage(allow_overwrite=True)
+
+
+def get_storage():
+    """
+    Storage of document files and page images, used as callable
+    storage of the model file fields.
+    """
+    if FILINGCABINET_STORAGE is not None:
+        return storages[FILINGCABINET_STORAGE]
+    return default_storage
+
+
+def is_local_storage(storage) -> bool:
+    """
+    Local storages are moved and deleted with file system operations.
+    """
+    return isinstance(storage, FileSystemStorage)
+
+
+def walk_storage_files(storage, directory) -> Iterator[str]:
+    try:
+        directories, files = storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in files:
+        yield posixpath.join(directory, name)
+    for name in directories:
+        yield from walk_storage_files(storage, posixpath.join(directory, name))
+
+
+def run_storage_operations(func, items, workers=FILINGCABINET_STORAGE_WORKERS):
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            func(item)
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        # Consume results to raise errors of operations
+        list(executor.map(func, items))
+
+
+def get_storage_key(storage, name) -> str:
+    """
+    Returns the object key of a file of an S3Storage of django-storages.
+    """
+    from storages.utils import clean_name, safe_join
+
+    return safe_join(storage.location, clean_name(name))
+
+
+def copy_storage_object(storage, source, destination):
+    """
+    Copies a file within a storage, server side for S3 compatible storages.
+    """
+    bucket = getattr(storage, "bucket", None)
+    if bucket is not None:
+        # S3Storage of django-storages, managed copy uses multipart for large files
+        bucket.copy(
+            {"Bucket": bucket.name, "Key": get_storage_key(storage, source)},
+            get_storage_key(storage, destination),
+        )
+        return
+    with storage.open(source, "rb") as f:
+        storage.save(destination, f)
+
+
+def delete_storage_directory(storage, directory):
+    if is_local_storage(storage):
+        shutil.rmtree(storage.path(directory), ignore_errors=True)
+        return
+    run_storage_operations(storage.delete, walk_storage_files(storage, directory))
+
+
+def move_storage_directory(storage, source, destination):
+    """
+    Moves all files below source directory to destination directory,
+    replacing existing files at destination.
+    """
+    if is_local_storage(storage):
+        source_path = storage.path(source)
+        destination_path = storage.path(destination)
+        if source_path == destination_path:
+            return
+        if storage.exists(source):
+            shutil.rmtree(destination_path, ignore_errors=True)
+        shutil.move(source_path, destination_path)
+        return
+    if source == destination:
+        return
+    source_names = list(walk_storage_files(storage, source))
+    if not source_names:
+        raise FileNotFoundError(source)
+    delete_storage_directory(storage, destination)
+
+    def copy(name):
+        target = posixpath.join(destination, posixpath.relpath(name, source))
+        copy_storage_object(storage, name, target)
+
+    run_storage_operations(copy, source_names)
+    run_storage_operations(storage.delete, source_names)
+
+
+def save_field_files(field_files):
+    """
+    Saves (field file, name, content) triples without saving the
+    instance, uploading in parallel to remote storages.
+    """
+
+    def save(item):
+        field_file, name, content = item
+        field_file.save(name, content, save=False)
+
+    if field_files and is_local_storage(field_files[0][0].storage):
+        # Local files are moved or written, no need for threads
+        workers = 1
+    else:
+        workers = FILINGCABINET_STORAGE_WORKERS
+    run_storage_operations(save, field_files, workers=workers)
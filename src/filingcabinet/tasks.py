@@ -1,10 +1,19 @@
 from django.db import transaction
 
 from celery import shared_task
+from celery.signals import worker_process_shutdown
 
-from . import get_document_model
+from . import get_document_model, get_documentcollection_model
 
 Document = get_document_model()
+DocumentCollection = get_documentcollection_model()
+
+
+@worker_process_shutdown.connect
+def shutdown_page_workers(**kwargs):
+    from .services import shutdown_page_pool
+
+    shutdown_page_pool()
 
 
 @shared_task(acks_late=True, time_limit=5 * 60)
@@ -18,15 +27,80 @@ def process_document_task(doc_pk):
     process_document(doc)
 
 
+@shared_task(acks_late=True)
+def ocr_document_task(doc_pk):
+    from .services import ocr_document
+
+    try:
+        doc = Document.objects.get(pk=doc_pk)
+    except Document.DoesNotExist:
+        return None
+    ocr_document(doc)
+
+
 @shared_task(acks_late=True, time_limit=5 * 60)
-def process_pages_task(doc_pk, page_numbers=None, task_page_limit=None):
+def process_pages_task(doc_pk, page_numbers=None, task_page_limit=None, requeue=True):
     from .services import process_pages
 
     try:
         doc = Document.objects.get(pk=doc_pk)
     except Document.DoesNotExist:
         return None
-    process_pages(doc, page_numbers=page_numbers, task_page_limit=task_page_limit)
+    process_pages(
+        doc,
+        page_numbers=page_numbers,
+        task_page_limit=task_page_limit,
+        requeue=requeue,
+    )
+
+
+@shared_task(acks_late=True, time_limit=5 * 60)
+def finalize_pages_task(doc_pk):
+    from .services import finalize_pages
+
+    try:
+        doc = Document.objects.get(pk=doc_pk)
+    except Document.DoesNotExist:
+        return None
+    finalize_pages(doc)
+
+
+@shared_task(bind=True, acks_late=True, time_limit=60 * 60)
+def unpack_zip_task(
+    self, zip_name, user_id=None, public=False, collection_id=None, tags=None
+):
+    """
+    Unpacks a zip file of the document storage into documents and deletes
+    it, progress is reported as PROGRESS state with done and total entries
+    if a result backend is set.
+    """
+    from django.contrib.auth import get_user_model
+
+    from .services import DocumentStorer
+    from .storage import get_storage
+
+    User = get_user_model()
+    user = User.objects.filter(id=user_id).first() if user_id else None
+    collection = None
+    if collection_id is not None:
+        collection = DocumentCollection.objects.filter(id=collection_id).first()
+
+    def report_progress(done, total):
+        if self.request.is_eager:
+            return
+        try:
+            self.update_state(state="PROGRESS", meta={"done": done, "total": total})
+        except NotImplementedError:
+            # No result backend configured
+            pass
+
+    storer = DocumentStorer(user, public=public, collection=collection, tags=tags)
+    storage = get_storage()
+    try:
+        with storage.open(zip_name, "rb") as f:
+            storer.unpack_zip(f, progress_callback=report_progress)
+    finally:
+        storage.delete(zip_name)
 
 
 @shared_task(acks_late=True, time_limit=5 * 60)
@@ -42,6 +116,14 @@ def files_moved_task(doc_pk):
     doc.save()
 
 
+@shared_task(acks_late=True, time_limit=5 * 60)
+def update_search_index_task():
+    # Run periodically by celery beat
+    from .search import update_search_index
+
+    update_search_index()
+
+
 @shared_task(acks_late=True, time_limit=5 * 60)
 def publish_document(doc_pk, public=True):
     try:
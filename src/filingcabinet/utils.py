@@ -1,67 +1,476 @@
 import os
+import shutil
 import tempfile
+import threading
+from collections import Counter, OrderedDict
 from contextlib import contextmanager
 from pathlib import PurePath
-from typing import Generator
+from typing import Generator, Optional
 
+from django.core.files.base import File
 from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.db import IntegrityError, transaction
+from django.db.models.functions import Substr
 
 from .models import CollectionDirectory, DocumentCollection
+from .pdf_utils import HASH_BUFFER_SIZE, ContentHasher, hash_file
+from .settings import (
+    FILINGCABINET_LOCAL_FILE_CACHE_SIZE,
+    FILINGCABINET_SECONDARY_CONTENT_HASH,
+)
+
+
+def get_storage_local_path(path, storage=default_storage) -> Optional[str]:
+    """
+    Returns the local file system path of a storage file
+    if the storage keeps its files locally.
+    """
+    try:
+        local_path = storage.path(path)
+    except NotImplementedError:
+        return None
+    if os.path.exists(local_path):
+        return local_path
+    return None
+
+
+def copy_storage_file(path, storage, local_file):
+    with storage.open(path, "rb") as f:
+        shutil.copyfileobj(f, local_file, HASH_BUFFER_SIZE)
+
+
+def iter_storage_file(path, storage):
+    with storage.open(path, "rb") as f:
+        yield from f.chunks(HASH_BUFFER_SIZE)
+
+
+def get_storage_file_version(path, storage):
+    try:
+        modified_time = storage.get_modified_time(path)
+    except NotImplementedError:
+        modified_time = None
+    return storage.size(path), modified_time
+
+
+class LocalFileCache:
+    """
+    Local copies of remote storage files kept per process, evicting the
+    least recently used copies not in use when over max_bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.in_use = Counter()
+        self.stale = set()
+        self.directory = None
+        self.lock = threading.Lock()
+
+    def get_directory(self):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="filingcabinet-")
+        return self.directory
+
+    @contextmanager
+    def get(self, path, storage) -> Generator[str, None, None]:
+        key = (type(storage).__qualname__, path)
+        version = get_storage_file_version(path, storage)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] == version:
+                self.entries.move_to_end(key)
+                local_path = entry[0]
+                self.in_use[local_path] += 1
+            else:
+                local_path = None
+        if local_path is None:
+            local_path = self.download(path, storage, key, version)
+        try:
+            yield local_path
+        finally:
+            with self.lock:
+                self.in_use[local_path] -= 1
+                if not self.in_use[local_path]:
+                    del self.in_use[local_path]
+                    if local_path in self.stale:
+                        self.stale.discard(local_path)
+                        os.remove(local_path)
+
+    def download(self, path, storage, key, version):
+        _, extension = os.path.splitext(path)
+        with tempfile.NamedTemporaryFile(
+            mode="wb", delete=False, suffix=extension, dir=self.get_directory()
+        ) as local_file:
+            copy_storage_file(path, storage, local_file)
+        local_path = local_file.name
+        size = os.path.getsize(local_path)
+        with self.lock:
+            self.in_use[local_path] += 1
+            if size > self.max_bytes:
+                # Too large to keep, removed after use
+                self.stale.add(local_path)
+                return local_path
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.remove(old_entry[0])
+            self.entries[key] = (local_path, size, version)
+            self.evict()
+        return local_path
+
+    def evict(self):
+        total = sum(size for _path, size, _version in self.entries.values())
+        for key in list(self.entries):
+            if total <= self.max_bytes:
+                break
+            local_path, size, _version = self.entries.pop(key)
+            self.remove(local_path)
+            total -= size
+
+    def remove(self, local_path):
+        if self.in_use[local_path]:
+            self.stale.add(local_path)
+        else:
+            self.in_use.pop(local_path, None)
+            os.remove(local_path)
+
+
+local_file_cache = LocalFileCache(FILINGCABINET_LOCAL_FILE_CACHE_SIZE)
 
 
 @contextmanager
 def get_local_file(path, storage=default_storage) -> Generator[str, None, None]:
+    """
+    Yields a local file system path of a storage file for reading.
+    Local storage files are used in place, remote files are copied
+    into the local file cache or into a temporary file.
+    """
+    local_path = get_storage_local_path(path, storage=storage)
+    if local_path is not None:
+        yield local_path
+        return
+    if local_file_cache.max_bytes > 0:
+        with local_file_cache.get(path, storage) as local_path:
+            yield local_path
+        return
+
     _, extension = os.path.splitext(path)
     local_file_path = None
     try:
-        local_file = tempfile.NamedTemporaryFile(
+        with tempfile.NamedTemporaryFile(
             mode="wb", delete=False, suffix=extension
-        )
+        ) as local_file:
+            local_file_path = local_file.name
+            copy_storage_file(path, storage, local_file)
 
-        local_file.write(storage.open(path).read())
-        local_file.flush()
-        local_file_path = local_file.name
-        local_file.close()
-
-        yield local_file.name
+        yield local_file_path
     finally:
         if local_file_path:
             os.remove(local_file_path)
 
 
+class HashingFile(File):
+    """
+    File that computes its content hashes while storage reads it,
+    so saving the file hashes it in the same pass.
+    """
+
+    def __init__(self, file, name=None, secondary=FILINGCABINET_SECONDARY_CONTENT_HASH):
+        super().__init__(file, name=name)
+        self.secondary = secondary
+        self.hasher = None
+
+    def chunks(self, chunk_size=None):
+        hasher = ContentHasher(self.secondary)
+        for chunk in super().chunks(chunk_size=chunk_size or HASH_BUFFER_SIZE):
+            hasher.update(chunk)
+            yield chunk
+        self.hasher = hasher
+
+    def get_hasher(self) -> ContentHasher:
+        if self.hasher is None:
+            # Storage did not read the file through chunks()
+            self.seek(0)
+            self.hasher = hash_file(self.file, secondary=self.secondary)
+            self.seek(0)
+        return self.hasher
+
+
+def copy_to_temporary_file(
+    file_object, name, secondary=FILINGCABINET_SECONDARY_CONTENT_HASH
+) -> tuple[TemporaryUploadedFile, ContentHasher]:
+    """
+    Copies file_object to a temporary file while hashing it.
+    File system storage moves the temporary file into place
+    instead of reading it again.
+    """
+    temp_file = TemporaryUploadedFile(name, "application/pdf", None, None)
+    if file_object.seekable():
+        file_object.seek(0)
+    hasher = hash_file(file_object, secondary=secondary, output=temp_file)
+    temp_file.size = hasher.size
+    temp_file.seek(0)
+    return temp_file, hasher
+
+
 DirectoryDict = dict[PurePath, CollectionDirectory]
 
 
 def ensure_directory_exists(
     collection: DocumentCollection, directories: DirectoryDict, path: PurePath, user
 ) -> DirectoryDict:
+    return build_directory_tree(collection, directories, [path.parent], user)
+
+
+def get_existing_directories(collection: DocumentCollection) -> DirectoryDict:
+    """
+    Loads all directories of the collection with one query and
+    derives their name paths from the materialized tree paths.
+    """
+    dirs = list(CollectionDirectory.objects.filter(collection=collection))
+    by_tree_path = {dir.path: dir for dir in dirs}
+    steplen = CollectionDirectory.steplen
+    directories = {}
+    for dir in dirs:
+        tree_to_root = [
+            by_tree_path.get(dir.path[: depth * steplen])
+            for depth in range(1, dir.depth + 1)
+        ]
+        if None in tree_to_root:
+            # Ancestor outside of the collection
+            tree_to_root = list(dir.get_ancestors()) + [dir]
+        path = PurePath("/".join([x.name for x in tree_to_root]))
+        directories[path] = dir
+    return directories
+
+
+def build_directory_tree(
+    collection: DocumentCollection,
+    directories: DirectoryDict,
+    paths: list[PurePath],
+    user,
+) -> DirectoryDict:
+    """
+    Creates all missing directories of paths and their parents level by level.
+    New directories below existing ones get their tree paths computed in Python
+    and are inserted in bulk while their parents are locked. Where that would
+    not keep siblings in database name order, and for root directories which
+    are shared by all collections, directories are added through treebeard.
+    """
     directories = directories.copy()
+    missing = set()
+    for path in paths:
+        for dir_path in [path, *path.parents]:
+            if str(dir_path) != "." and dir_path not in directories:
+                missing.add(dir_path)
+    if not missing:
+        return directories
 
-    for parent_path in reversed(path.parents):
-        if str(parent_path) == ".":
-            continue
-        if parent_path not in directories:
-            parent_parent_path = parent_path.parent
-            parent_parent_dir = directories.get(parent_parent_path)
-            directory = CollectionDirectory(
-                name=PurePath(parent_path).name,
-                user=user,
-                collection=collection,
+    max_depth = max(len(dir_path.parts) for dir_path in missing)
+    with transaction.atomic():
+        for depth in range(1, max_depth + 1):
+            dir_paths = sorted(
+                dir_path for dir_path in missing if len(dir_path.parts) == depth
             )
-            if parent_parent_dir is None:
-                directory = CollectionDirectory.add_root(instance=directory)
+            if not dir_paths:
+                continue
+            if depth == 1:
+                directories = add_root_directories(
+                    collection, directories, dir_paths, user
+                )
             else:
-                directory = parent_parent_dir.add_child(instance=directory)
-            directories[parent_path] = directory
+                directories = add_child_directories(
+                    collection, directories, dir_paths, depth, user
+                )
+    return directories
 
+
+def add_root_directories(
+    collection: DocumentCollection,
+    directories: DirectoryDict,
+    dir_paths: list[PurePath],
+    user,
+) -> DirectoryDict:
+    existing = CollectionDirectory.objects.filter(
+        collection=collection,
+        depth=1,
+        name__in=[dir_path.name for dir_path in dir_paths],
+    ).order_by("path")
+    by_name = {}
+    for directory in existing:
+        by_name.setdefault(directory.name, directory)
+    added = False
+    for dir_path in dir_paths:
+        directory = by_name.get(dir_path.name)
+        if directory is None:
+            directory = add_root_directory(collection, dir_path.name, user)
+            added = True
+        directories[dir_path] = directory
+    if added:
+        # Sorted inserts may have moved existing directories
+        directories = get_existing_directories(collection)
     return directories
 
 
-def get_existing_directories(collection: DocumentCollection) -> DirectoryDict:
-    directories = {}
-    dirs = CollectionDirectory.objects.filter(collection=collection)
-    for dir in dirs:
-        tree_to_root = list(dir.get_ancestors()) + [dir]
-        path = PurePath("/".join([x.name for x in tree_to_root]))
-        directories[path] = dir
+def add_root_directory(
+    collection: DocumentCollection, name: str, user, attempts: int = 3
+) -> CollectionDirectory:
+    # Root paths are computed from the last root of any collection,
+    # concurrent imports may compute the same one
+    for attempt in range(attempts):
+        try:
+            with transaction.atomic():
+                return CollectionDirectory.add_root(
+                    instance=CollectionDirectory(
+                        name=name, user=user, collection=collection
+                    )
+                )
+        except IntegrityError:
+            if attempt == attempts - 1:
+                raise
+
+
+def add_child_directories(
+    collection: DocumentCollection,
+    directories: DirectoryDict,
+    dir_paths: list[PurePath],
+    depth: int,
+    user,
+) -> DirectoryDict:
+    parents = lock_directories({directories[dir_path.parent] for dir_path in dir_paths})
+    children = get_child_directories(parents, depth)
+
+    by_parent = {}
+    for dir_path in dir_paths:
+        parent = directories[dir_path.parent]
+        existing = next(
+            (child for child in children[parent.path] if child.name == dir_path.name),
+            None,
+        )
+        if existing is not None:
+            directories[dir_path] = existing
+        else:
+            by_parent.setdefault(parent.path, []).append(dir_path)
+    if not by_parent:
+        return directories
+
+    slow_parents = set()
+    while True:
+        fast_parents = {
+            parent_path: dir_paths
+            for parent_path, dir_paths in by_parent.items()
+            if parent_path not in slow_parents
+        }
+        new_dirs = []
+        changed_parents = []
+        for parent_path, dir_paths in fast_parents.items():
+            parent = parents[parent_path]
+            siblings = children[parent_path]
+            last_sibling = siblings[-1] if siblings else None
+            for dir_path in sorted(dir_paths, key=lambda dir_path: dir_path.name):
+                if last_sibling is not None:
+                    tree_path = last_sibling._inc_path()
+                else:
+                    tree_path = CollectionDirectory._get_path(parent.path, depth, 1)
+                last_sibling = CollectionDirectory(
+                    name=dir_path.name,
+                    user=user,
+                    collection=collection,
+                    path=tree_path,
+                    depth=depth,
+                    numchild=0,
+                )
+                new_dirs.append((dir_path, last_sibling))
+            parent.numchild = len(siblings) + len(dir_paths)
+            changed_parents.append(parent)
+
+        try:
+            with transaction.atomic():
+                CollectionDirectory.objects.bulk_create(
+                    [directory for _dir_path, directory in new_dirs]
+                )
+                CollectionDirectory.objects.bulk_update(changed_parents, ["numchild"])
+                unordered = get_unordered_parents(list(fast_parents), depth)
+                if unordered:
+                    # Roll back, names sort differently in the database
+                    raise UnorderedSiblings(unordered)
+        except UnorderedSiblings as e:
+            slow_parents |= e.parent_paths
+            for parent_path in e.parent_paths:
+                parents[parent_path].numchild = len(children[parent_path])
+            continue
+        break
+
+    for dir_path, directory in new_dirs:
+        directories[dir_path] = directory
+    if slow_parents:
+        for parent_path in slow_parents:
+            for dir_path in by_parent[parent_path]:
+                directories[dir_path] = parents[parent_path].add_child(
+                    instance=CollectionDirectory(
+                        name=dir_path.name, user=user, collection=collection
+                    )
+                )
+        # Sorted inserts may have moved existing directories
+        directories = get_existing_directories(collection)
     return directories
+
+
+class UnorderedSiblings(Exception):
+    def __init__(self, parent_paths: set[str]):
+        super().__init__(parent_paths)
+        self.parent_paths = parent_paths
+
+
+def lock_directories(
+    directories: set[CollectionDirectory],
+) -> dict[str, CollectionDirectory]:
+    """
+    Locks the directory rows like treebeard does when adding a child
+    and refreshes their tree paths and child counts.
+    """
+    by_id = {directory.id: directory for directory in directories}
+    locked = CollectionDirectory.objects.select_for_update().filter(id__in=by_id)
+    for directory_id, path, numchild in locked.values_list("id", "path", "numchild"):
+        by_id[directory_id].path = path
+        by_id[directory_id].numchild = numchild
+    return {directory.path: directory for directory in directories}
+
+
+def get_child_directories(
+    parents: dict[str, CollectionDirectory], depth: int
+) -> dict[str, list[CollectionDirectory]]:
+    children = {parent_path: [] for parent_path in parents}
+    for child in (
+        annotate_parent_path(CollectionDirectory.objects.all(), depth)
+        .filter(depth=depth, parent_path__in=list(parents))
+        .order_by("path")
+    ):
+        children[child.parent_path].append(child)
+    return children
+
+
+def get_unordered_parents(parent_paths: list[str], depth: int) -> set[str]:
+    """
+    Returns the parents whose children are not ordered by name
+    in the collation of the database, which treebeard relies on.
+    """
+    siblings = (
+        annotate_parent_path(CollectionDirectory.objects.all(), depth)
+        .filter(depth=depth, parent_path__in=parent_paths)
+        .order_by("parent_path", "name", "path")
+        .values_list("parent_path", "path")
+    )
+    unordered = set()
+    last_paths = {}
+    for parent_path, path in siblings:
+        if path < last_paths.get(parent_path, ""):
+            unordered.add(parent_path)
+        last_paths[parent_path] = path
+    return unordered
+
+
+def annotate_parent_path(queryset, depth: int):
+    return queryset.annotate(
+        parent_path=Substr("path", 1, CollectionDirectory.steplen * (depth - 1))
+    )
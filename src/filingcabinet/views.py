@@ -21,6 +21,8 @@ from .api_views import PageSerializer
 from .forms import get_viewer_preferences
 from .models import CollectionDirectory, CollectionDocument, DocumentPortal
 from .settings import FILINGCABINET_ENABLE_WEBP, FILINGCABINET_MEDIA_PRIVATE_INTERNAL
+from .storage import is_local_storage
+from .utils import iter_storage_file
 
 Document = get_document_model()
 DocumentCollection = get_documentcollection_model()
@@ -274,7 +276,7 @@ class DocumentCollectionZipDownloadView(AuthMixin, PkSlugMixin, DetailView):
         directory_dirname_map = {}
         filename_counter = defaultdict(int)
         for doc in coll_docs:
-            _, doc_ext = os.path.splitext(doc.document.get_file_path())
+            _, doc_ext = os.path.splitext(doc.document.get_document_filename())
             doc_filename_stem = (
                 doc.document.title.replace("/", "_").replace("\\", "_").strip()
             )
@@ -294,9 +296,10 @@ class DocumentCollectionZipDownloadView(AuthMixin, PkSlugMixin, DetailView):
                 )
             else:
                 filename = doc_filename
-            archive_stream.write(
-                doc.document.get_file_path(),
-                arcname=ensure_unique_filename(filename_counter, filename),
+            write_document_to_archive(
+                archive_stream,
+                doc.document,
+                ensure_unique_filename(filename_counter, filename),
             )
 
         resp = ZipStreamResponse(
@@ -307,6 +310,16 @@ class DocumentCollectionZipDownloadView(AuthMixin, PkSlugMixin, DetailView):
         return resp
 
 
+def write_document_to_archive(archive_stream, document, arcname):
+    file = document.get_file()
+    storage = getattr(file, "storage", None)
+    if storage is None or is_local_storage(storage):
+        archive_stream.write(document.get_file_path(), arcname=arcname)
+    else:
+        # Read lazily from remote storage while streaming the archive
+        archive_stream.write_iter(arcname, iter_storage_file(file.name, storage))
+
+
 def ensure_unique_filename(filename_counter: defaultdict, filename: str):
     if filename_counter[filename] > 0:
         original_path = Path(filename)
@@ -394,14 +407,15 @@ class DocumentPortalZipDownloadView(DocumentPortalView):
 
         filename_counter = defaultdict(int)
         for doc in documents:
-            _, doc_ext = os.path.splitext(doc.get_file_path())
+            _, doc_ext = os.path.splitext(doc.get_document_filename())
             doc_filename_stem = doc.title.replace("/", "_").replace("\\", "_").strip()
             if not doc_filename_stem:
                 doc_filename_stem = "unnamed"
             doc_filename = doc_filename_stem + doc_ext
-            archive_stream.write(
-                doc.get_file_path(),
-                arcname=ensure_unique_filename(filename_counter, doc_filename),
+            write_document_to_archive(
+                archive_stream,
+                doc,
+                ensure_unique_filename(filename_counter, doc_filename),
             )
 
         resp = ZipStreamResponse(
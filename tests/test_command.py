@@ -1,12 +1,15 @@
+import hashlib
 import json
 from io import StringIO
-from pathlib import PosixPath
+from pathlib import Path, PosixPath
 
 from django.core.management import call_command
 
 import pytest
 
 from filingcabinet import get_document_model
+from filingcabinet.api import create_document
+from filingcabinet.management.commands.import_documents import ImportManifest
 
 Document = get_document_model()
 
@@ -55,3 +58,266 @@ def test_import_command(processed_document, document_collection):
     )
     assert "Importing %s" % processed_document.pdf_file.path in out.getvalue()
     assert Document.objects.exclude(pk=processed_document.pk).count() == 1
+
+
+@pytest.mark.django_db
+def test_create_document_hashes_without_copying(settings, monkeypatch, tmp_path):
+    settings.MEDIA_ROOT = tmp_path / "media"
+    monkeypatch.setattr(
+        "filingcabinet.utils.copy_to_temporary_file",
+        lambda *args, **kwargs: pytest.fail("File copied for hashing"),
+    )
+    source = tmp_path / "source.pdf"
+    source.write_bytes(b"%PDF-1.4 test")
+    with open(source, "rb") as f:
+        doc = create_document(f, {"title": "Test"}, process=False)
+    assert Path(doc.pdf_file.path).read_bytes() == b"%PDF-1.4 test"
+    assert doc.content_hash == hashlib.sha1(b"%PDF-1.4 test").hexdigest()
+    with open(source, "rb") as f:
+        assert create_document(f, {"title": "Test"}, process=False) == doc
+    assert Document.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_import_command_in_batches(
+    processed_document, document_collection, monkeypatch, tmp_path
+):
+    queued = []
+    monkeypatch.setattr(
+        "filingcabinet.api.enqueue_document_processing",
+        lambda docs: queued.extend(doc.id for doc in docs),
+    )
+    directory = tmp_path / "import"
+    directory.mkdir()
+    pdf_bytes = Path(processed_document.pdf_file.path).read_bytes()
+    processed_document.content_hash = hashlib.sha1(pdf_bytes).hexdigest()
+    processed_document.save()
+    # Already imported
+    (directory / "existing.pdf").write_bytes(pdf_bytes)
+    for name in ("a", "b", "c"):
+        (directory / f"{name}.pdf").write_bytes(b"%PDF-1.4 " + name.encode())
+    # Duplicate of a within the same batch
+    (directory / "d.pdf").write_bytes(b"%PDF-1.4 a")
+    with open(directory / "b.json", "w") as f:
+        json.dump(
+            {"title": "B", "tags": ["tag1"], "collection": document_collection.id}, f
+        )
+
+    out = StringIO()
+    call_command(
+        "import_documents",
+        str(directory),
+        "--workers",
+        "2",
+        "--batch-size",
+        "3",
+        stdout=out,
+        stderr=StringIO(),
+    )
+
+    docs = Document.objects.exclude(pk=processed_document.pk)
+    assert docs.count() == 3
+    assert sorted(queued) == sorted(docs.values_list("id", flat=True))
+    doc_b = docs.get(title="B")
+    assert Path(doc_b.pdf_file.path).read_bytes() == b"%PDF-1.4 b"
+    assert doc_b.content_hash == hashlib.sha1(b"%PDF-1.4 b").hexdigest()
+    assert list(doc_b.tags.values_list("name", flat=True)) == ["tag1"]
+    assert doc_b.filingcabinet_collectiondocument.get().collection == (
+        document_collection
+    )
+    assert "Imported 5/5 files (3 new)" in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_import_command_recursive_with_resume(
+    document_collection, monkeypatch, settings, tmp_path
+):
+    settings.MEDIA_ROOT = tmp_path / "media"
+    monkeypatch.setattr("filingcabinet.api.enqueue_document_processing", lambda d: None)
+    directory = tmp_path / "import"
+    (directory / "sub" / "deeper").mkdir(parents=True)
+    (directory / "top.pdf").write_bytes(b"%PDF-1.4 top")
+    (directory / "sub" / "a.pdf").write_bytes(b"%PDF-1.4 a")
+    (directory / "sub" / "deeper" / "b.pdf").write_bytes(b"%PDF-1.4 b")
+    manifest = tmp_path / "manifest.jsonl"
+    args = [
+        "import_documents",
+        str(directory),
+        "--recursive",
+        "--collection",
+        str(document_collection.id),
+        "--manifest",
+        str(manifest),
+        "--batch-size",
+        "2",
+    ]
+    call_command(*args, stdout=StringIO(), stderr=StringIO())
+
+    collection_docs = {
+        cd.document.pdf_file.read(): cd
+        for cd in document_collection.filingcabinet_collectiondocument.all()
+        if cd.document.content_hash
+    }
+    assert collection_docs[b"%PDF-1.4 top"].directory is None
+    assert collection_docs[b"%PDF-1.4 a"].directory.name == "sub"
+    deeper = collection_docs[b"%PDF-1.4 b"].directory
+    assert deeper.name == "deeper"
+    assert deeper.get_parent().name == "sub"
+    entries = [json.loads(line) for line in manifest.read_text().splitlines()]
+    assert {entry["path"] for entry in entries} == {
+        "top.pdf",
+        "sub/a.pdf",
+        "sub/deeper/b.pdf",
+    }
+    assert all(entry["document"] for entry in entries)
+
+    # Changed files already in the manifest are not looked at again
+    (directory / "sub" / "a.pdf").write_bytes(b"%PDF-1.4 changed")
+    (directory / "new.pdf").write_bytes(b"%PDF-1.4 new")
+    out = StringIO()
+    call_command(*args, "--resume", stdout=out, stderr=StringIO())
+    assert "Skipping 3 already imported files" in out.getvalue()
+    hashes = set(Document.objects.values_list("content_hash", flat=True))
+    assert hashlib.sha1(b"%PDF-1.4 new").hexdigest() in hashes
+    assert hashlib.sha1(b"%PDF-1.4 changed").hexdigest() not in hashes
+    assert len(manifest.read_text().splitlines()) == 4
+
+
+@pytest.mark.django_db
+def test_import_command_links_existing_documents(
+    document_collection, document_collection_factory, monkeypatch, settings, tmp_path
+):
+    settings.MEDIA_ROOT = tmp_path / "media"
+    monkeypatch.setattr("filingcabinet.api.enqueue_document_processing", lambda d: None)
+    other_collection = document_collection_factory.create(user=document_collection.user)
+    directory = tmp_path / "import"
+    directory.mkdir()
+    (directory / "a.pdf").write_bytes(b"%PDF-1.4 a")
+    with open(directory / "a.json", "w") as f:
+        json.dump({"title": "A", "tags": ["tag1"]}, f)
+    (directory / "b.pdf").write_bytes(b"%PDF-1.4 a")
+    with open(directory / "b.json", "w") as f:
+        json.dump({"title": "B", "tags": ["tag2"]}, f)
+
+    for collection in (document_collection, other_collection):
+        call_command(
+            "import_documents",
+            str(directory),
+            "--collection",
+            str(collection.id),
+            "--batch-size",
+            "10",
+            stdout=StringIO(),
+            stderr=StringIO(),
+        )
+
+    doc = Document.objects.get(content_hash=hashlib.sha1(b"%PDF-1.4 a").hexdigest())
+    assert set(
+        doc.filingcabinet_collectiondocument.values_list("collection_id", flat=True)
+    ) == {document_collection.id, other_collection.id}
+    assert sorted(doc.tags.values_list("name", flat=True)) == ["tag1", "tag2"]
+
+
+@pytest.mark.django_db
+def test_import_command_repairs_aborted_batches(monkeypatch, settings, tmp_path):
+    settings.MEDIA_ROOT = tmp_path / "media"
+    monkeypatch.setattr("filingcabinet.api.enqueue_document_processing", lambda d: None)
+    directory = tmp_path / "import"
+    directory.mkdir()
+    (directory / "a.pdf").write_bytes(b"%PDF-1.4 a")
+    (directory / "b.pdf").write_bytes(b"%PDF-1.4 b")
+    args = ["import_documents", str(directory), "--batch-size", "10"]
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("aborted")
+
+    with monkeypatch.context() as m:
+        m.setattr(Document.objects, "bulk_update", fail)
+        with pytest.raises(RuntimeError):
+            call_command(*args, stdout=StringIO(), stderr=StringIO())
+    assert not Document.objects.exists()
+    assert not any(path.is_file() for path in settings.MEDIA_ROOT.rglob("*"))
+
+    # Documents left without file are repaired instead of skipped by hash
+    Document.objects.create(
+        title="A", content_hash=hashlib.sha1(b"%PDF-1.4 a").hexdigest()
+    )
+    call_command(*args, stdout=StringIO(), stderr=StringIO())
+    assert Document.objects.count() == 2
+    for doc in Document.objects.all():
+        assert doc.pdf_file
+        assert doc.pdf_file.read().startswith(b"%PDF-1.4 ")
+
+
+@pytest.mark.django_db
+def test_import_command_batches_portal_updates(
+    document_portal_factory, monkeypatch, settings, tmp_path
+):
+    settings.MEDIA_ROOT = tmp_path / "media"
+    queued = []
+    monkeypatch.setattr(
+        "filingcabinet.api.enqueue_document_processing",
+        lambda docs: queued.append(
+            sorted(doc.properties["foreign_id"] for doc in docs)
+        ),
+    )
+
+    def create_or_update_document(*args, **kwargs):
+        raise AssertionError("Looked up one by one")
+
+    monkeypatch.setattr(
+        "filingcabinet.management.commands.import_documents.create_or_update_document",
+        create_or_update_document,
+    )
+    portal = document_portal_factory(slug="portal")
+    directory = tmp_path / "import"
+    directory.mkdir()
+
+    def write_files(version):
+        for foreign_id in ("a", "b"):
+            (directory / f"{foreign_id}.pdf").write_bytes(
+                b"%PDF-1.4 " + f"{foreign_id} {version}".encode()
+            )
+            with open(directory / f"{foreign_id}.json", "w") as f:
+                json.dump(
+                    {
+                        "title": f"{foreign_id} {version}",
+                        "portal": "portal",
+                        "properties": {"foreign_id": foreign_id},
+                    },
+                    f,
+                )
+
+    args = ["import_documents", str(directory), "--batch-size", "10"]
+    write_files("v1")
+    call_command(*args, stdout=StringIO(), stderr=StringIO())
+    # Changed files of known foreign ids are left alone without --update
+    write_files("v2")
+    call_command(*args, stdout=StringIO(), stderr=StringIO())
+    docs = Document.objects.filter(portal=portal).order_by("title")
+    assert [doc.title for doc in docs] == ["a v1", "b v1"]
+
+    call_command(*args, "--update", stdout=StringIO(), stderr=StringIO())
+
+    docs = Document.objects.filter(portal=portal).order_by("title")
+    assert [doc.title for doc in docs] == ["a v2", "b v2"]
+    assert docs[0].pdf_file.read() == b"%PDF-1.4 a v2"
+    assert docs[0].content_hash == hashlib.sha1(b"%PDF-1.4 a v2").hexdigest()
+    assert queued == [["a", "b"], ["a", "b"]]
+
+
+def test_import_manifest_skips_invalid_lines(tmp_path, caplog):
+    path = tmp_path / "manifest.jsonl"
+    path.write_text(
+        json.dumps({"path": "a.pdf", "content_hash": "a", "document": 1})
+        + "\n"
+        + '{"path": "b.p'
+    )
+    manifest = ImportManifest(str(path))
+    assert manifest.get_imported_paths() == {"a.pdf"}
+    assert "Skipping invalid line 2" in caplog.text
+
+    manifest.open()
+    manifest.record("c.pdf", "c", 3)
+    manifest.close()
+    assert manifest.get_imported_paths() == {"a.pdf", "c.pdf"}
@@ -245,3 +245,160 @@ def test_document_api_filter_created_at(
     assert len(data["objects"]) == 3
     ids = {d["id"] for d in data["objects"]}
     assert {documents[2].id, documents[3].id, documents[4].id} == ids
+
+
+@pytest.mark.django_db
+def test_document_api_facets(client, document_factory, document_portal_factory):
+    portal = document_portal_factory.create(
+        public=True,
+        settings={
+            "filters": [
+                {
+                    "id": "publisher",
+                    "key": "data.publisher",
+                    "type": "choice",
+                    "facet": True,
+                    "label": {"en": "publisher"},
+                    "choices": [],
+                },
+                {
+                    "id": "date",
+                    "key": "created_at",
+                    "type": "daterange",
+                    "facet": True,
+                    "facet_config": {"interval": "year"},
+                    "label": {"en": "date"},
+                },
+                {
+                    "id": "tags",
+                    "key": "tag",
+                    "type": "choice",
+                    "facet": True,
+                    "label": {"en": "tags"},
+                },
+            ]
+        },
+    )
+    date = datetime(2019, 6, 1, 0, 0, 0, tzinfo=timezone.utc)
+    documents = document_factory.create_batch(
+        4, public=True, portal=portal, created_at=date
+    )
+    documents[0].data["publisher"] = "wd1"
+    documents[0].published_at = date.replace(year=2020)
+    documents[0].save()
+    documents[0].tags.add("tag1")
+    documents[1].data["publisher"] = "wd1"
+    documents[1].save()
+    documents[2].data["publisher"] = "wd2"
+    documents[2].save()
+
+    response = client.get("/api/document/?portal={}".format(portal.pk))
+    data = response.json()
+    assert response.status_code == 200
+    assert len(data["objects"]) == 4
+    facets = data["facets"]
+    assert facets["publisher"]["buckets"] == [
+        {"value": "wd1", "count": 2},
+        {"value": "wd2", "count": 1},
+    ]
+    assert [b["count"] for b in facets["date"]["buckets"]] == [3, 1]
+    assert facets["date"]["buckets"][1]["value"].startswith("2020-01-01")
+    assert facets["tags"]["buckets"] == [{"value": "tag1", "label": "tag1", "count": 1}]
+
+    # Facets count the filtered documents
+    response = client.get(
+        "/api/document/?portal={}&data.publisher=wd1".format(portal.pk)
+    )
+    facets = response.json()["facets"]
+    assert facets["publisher"]["buckets"] == [{"value": "wd1", "count": 2}]
+    assert [b["count"] for b in facets["date"]["buckets"]] == [1, 1]
+
+    response = client.get("/api/document/")
+    assert "facets" not in response.json()
+
+
+@pytest.mark.django_db
+def test_document_api_cursor_pagination(
+    client, document_factory, document_portal_factory
+):
+    portal = document_portal_factory.create(public=True)
+    date = datetime(2019, 1, 1, 0, 0, 0, tzinfo=timezone.utc)
+    documents = document_factory.create_batch(
+        7, public=True, portal=portal, published_at=date, title="same"
+    )
+    documents[0].published_at = None
+    documents[0].save()
+    documents[1].published_at = date + timedelta(days=1)
+    documents[1].save()
+
+    url = "/api/document/?portal={}&limit=50".format(portal.pk)
+    expected = [d["id"] for d in client.get(url).json()["objects"]]
+    assert expected[0] == documents[1].pk
+    assert expected[-1] == documents[0].pk
+
+    ids = []
+    url = "/api/document/?portal={}&limit=2&cursor=&count=none".format(portal.pk)
+    while url:
+        data = client.get(url).json()
+        assert data["meta"]["total_count"] is None
+        assert data["meta"]["previous"] is None
+        ids.extend(d["id"] for d in data["objects"])
+        url = data["meta"]["next"]
+    assert ids == expected
+
+    response = client.get(
+        "/api/document/?portal={}&limit=2&offset=2&count=estimate".format(portal.pk)
+    )
+    data = response.json()
+    assert data["meta"]["total_count"] == 7
+    assert [d["id"] for d in data["objects"]] == expected[2:4]
+    assert "offset=4" in data["meta"]["next"]
+
+    response = client.get("/api/document/?portal={}&cursor=xyz".format(portal.pk))
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_document_api_cursor_pagination_microseconds(
+    client, document_factory, document_portal_factory
+):
+    portal = document_portal_factory.create(public=True)
+    date = datetime(2019, 1, 1, 0, 0, 0, 123456, tzinfo=timezone.utc)
+    documents = document_factory.create_batch(
+        5, public=True, portal=portal, published_at=date, title="same"
+    )
+    documents[0].published_at = date + timedelta(microseconds=1)
+    documents[0].save()
+
+    ids = []
+    url = "/api/document/?portal={}&limit=2&cursor=".format(portal.pk)
+    while url:
+        data = client.get(url).json()
+        ids.extend(d["id"] for d in data["objects"])
+        url = data["meta"]["next"]
+    assert ids == [documents[0].pk] + sorted(d.pk for d in documents[1:])
+
+
+@pytest.mark.django_db
+def test_document_api_cursor_pagination_collection(
+    client, dummy_user, document_factory, document_collection_factory
+):
+    collection = document_collection_factory.create(user=dummy_user, public=True)
+    other_collection = document_collection_factory.create(user=dummy_user, public=True)
+    documents = document_factory.create_batch(5, user=dummy_user, public=True)
+    for i, document in enumerate(documents):
+        CollectionDocument.objects.create(
+            collection=collection, document=document, order=5 - i
+        )
+        CollectionDocument.objects.create(
+            collection=other_collection, document=document, order=i
+        )
+
+    ids = []
+    url = "/api/document/?collection={}&limit=2&cursor=".format(collection.pk)
+    while url:
+        data = client.get(url).json()
+        assert data["meta"]["total_count"] == 5
+        ids.extend(d["id"] for d in data["objects"])
+        url = data["meta"]["next"]
+    assert ids == [d.pk for d in reversed(documents)]
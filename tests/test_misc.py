@@ -1,5 +1,24 @@
+import os
 from collections import defaultdict
+from pathlib import Path, PurePath
 
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import FileSystemStorage, InMemoryStorage, Storage
+
+import pytest
+
+from filingcabinet.models import CollectionDirectory
+from filingcabinet.storage import (
+    copy_storage_object,
+    delete_storage_directory,
+    move_storage_directory,
+)
+from filingcabinet.utils import (
+    LocalFileCache,
+    build_directory_tree,
+    get_existing_directories,
+    get_local_file,
+)
 from filingcabinet.views import ensure_unique_filename
 
 
@@ -16,3 +35,191 @@ def test_ensure_unique_filename():
     assert ensure_unique_filename(filename_counter, "file-1.pdf") == "file-1-1.pdf"
     assert ensure_unique_filename(filename_counter, "file-4.pdf") == "file-4.pdf"
     assert ensure_unique_filename(filename_counter, "file.pdf") == "file-5.pdf"
+
+
+@pytest.mark.django_db
+def test_build_directory_tree(dummy_user, document_collection_factory):
+    other = document_collection_factory(user=dummy_user)
+    CollectionDirectory.add_root(
+        instance=CollectionDirectory(name="m", collection=other, user=dummy_user)
+    )
+    collection = document_collection_factory(user=dummy_user)
+    directories = build_directory_tree(
+        collection,
+        {},
+        [PurePath("x/b"), PurePath("x/a/deep"), PurePath("c")],
+        dummy_user,
+    )
+    # Inserted after existing siblings in bulk and before them one by one
+    directories = build_directory_tree(
+        collection,
+        get_existing_directories(collection),
+        [PurePath("x/0"), PurePath("x/z"), PurePath("z/y")],
+        dummy_user,
+    )
+
+    assert set(directories) == {
+        PurePath(path)
+        for path in ("c", "x", "x/0", "x/a", "x/a/deep", "x/b", "x/z", "z", "z/y")
+    }
+    assert get_existing_directories(collection) == directories
+    assert CollectionDirectory.find_problems() == ([], [], [], [], [])
+    x_children = [d.name for d in directories[PurePath("x")].get_children()]
+    assert x_children == ["0", "a", "b", "z"]
+    roots = [d.name for d in CollectionDirectory.get_root_nodes()]
+    assert roots == sorted(roots)
+    assert directories[PurePath("x")].numchild == 4
+
+
+@pytest.mark.django_db
+def test_build_directory_tree_with_stale_directories(dummy_user, document_collection):
+    first = build_directory_tree(
+        document_collection, {}, [PurePath("x/b/c")], dummy_user
+    )
+    stale = {PurePath("x"): first[PurePath("x")]}
+    # Another import created x/b after the stale directories were loaded
+    directories = build_directory_tree(
+        document_collection, stale, [PurePath("x/b/d"), PurePath("x/e")], dummy_user
+    )
+
+    assert directories[PurePath("x/b")] == first[PurePath("x/b")]
+    assert directories.items() <= get_existing_directories(document_collection).items()
+    assert CollectionDirectory.objects.filter(name="b").count() == 1
+    assert CollectionDirectory.find_problems() == ([], [], [], [], [])
+
+
+@pytest.mark.django_db
+def test_build_directory_tree_falls_back_on_database_order(
+    dummy_user, document_collection, monkeypatch
+):
+    directories = build_directory_tree(
+        document_collection, {}, [PurePath("x/a")], dummy_user
+    )
+    parent_path = directories[PurePath("x")].path
+    reported = []
+
+    def get_unordered_parents(parent_paths, depth):
+        # Pretend the database collation sorts the new names differently once
+        if reported:
+            return set()
+        reported.append(parent_paths)
+        return {parent_path}
+
+    monkeypatch.setattr(
+        "filingcabinet.utils.get_unordered_parents", get_unordered_parents
+    )
+    directories = build_directory_tree(
+        document_collection,
+        directories,
+        [PurePath("x/b"), PurePath("x/c")],
+        dummy_user,
+    )
+
+    assert reported == [[parent_path]]
+    x_children = [d.name for d in directories[PurePath("x")].get_children()]
+    assert x_children == ["a", "b", "c"]
+    assert get_existing_directories(document_collection) == directories
+    assert CollectionDirectory.find_problems() == ([], [], [], [], [])
+
+
+class RemoteStorage(Storage):
+    """
+    Storage without local paths.
+    """
+
+    def __init__(self, location):
+        self.location = location
+
+    def _open(self, name, mode="rb"):
+        return File(open(os.path.join(self.location, name), mode))
+
+    def size(self, name):
+        return os.path.getsize(os.path.join(self.location, name))
+
+    def get_modified_time(self, name):
+        return os.path.getmtime(os.path.join(self.location, name))
+
+
+def test_get_local_file_uses_local_path(tmp_path):
+    (tmp_path / "doc.pdf").write_bytes(b"pdf")
+    storage = FileSystemStorage(location=tmp_path)
+    with get_local_file("doc.pdf", storage=storage) as local_path:
+        assert local_path == str(tmp_path / "doc.pdf")
+    assert (tmp_path / "doc.pdf").exists()
+
+
+def test_get_local_file_caches_remote_files(monkeypatch, tmp_path):
+    cache = LocalFileCache(max_bytes=8)
+    monkeypatch.setattr("filingcabinet.utils.local_file_cache", cache)
+    storage = RemoteStorage(location=tmp_path)
+    (tmp_path / "a.pdf").write_bytes(b"aaaa")
+    (tmp_path / "b.pdf").write_bytes(b"bbbbbb")
+    (tmp_path / "c.pdf").write_bytes(b"cccc")
+
+    with get_local_file("a.pdf", storage=storage) as path_a:
+        assert Path(path_a).read_bytes() == b"aaaa"
+    with get_local_file("a.pdf", storage=storage) as path:
+        assert path == path_a
+    with get_local_file("b.pdf", storage=storage) as path_b:
+        assert not os.path.exists(path_a)
+        # Evicts b, which stays around while in use
+        with get_local_file("c.pdf", storage=storage):
+            pass
+        assert Path(path_b).read_bytes() == b"bbbbbb"
+    assert not os.path.exists(path_b)
+    assert len(cache.entries) == 1
+
+
+def test_move_storage_directory_on_remote_storage():
+    storage = InMemoryStorage()
+    storage.save("private/ab/doc.pdf", ContentFile(b"pdf"))
+    storage.save("private/ab/page-p1-small.png", ContentFile(b"png"))
+    storage.save("private/ab/annotations/a.gif", ContentFile(b"gif"))
+    storage.save("public/ab/stale.png", ContentFile(b"old"))
+
+    move_storage_directory(storage, "private/ab", "public/ab")
+
+    assert not storage.exists("private/ab/doc.pdf")
+    assert not storage.exists("private/ab/annotations/a.gif")
+    assert sorted(storage.listdir("public/ab")[1]) == ["doc.pdf", "page-p1-small.png"]
+    with storage.open("public/ab/annotations/a.gif") as f:
+        assert f.read() == b"gif"
+    with pytest.raises(FileNotFoundError):
+        move_storage_directory(storage, "private/ab", "public/ab")
+
+    delete_storage_directory(storage, "public/ab")
+    assert not storage.exists("public/ab/doc.pdf")
+    assert not storage.exists("public/ab/annotations/a.gif")
+
+
+def test_storage_directories_on_s3_storage(monkeypatch):
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+    from storages.backends.s3 import S3Storage
+
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with moto.mock_aws():
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="files")
+        storage = S3Storage(
+            bucket_name="files", location="media", region_name="us-east-1"
+        )
+        storage.save("private/ab/doc.pdf", ContentFile(b"pdf"))
+        storage.save("private/ab/annotations/a.gif", ContentFile(b"gif"))
+        storage.save("public/ab/stale.png", ContentFile(b"old"))
+
+        copy_storage_object(storage, "private/ab/doc.pdf", "private/cd/doc.pdf")
+        with storage.open("private/cd/doc.pdf") as f:
+            assert f.read() == b"pdf"
+        keys = {obj.key for obj in storage.bucket.objects.all()}
+        assert "media/private/cd/doc.pdf" in keys
+
+        move_storage_directory(storage, "private/ab", "public/ab")
+        assert not storage.exists("private/ab/doc.pdf")
+        assert not storage.exists("public/ab/stale.png")
+        with storage.open("public/ab/annotations/a.gif") as f:
+            assert f.read() == b"gif"
+
+        delete_storage_directory(storage, "public/ab")
+        keys = {obj.key for obj in storage.bucket.objects.all()}
+        assert keys == {"media/private/cd/doc.pdf"}
@@ -1,7 +1,10 @@
 from datetime import datetime, timedelta, timezone
 
+from django.core.management import call_command
+
 import pytest
 
+from filingcabinet import search
 from filingcabinet.models import CollectionDocument
 
 
@@ -19,6 +22,18 @@ def test_page_api(client, processed_document):
     assert len(data["objects"]) == 4
 
 
+@pytest.mark.django_db
+def test_page_api_cursor_pagination(client, processed_document):
+    numbers = []
+    url = "/api/page/?document={}&limit=3&cursor=".format(processed_document.pk)
+    while url:
+        data = client.get(url).json()
+        assert data["meta"]["total_count"] == 4
+        numbers.extend(p["number"] for p in data["objects"])
+        url = data["meta"]["next"]
+    assert numbers == [1, 2, 3, 4]
+
+
 @pytest.mark.django_db
 def test_page_api_filter_q(client, processed_document):
     page = processed_document.pages.all()[0]
@@ -33,6 +48,57 @@ def test_page_api_filter_q(client, processed_document):
     assert data["objects"][0]["number"] == page.number
 
 
+@pytest.mark.django_db
+def test_page_api_filter_q_with_fts5_index(client, processed_document, monkeypatch):
+    monkeypatch.setattr(search, "FILINGCABINET_SEARCH_BACKEND", "sqlite")
+    pages = list(processed_document.pages.all())
+    pages[0].content = "Vertrag mit Nebenabrede zum Vertrag"
+    pages[2].content = "Der Vertrag wurde nach langen Verhandlungen unterschrieben"
+    for page in pages[0], pages[2]:
+        page.save()
+    call_command("rebuild_search_index", stdout=None)
+
+    response = client.get(
+        "/api/page/?document={}&q=vertrag".format(processed_document.pk)
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert [page["number"] for page in data["objects"]] == [1, 3]
+    assert "<em>Vertrag</em>" in data["objects"][0]["query_highlight"]
+
+    # Query syntax is not interpreted
+    response = client.get(
+        "/api/page/?document={}&q=vertrag%20AND%20(".format(processed_document.pk)
+    )
+    assert response.status_code == 200
+    assert response.json()["objects"] == []
+
+
+@pytest.mark.django_db
+def test_page_api_search_snippets(client, processed_document):
+    page = processed_document.pages.all()[0]
+    words = ["word{}".format(i) for i in range(100)]
+    words[10] = "<b>search</b>"
+    words[80] = "Search"
+    page.content = " ".join(words)
+    page.save()
+
+    response = client.get(
+        "/api/page/?document={}&q=search&fields=number,query_highlight".format(
+            processed_document.pk
+        )
+    )
+    assert response.status_code == 200
+    result = response.json()["objects"][0]
+    assert set(result) == {"number", "query_highlight"}
+    fragments = result["query_highlight"].split(" … ")
+    assert len(fragments) == 2
+    assert "&lt;b&gt;<em>search</em>&lt;/b&gt;" in fragments[0]
+    assert "<em>Search</em>" in fragments[1]
+    assert fragments[0].startswith("word4 ")
+    assert "word50" not in result["query_highlight"]
+
+
 @pytest.mark.django_db
 def test_page_api_filter_number(client, processed_document):
     response = client.get(
@@ -354,3 +420,21 @@ def test_page_api_filter_created_at(
     )
     data = response.json()
     assert len(data["objects"]) == processed_document.num_pages + document.num_pages
+
+
+@pytest.mark.django_db
+def test_page_api_search_alias(client, processed_document):
+    page = processed_document.pages.all()[0]
+    page.content = "test search test"
+    page.save()
+    response = client.get(
+        "/api/page/?document={}&search=search".format(processed_document.pk)
+    )
+    assert response.status_code == 200
+    assert [p["number"] for p in response.json()["objects"]] == [page.number]
+
+    response = client.get(
+        "/api/page/?document={}&search=search&format=rss".format(processed_document.pk)
+    )
+    assert response.status_code == 200
+    assert "(p. {})".format(page.number) in response.content.decode("utf-8")
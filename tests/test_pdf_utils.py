@@ -0,0 +1,255 @@
+import hashlib
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image as PILImage
+from pypdf import PdfReader, PdfWriter
+from pypdf.annotations import FreeText
+
+from filingcabinet import pdf_utils
+from filingcabinet.pdf_utils import get_images_from_pdf, get_page_batches
+
+
+def make_reader(sizes):
+    return SimpleNamespace(
+        pages=[
+            SimpleNamespace(cropbox=SimpleNamespace(width=width, height=height))
+            for width, height in sizes
+        ]
+    )
+
+
+A4_SIZE = (595, 842)
+A3_SIZE = (842, 1191)
+
+
+def test_page_batches_split_on_gaps_dpi_and_size():
+    reader = make_reader([A4_SIZE] * 4 + [A3_SIZE] + [A4_SIZE] * 5)
+    batches = list(
+        get_page_batches(
+            reader, [1, 2, 3, 5, 6, 7, 8, 9, 10], 300, pdf_utils.MAX_HEIGHT_A4, 3
+        )
+    )
+    assert [pages for _dpi, pages in batches] == [
+        [1, 2, 3],
+        [5],
+        [6, 7, 8],
+        [9, 10],
+    ]
+    assert batches[1][0] < batches[0][0]
+
+
+def test_batched_images_fall_back_to_single_pages(monkeypatch, tmp_path):
+    reader = make_reader([A4_SIZE] * 3)
+
+    def pages_to_png(**kwargs):
+        assert (kwargs["first"], kwargs["last"]) == (1, 3)
+        assert kwargs["timeout"] == 3 * 60
+        return {1: "image-1.png", 3: "image-3.png"}
+
+    def get_single_images_from_pdf(pdf_reader, filename, pages, **kwargs):
+        for page in pages:
+            yield (page, "single-{}.png".format(page))
+
+    monkeypatch.setattr(pdf_utils, "pages_to_png", pages_to_png)
+    monkeypatch.setattr(
+        pdf_utils, "get_single_images_from_pdf", get_single_images_from_pdf
+    )
+    images = list(
+        get_images_from_pdf(reader, tmp_path, [1, 2, 3], timeout=60, batch_size=10)
+    )
+    assert images == [(1, "image-1.png"), (2, "single-2.png"), (3, "image-3.png")]
+
+
+def test_rasterizer_selection():
+    assert pdf_utils.get_rasterizer_class() is pdf_utils.PdftoppmRasterizer
+    assert pdf_utils.get_rasterizer_class("pdfium") is pdf_utils.PdfiumRasterizer
+    with pytest.raises(ValueError):
+        pdf_utils.get_rasterizer_class("unknown")
+
+
+def test_write_page_images(tmp_path):
+    source = tmp_path / "source.png"
+    PILImage.new("RGB", (1400, 2000), "white").save(source)
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+
+    image_files = pdf_utils.write_page_images(
+        pdf_utils.PageImage(3, filename=source),
+        (("large", 1000), ("small", 180)),
+        output_dir,
+    )
+
+    assert not source.exists()
+    assert set(image_files) == {"original", "large", "small"}
+    with PILImage.open(image_files["original"]) as img:
+        assert img.size == (1400, 2000)
+    with PILImage.open(image_files["small"]) as img:
+        assert img.size == (180, 257)
+
+
+def test_pdf_processor_cache_eviction():
+    cache = pdf_utils.PDFProcessorCache(max_entries=2, max_bytes=100)
+    cache.set("a", "pdf-a", 40)
+    cache.set("b", "pdf-b", 40)
+    assert cache.get("a") == "pdf-a"
+    # Exceeds the size bound, evicts least recently used b
+    cache.set("c", "pdf-c", 50)
+    assert cache.get("b") is None
+    assert cache.get("a") == "pdf-a"
+    # Exceeds the entry bound, evicts c
+    cache.set("d", "pdf-d", 1)
+    assert cache.get("c") is None
+    assert len(cache) == 2
+    # Too large to be cached at all
+    cache.set("e", "pdf-e", 101)
+    assert cache.get("e") is None
+
+
+def test_readable_pdf_reports_repairs(monkeypatch, tmp_path):
+    attempts = []
+
+    def try_reading_pdf(pdf_file, password=None):
+        attempts.append(pdf_file)
+        if len(attempts) == 1:
+            raise pdf_utils.PDFException(None, "rewrite")
+        return "reader"
+
+    monkeypatch.setattr(pdf_utils, "try_reading_pdf", try_reading_pdf)
+    monkeypatch.setattr(pdf_utils, "rewrite_pdf_in_place", lambda f, **kw: None)
+    monkeypatch.setattr(pdf_utils, "rewrite_hard_pdf_in_place", lambda f, **kw: f)
+    copy_path = tmp_path / "copy.pdf"
+
+    pdf_file, reader, repairs = pdf_utils.get_readable_pdf(
+        tmp_path / "broken.pdf", lambda f: copy_path
+    )
+
+    assert pdf_file == copy_path
+    assert reader == "reader"
+    assert repairs == ["rewrite_hard"]
+
+
+def test_pdftotext_extracts_page_ranges(monkeypatch, tmp_path):
+    calls = []
+
+    def shell_call(command, outpath, output_file=None, timeout=50):
+        calls.append(command)
+        return "one\fzwei\f".encode("utf-8")
+
+    monkeypatch.setattr(pdf_utils, "shell_call", shell_call)
+    extractor = pdf_utils.PdftotextTextExtractor(
+        make_reader([A4_SIZE] * 3), tmp_path / "doc.pdf", batch_size=2
+    )
+    assert extractor.get_text_for_page(1) == "one"
+    assert extractor.get_text_for_page(2) == "zwei"
+    assert len(calls) == 1
+    assert calls[0][calls[0].index("-f") + 1] == "1"
+    assert calls[0][calls[0].index("-l") + 1] == "2"
+    # Next range is only clamped to the page count
+    extractor.get_text_for_page(3)
+    assert calls[1][calls[1].index("-l") + 1] == "3"
+
+
+def test_worker_pdf_extracts_text_of_single_pages(settings, monkeypatch):
+    calls = []
+
+    def pages_to_text(filename, first, last, timeout):
+        calls.append((first, last))
+        return {first: "text"}
+
+    monkeypatch.setattr(pdf_utils, "pages_to_text", pages_to_text)
+    filename = settings.TEST_DATA_ROOT / "example-doc" / "example.pdf"
+    config = {"TEXT_EXTRACTOR": "pdftotext"}
+    pdf = pdf_utils.get_worker_pdf(filename, "de", config)
+    assert pdf_utils.get_worker_pdf(filename, "de", config) is pdf
+    assert pdf.get_text_extractor().get_text_for_page(2) == "text"
+    assert calls == [(2, 2)]
+
+
+def test_text_extractor_selection():
+    assert pdf_utils.get_text_extractor_class() is pdf_utils.PypdfTextExtractor
+    assert (
+        pdf_utils.get_text_extractor_class("pdftotext")
+        is pdf_utils.PdftotextTextExtractor
+    )
+    with pytest.raises(ValueError):
+        pdf_utils.get_text_extractor_class("unknown")
+
+
+def test_tesserocr_api_is_reused(monkeypatch):
+    created = []
+
+    class FakeAPI:
+        def __init__(self, lang, path=None):
+            created.append((lang, path))
+
+        def SetImage(self, image):
+            self.image = image
+
+        def GetUTF8Text(self):
+            return "text"
+
+        def Clear(self):
+            pass
+
+    monkeypatch.setattr(pdf_utils, "tesserocr", SimpleNamespace(PyTessBaseAPI=FakeAPI))
+    monkeypatch.setattr(pdf_utils, "_tesseract_apis", pdf_utils.threading.local())
+    image = PILImage.new("RGB", (10, 10))
+    for _i in range(3):
+        engine = pdf_utils.TesserocrOCREngine(language="de", data_path="/tessdata")
+        assert engine.image_to_string(image) == "text"
+    pdf_utils.TesserocrOCREngine(language="en").image_to_string(image)
+    assert created == [("deu", "/tessdata"), ("eng", None)]
+
+
+def test_hash_file_in_large_buffers_with_secondary_hash():
+    data = bytes(range(256)) * 5000
+    output = BytesIO()
+    hasher = pdf_utils.hash_file(
+        BytesIO(data), secondary="blake2b", output=output, buffer_size=4096
+    )
+    assert hasher.hexdigest() == hashlib.sha1(data).hexdigest()
+    assert hasher.size == len(data)
+    assert output.getvalue() == data
+    assert hasher.get_properties() == {
+        "_content_hash_blake2b": hashlib.blake2b(data).hexdigest()
+    }
+
+
+def test_page_content_hash_covers_annotations():
+    writer = PdfWriter()
+    for _ in range(4):
+        writer.add_blank_page(width=A4_SIZE[0], height=A4_SIZE[1])
+    for page_index, text in ((1, "Approved"), (2, "Rejected"), (3, "Approved")):
+        writer.add_annotation(page_index, FreeText(text=text, rect=(50, 550, 200, 650)))
+    output = BytesIO()
+    writer.write(output)
+    output.seek(0)
+    pages = PdfReader(output).pages
+
+    hashes = [pdf_utils.get_page_content_hash(page) for page in pages]
+    assert len({hashes[0], hashes[1], hashes[2]}) == 3
+    # Same annotation on another page
+    assert hashes[3] == hashes[1]
+
+
+def test_page_image_keeps_wand_compatibility(monkeypatch):
+    image = PILImage.new("RGB", (20, 10), "white")
+    page_image = pdf_utils.PageImage(1, image=image)
+    wand_image = SimpleNamespace(
+        width=20, make_blob=lambda format: page_image_bytes(image)
+    )
+    monkeypatch.setattr(pdf_utils.PageImage, "as_wand", lambda self: wand_image)
+
+    with pytest.warns(DeprecationWarning):
+        assert page_image.width == 20
+    assert pdf_utils.get_pil_image(page_image) is image
+    assert pdf_utils.get_pil_image(image) is image
+    assert pdf_utils.get_pil_image(wand_image).size == (20, 10)
+
+
+def page_image_bytes(image):
+    output = BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
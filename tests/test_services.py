@@ -1,17 +1,30 @@
+import hashlib
+import os
 import zipfile
 from io import BytesIO
-from pathlib import PurePath
+from pathlib import Path, PurePath
+from types import SimpleNamespace
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import InMemoryStorage
+from django.db import connection
 
 import pytest
+from PIL import Image as PILImage
+from pypdf import PdfReader
 
-from filingcabinet import services
-from filingcabinet.models import CollectionDocument
+from filingcabinet import get_document_model, pdf_utils, search, services, tasks
+from filingcabinet.api import PreparedFile, create_documents_in_bulk
+from filingcabinet.models import CollectionDocument, Page, SearchIndexUpdate
+from filingcabinet.pdf_utils import PageImage
 from filingcabinet.services import (
     DocumentStorer,
     detect_tables_on_doc,
     remove_common_root_path,
 )
 
+Document = get_document_model()
+
 
 def test_common_root_detection():
     paths = [
@@ -47,9 +60,9 @@ def test_zip_unpacking(dummy_user, document_collection_factory, settings, tmp_pa
     zfh = zipfile.ZipFile(fh, "w")
     zfh.writestr("foo/somefile.txt", "test")
     zfh.writestr("bar/somefile.txt", "test")
-    zfh.writestr("foo/bar/1_somefile.pdf", b"pdf")
-    zfh.writestr("foo/bar/baz/2_otherfile.pdf", b"pdf")
-    zfh.writestr("foo/bar/baz/boo/3_otherfile.pdf", b"pdf")
+    zfh.writestr("foo/bar/1_somefile.pdf", b"pdf1")
+    zfh.writestr("foo/bar/baz/2_otherfile.pdf", b"pdf2")
+    zfh.writestr("foo/bar/baz/boo/3_otherfile.pdf", b"pdf3")
     zfh.close()
     fh.seek(0)
     collection = document_collection_factory()
@@ -71,6 +84,46 @@ def test_zip_unpacking(dummy_user, document_collection_factory, settings, tmp_pa
     assert col_docs[2].directory.get_parent().name == "baz"
 
 
+@pytest.mark.django_db
+def test_zip_unpacking_nested_and_deduplicated(
+    dummy_user, document_collection_factory, settings, tmp_path
+):
+    settings.MEDIA_ROOT = tmp_path / "media"
+    nested = BytesIO()
+    with zipfile.ZipFile(nested, "w") as zfh:
+        zfh.writestr("inner.pdf", b"inner")
+        zfh.writestr("copy.pdf", b"outer")
+    zip_path = tmp_path / "upload.zip"
+    with zipfile.ZipFile(zip_path, "w") as zfh:
+        zfh.writestr("top/outer.pdf", b"outer")
+        zfh.writestr("top/archive.zip", nested.getvalue())
+    collection = document_collection_factory()
+    storer = DocumentStorer(dummy_user, collection=collection, tags=["tag1"])
+
+    with open(zip_path, "rb") as f:
+        storer.unpack_upload_zip(SimpleNamespace(get_file=lambda: f))
+
+    # Zip file staged in storage for the task is deleted afterwards
+    zip_dir = (
+        settings.MEDIA_ROOT
+        / settings.FILINGCABINET_MEDIA_PRIVATE_PREFIX
+        / services.ZIP_UPLOAD_DIRECTORY
+    )
+    assert not list(zip_dir.iterdir())
+
+    col_docs = {
+        col_doc.document.title: col_doc
+        for col_doc in CollectionDocument.objects.filter(collection=collection)
+    }
+    assert set(col_docs) == {"outer.pdf", "inner.pdf"}
+    assert col_docs["outer.pdf"].directory is None
+    assert col_docs["inner.pdf"].directory.name == "archive"
+    inner_doc = col_docs["inner.pdf"].document
+    assert Path(inner_doc.pdf_file.path).read_bytes() == b"inner"
+    assert inner_doc.content_hash == hashlib.sha1(b"inner").hexdigest()
+    assert inner_doc.tags.filter(name="tag1").exists()
+
+
 @pytest.mark.django_db
 @pytest.mark.slow
 def test_processing_document(processed_document):
@@ -89,3 +142,481 @@ def test_processing_document(processed_document):
     assert not processed_document.pending
     assert processed_document.pages.count() == 4
     assert processed_document.num_pages == 4
+
+
+@pytest.mark.django_db
+def test_make_thumbnails_moves_original(processed_document, tmp_path):
+    image_path = tmp_path / "image-1.png"
+    PILImage.new("RGB", (2000, 2800), "white").save(image_path)
+    page = processed_document.pages.get(number=1)
+
+    services.make_thumbnails(page, PageImage(1, filename=image_path))
+
+    assert not image_path.exists()
+    with PILImage.open(page.image.path) as img:
+        assert img.size == (2000, 2800)
+    for size_name, width in Page.SIZES:
+        with PILImage.open(getattr(page, "image_%s" % size_name).path) as img:
+            assert img.size == (width, round(width * 1.4))
+
+
+@pytest.mark.django_db
+def test_queue_missing_pages_fanout(processed_document, monkeypatch):
+    chunks = []
+
+    def process_pages(doc, page_numbers=None, task_page_limit=None, requeue=True):
+        assert not requeue
+        chunks.append(page_numbers)
+        doc.pages.filter(number__in=page_numbers).update(pending=False)
+
+    monkeypatch.setattr(services, "FILINGCABINET_PAGE_PROCESSING_FANOUT", True)
+    monkeypatch.setattr(services, "FILINGCABINET_PAGE_TASK_TARGET_DURATION", 40)
+    monkeypatch.setattr(services, "process_pages", process_pages)
+    processed_document.pages.update(pending=True)
+    processed_document.pending = True
+    processed_document.save()
+
+    services.queue_missing_pages(processed_document)
+
+    assert chunks == [[1, 2, 3], [4]]
+    processed_document.refresh_from_db()
+    assert not processed_document.pending
+
+
+def test_page_chunks_follow_page_costs(monkeypatch):
+    monkeypatch.setattr(services, "FILINGCABINET_PAGE_TASK_TARGET_DURATION", 70)
+
+    costed = []
+
+    class FakePDF:
+        def get_page_costs(self, pages):
+            costed.extend(pages)
+            return {page: 6 if page in (3, 4) else 1 for page in pages}
+
+    doc = Document(properties={services.PAGE_TIMING_KEY: {"seconds_per_cost": 10}})
+    chunks = services.get_page_chunks(doc, FakePDF(), [1, 2, 3, 4, 5, 6])
+    assert chunks == [([1, 2], 20), ([3], 60), ([4, 5], 70), ([6], 10)]
+    costed.clear()
+    chunks = services.get_page_chunks(doc, FakePDF(), [1, 2, 3, 4, 5, 6], max_chunks=1)
+    assert chunks == [([1, 2], 20)]
+    # Estimation stops once the first chunk is full
+    assert costed == [1, 2, 3]
+    assert services.get_chunk_time_limit(80) == 240 + 60
+    assert services.get_chunk_time_limit(200) == 400 + 60
+
+
+@pytest.mark.django_db
+def test_record_page_timing_smooths_stored_timing(processed_document):
+    class FakePDF:
+        def get_page_costs(self, pages):
+            return dict.fromkeys(pages, 2)
+
+    services.record_page_timing(processed_document, FakePDF(), [1, 2], 8)
+    stale = Document.objects.get(pk=processed_document.pk)
+    services.record_page_timing(processed_document, FakePDF(), [3], 6)
+    # Starts from the stored timing, not from the stale instance
+    services.record_page_timing(stale, FakePDF(), [4], 2)
+
+    processed_document.refresh_from_db()
+    timing = processed_document.properties[services.PAGE_TIMING_KEY]
+    assert timing == {"seconds_per_cost": 1.75}
+
+
+@pytest.mark.django_db
+def test_pdf_processor_is_cached_until_file_changes(processed_document):
+    services.pdf_processor_cache.clear()
+    path = Path(processed_document.get_file_path())
+    pdf = services.get_pdf_processor(processed_document, path)
+    assert services.get_pdf_processor(processed_document, path) is pdf
+
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert services.get_pdf_processor(processed_document, path) is not pdf
+
+
+@pytest.mark.django_db
+def test_save_pages_bulk_writes_existing_and_new(processed_document):
+    Page.objects.filter(document=processed_document, number=4).delete()
+    pages = services.get_chunk_pages(processed_document, [1, 4])
+    assert pages[4].pk is None
+    pages[1].content = "updated"
+    pages[4].content = "new"
+    pages[4].pending = False
+
+    services.save_pages([pages[1], pages[4]])
+
+    assert Page.objects.get(document=processed_document, number=1).content == (
+        "updated"
+    )
+    new_page = Page.objects.get(document=processed_document, number=4)
+    assert new_page.content == "new"
+    assert not new_page.pending
+
+
+@pytest.mark.django_db
+def test_process_pages_saves_in_batches(processed_document, monkeypatch):
+    def get_images(self, pages=None, timeout=None):
+        for page_number in pages:
+            if page_number == 4:
+                raise TimeoutError("time limit")
+            yield page_number, None
+
+    def process_page(doc, pdf, page_number, image, page=None, save=True):
+        page.content = "processed"
+        page.pending = False
+        return page
+
+    monkeypatch.setattr(services, "FILINGCABINET_PAGE_DEDUPLICATION", False)
+    monkeypatch.setattr(services, "FILINGCABINET_PAGE_PROCESSING_WORKERS", 1)
+    monkeypatch.setattr(services, "FILINGCABINET_PAGE_SAVE_BATCH_SIZE", 2)
+    monkeypatch.setattr(services.PDFProcessor, "get_images", get_images)
+    monkeypatch.setattr(services, "process_page", process_page)
+    processed_document.pages.update(pending=True)
+
+    with pytest.raises(TimeoutError):
+        services.process_pages(processed_document, [1, 2, 3, 4])
+
+    # First full batch is kept although the chunk was aborted
+    assert set(
+        processed_document.pages.filter(pending=False).values_list("number", flat=True)
+    ) == {1, 2}
+
+
+@pytest.mark.django_db
+def test_duplicate_pages_are_reused(
+    processed_document, document_factory, monkeypatch, tmp_path
+):
+    pdf = services.get_pdf_processor(
+        processed_document, processed_document.get_file_path()
+    )
+    for number, content_hash in pdf.get_page_hashes([1, 2, 3, 4]).items():
+        Page.objects.filter(document=processed_document, number=number).update(
+            content=f"text {number}", content_hash=content_hash
+        )
+    upload_path = tmp_path / "upload" / "copy.pdf"
+    upload_path.parent.mkdir()
+    upload_path.write_bytes(Path(processed_document.get_file_path()).read_bytes())
+    doc = document_factory(
+        pdf_file="upload/copy.pdf",
+        num_pages=4,
+        language=processed_document.language,
+        pending=True,
+    )
+
+    def get_images(*args, **kwargs):
+        assert not kwargs["pages"]
+        return []
+
+    monkeypatch.setattr(services.PDFProcessor, "get_images", get_images)
+    services.process_pages(doc)
+
+    pages = list(Page.objects.filter(document=doc))
+    assert [page.content for page in pages] == ["text 1", "text 2", "text 3", "text 4"]
+    assert all(not page.pending and page.content_hash for page in pages)
+    assert Path(pages[0].image_small.path).exists()
+    assert (
+        pages[0].image_small.path
+        != processed_document.pages.get(number=1).image_small.path
+    )
+    doc.refresh_from_db()
+    assert not doc.pending
+    assert doc.properties[services.PAGE_DEDUPLICATION_KEY] == {
+        "pages": 4,
+        "reused": 4,
+        "hit_rate": 1.0,
+    }
+
+
+@pytest.mark.django_db
+def test_document_without_text_layer_is_ocred_once(processed_document, monkeypatch):
+    pdf_path = Path(processed_document.get_file_path())
+    ocred_bytes = pdf_path.read_bytes() + b"\n% ocred\n"
+    ocr_calls = []
+
+    def run_ocr(filename, language=None, timeout=50, jobs=None, output_path=None):
+        ocr_calls.append((str(filename), language, jobs))
+        Path(output_path).write_bytes(ocred_bytes)
+        return output_path
+
+    monkeypatch.setattr(services, "FILINGCABINET_OCR_DOCUMENT", True)
+    monkeypatch.setattr(services, "FILINGCABINET_OCR_JOBS", 3)
+    monkeypatch.setattr(services, "run_ocr", run_ocr)
+    monkeypatch.setattr(services.PDFProcessor, "has_text_layer", lambda self: False)
+    queued = []
+    monkeypatch.setattr(
+        services, "queue_missing_pages", lambda doc, pdf=None: queued.append(doc.id)
+    )
+
+    services.process_document(processed_document)
+
+    assert ocr_calls == [(str(pdf_path), "de", 3)]
+    assert pdf_path.read_bytes() == ocred_bytes
+    assert queued == [processed_document.id]
+    processed_document.refresh_from_db()
+    assert processed_document.properties[services.OCR_DOCUMENT_KEY]["status"] == "done"
+
+
+@pytest.mark.django_db
+def test_ocr_keeps_original_file(processed_document, monkeypatch):
+    original_file = processed_document.pdf_file
+    original_path = Path(original_file.path)
+    original_bytes = original_path.read_bytes()
+    ocred_bytes = original_bytes + b"\n% ocred\n"
+    processed_document.original_id = 1
+    processed_document.original = SimpleNamespace(
+        get_file=lambda: original_file,
+        get_file_path=lambda: str(original_path),
+    )
+    processed_document.pdf_file = ""
+
+    def run_ocr(filename, output_path=None, **kwargs):
+        Path(output_path).write_bytes(ocred_bytes)
+        return output_path
+
+    monkeypatch.setattr(services, "run_ocr", run_ocr)
+    monkeypatch.setattr(services, "process_document", lambda doc: None)
+
+    services.ocr_document(processed_document)
+
+    assert original_path.read_bytes() == original_bytes
+    assert processed_document.pdf_file
+    assert Path(processed_document.pdf_file.path) != original_path
+    assert Path(processed_document.pdf_file.path).read_bytes() == ocred_bytes
+    assert list(original_path.parent.glob("tmp*.pdf")) == []
+
+
+@pytest.mark.django_db
+def test_storer_hashes_file_while_saving(dummy_user, settings, tmp_path):
+    settings.MEDIA_ROOT = tmp_path
+    data = b"%PDF-1.4 not really a pdf"
+    storer = DocumentStorer(dummy_user)
+    doc = storer.create_from_file(BytesIO(data), "upload.pdf")
+    doc.refresh_from_db()
+    assert doc.content_hash == hashlib.sha1(data).hexdigest()
+    assert Path(doc.pdf_file.path).read_bytes() == data
+
+
+@pytest.mark.django_db
+def test_publish_moves_document_directory(processed_document, settings, tmp_path):
+    public_dir = Path(processed_document.pdf_file.path).parent
+
+    tasks.publish_document(processed_document.pk, public=False)
+
+    processed_document.refresh_from_db()
+    assert not processed_document.public
+    assert processed_document.pdf_file.name.startswith(
+        settings.FILINGCABINET_MEDIA_PRIVATE_PREFIX
+    )
+    assert Path(processed_document.pdf_file.path).exists()
+    assert not public_dir.exists()
+
+
+@pytest.mark.django_db
+def test_page_images_are_uploaded_to_remote_storage(
+    processed_document, monkeypatch, tmp_path
+):
+    storage = InMemoryStorage()
+    for field_name in ("image", "image_large", "image_normal", "image_small"):
+        monkeypatch.setattr(Page._meta.get_field(field_name), "storage", storage)
+    image_files = {}
+    for size_name, width in (("original", 2000),) + Page.SIZES:
+        image_files[size_name] = tmp_path / "{}.png".format(size_name)
+        PILImage.new("RGB", (width, 10), "white").save(image_files[size_name])
+    page = Page(document=processed_document, number=5)
+
+    services.store_page_images(page, image_files)
+
+    with storage.open(page.image.name) as f, PILImage.open(f) as img:
+        assert img.size == (2000, 10)
+    for size_name, width in Page.SIZES:
+        field_file = getattr(page, "image_%s" % size_name)
+        with storage.open(field_file.name) as f, PILImage.open(f) as img:
+            assert img.size == (width, 10)
+
+
+@pytest.mark.django_db
+def test_search_index_updates_are_queued_and_drained(processed_document, monkeypatch):
+    monkeypatch.setattr(search, "FILINGCABINET_SEARCH_BACKEND", "sqlite")
+    backend = search.get_search_backend()
+    pages = services.get_chunk_pages(processed_document, [1, 2])
+    pages[1].content = "Haushaltsplan"
+    pages[2].content = "Haushaltsplan Entwurf"
+    services.save_pages([pages[1], pages[2]])
+    # Corrected text edited later, queued only once
+    pages[2].content = "Entwurf"
+    pages[2].corrected = True
+    pages[2].save()
+    assert SearchIndexUpdate.objects.count() == 2
+
+    assert search.update_search_index(batch_size=1) == 2
+    assert not SearchIndexUpdate.objects.exists()
+    found = backend.search(Page.objects.all(), "haushaltsplan")
+    assert [page.number for page in found] == [1]
+
+    # Saves without text changes are not queued
+    pages[2].save()
+    page = Page.objects.get(pk=pages[1].pk)
+    page.width = 100
+    page.save()
+    Page.objects.defer("content").get(pk=pages[1].pk).save()
+    tasks.publish_document(processed_document.pk, public=False)
+    assert not SearchIndexUpdate.objects.exists()
+    page.content = "Haushalt"
+    page.save()
+    assert list(SearchIndexUpdate.objects.values_list("page_id", flat=True)) == [
+        page.pk
+    ]
+    search.update_search_index()
+
+    page_id = pages[1].pk
+    pages[1].delete()
+    search.queue_page_index([page_id])
+    search.update_search_index()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT COUNT(*) FROM {} WHERE rowid = %s".format(
+                search.SQLITE_SEARCH_TABLE
+            ),
+            [page_id],
+        )
+        assert cursor.fetchone() == (0,)
+
+
+@pytest.mark.django_db
+def test_language_change_queues_document_pages(processed_document, monkeypatch):
+    monkeypatch.setattr(search, "FILINGCABINET_SEARCH_BACKEND", "sqlite")
+    services.get_chunk_pages(processed_document, [1, 2])
+    SearchIndexUpdate.objects.all().delete()
+    page_ids = set(processed_document.pages.values_list("id", flat=True))
+
+    doc = Document.objects.get(pk=processed_document.pk)
+    doc.title = "Changed"
+    doc.save()
+    assert not SearchIndexUpdate.objects.exists()
+    doc.language = "en"
+    doc.save(update_fields=["language"])
+    assert set(SearchIndexUpdate.objects.values_list("page_id", flat=True)) == (
+        page_ids
+    )
+
+    # Bulk updates of imports skip Document.save
+    SearchIndexUpdate.objects.all().delete()
+    doc.content_hash = "abc"
+    doc.save()
+    prepared = PreparedFile(
+        ContentFile(b"%PDF-1.4", name="doc.pdf"),
+        {"title": "Updated", "language": "de"},
+        "abc",
+        {},
+    )
+    create_documents_in_bulk([prepared], process=False, update=True)
+    assert Document.objects.get(pk=doc.pk).language == "de"
+    assert set(SearchIndexUpdate.objects.values_list("page_id", flat=True)) == (
+        page_ids
+    )
+
+
+def test_page_pool_is_kept_across_chunks():
+    services.shutdown_page_pool()
+    pool = services.get_page_pool(2)
+    try:
+        assert services.get_page_pool(2) is pool
+        other_pool = services.get_page_pool(3)
+        assert other_pool is not pool
+    finally:
+        services.shutdown_page_pool()
+    assert services._page_pool is None
+
+
+def test_page_pool_renders_pages(settings, tmp_path):
+    filename = settings.TEST_DATA_ROOT / "example-doc" / "example.pdf"
+    config = {"RASTERIZER": "pdfium"}
+    services.shutdown_page_pool()
+    try:
+        future = services.get_page_pool(2).submit(
+            services.render_page_in_worker,
+            filename,
+            "de",
+            config,
+            1,
+            Page.SIZES,
+            str(tmp_path),
+            True,
+            60,
+        )
+        rendered = future.result(timeout=120)
+    finally:
+        services.shutdown_page_pool()
+
+    assert rendered.number == 1
+    assert rendered.text
+    assert set(rendered.image_files) == {"original"} | {
+        size_name for size_name, _width in Page.SIZES
+    }
+    with PILImage.open(rendered.image_files["original"]) as img:
+        assert img.size == (rendered.width, rendered.height)
+
+
+@pytest.mark.django_db
+def test_pages_are_processed_sequentially_without_page_workers(
+    processed_document, monkeypatch
+):
+    class DaemonicExecutor:
+        def submit(self, *args):
+            raise AssertionError("daemonic processes are not allowed to have children")
+
+    sequential = []
+
+    def process_pages_sequential(doc, pdf, pages, timeout):
+        sequential.append(sorted(pages))
+        yield from []
+
+    monkeypatch.setattr(services, "get_page_pool", lambda workers: DaemonicExecutor())
+    monkeypatch.setattr(services, "process_pages_sequential", process_pages_sequential)
+    pages = services.get_chunk_pages(processed_document, [1, 2])
+    pdf = SimpleNamespace(filename="doc.pdf", language="de", config={})
+
+    result = services.process_pages_parallel(
+        processed_document, pdf, pages, workers=2, timeout=10
+    )
+
+    assert list(result) == []
+    assert sequential == [[1, 2]]
+
+
+@pytest.mark.django_db
+def test_repaired_remote_file_is_uploaded_and_removed(
+    processed_document, monkeypatch, settings
+):
+    storage = InMemoryStorage()
+    monkeypatch.setattr(Document._meta.get_field("pdf_file"), "storage", storage)
+    source = settings.TEST_DATA_ROOT / "example-doc" / "example.pdf"
+    old_name = "docs/example.pdf"
+    storage.save(old_name, ContentFile(source.read_bytes()))
+    doc = Document.objects.get(pk=processed_document.pk)
+    doc.pdf_file.name = old_name
+    attempts = []
+
+    def try_reading_pdf(pdf_file, password=None):
+        attempts.append(pdf_file)
+        if len(attempts) == 1:
+            raise pdf_utils.PDFException(None, "rewrite")
+        return PdfReader(pdf_file)
+
+    monkeypatch.setattr(pdf_utils, "try_reading_pdf", try_reading_pdf)
+    monkeypatch.setattr(pdf_utils, "rewrite_pdf_in_place", lambda f, **kw: f)
+    services.pdf_processor_cache.clear()
+
+    with services.open_document_pdf(doc) as pdf:
+        assert pdf.repairs == ["rewrite"]
+        repaired_path = pdf.filename
+        assert repaired_path.exists()
+
+    assert not repaired_path.exists()
+    assert len(services.pdf_processor_cache) == 0
+    # InMemoryStorage does not overwrite, the document points to the upload
+    assert doc.pdf_file.name != old_name
+    assert not storage.exists(old_name)
+    doc.refresh_from_db()
+    assert doc.pdf_file.name != old_name
+    assert storage.exists(doc.pdf_file.name)